@@ -10,10 +10,10 @@ __status__ = "Production"
 
 import os
 from flask import Flask, render_template, request, redirect
-from celery import Celery
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 # app.debug = True  # /var/log/apache2/error.log
 # app.config.from_object('config')
 from . import views
+from .api import views as api
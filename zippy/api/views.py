@@ -1,25 +1,110 @@
 #!/usr/bin/env python
 
-import sys
-import os
 import re
 import json
 import hashlib
-import subprocess
-from flask import Flask, render_template, request, redirect, send_from_directory
-from zippy import app
-from .. import ascii_encode_dict
-from ..primer import Location
-from ..database import PrimerDB
+from flask import render_template, request, jsonify, url_for
+from .. import app
+from ..zippy import updateLocation
+from ..views import database
+from ..zippylib.primer import Location
+from ..zippylib.interval import Interval
 
 # RESTful API for zippy (LOVD/SNPpy connections)
 
+API_MAXPAGE = 500  # maximum page size of name search
+API_MAXBATCH = 1000  # maximum number of queries per batch request
+intervalmatch = re.compile(r'^(\w+):(\d+)-(\d+)$')
+
+def primer_json(primer):
+    return {
+        'name': primer.name,
+        'seq': primer.seq,
+        'tag': primer.tag,
+        'tm': round(primer.tm, 2),
+        'gc': round(primer.gc, 3),
+        'location': str(primer.location) if primer.location else None
+    }
+
+def pair_json(pair):
+    return {
+        'name': pair.name,
+        'chrom': pair[0].targetposition.chrom,
+        'start': pair[0].targetposition.offset,
+        'end': pair[1].targetposition.offset + pair[1].targetposition.length,
+        'left': primer_json(pair[0]),
+        'right': primer_json(pair[1])
+    }
+
+def api_response(version, payload):
+    # ETag changes with database version (and request)
+    etag = hashlib.sha1(json.dumps([version, request.path, request.query_string, request.get_data()])).hexdigest()
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate
+    return response
+
+def api_error(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+def parse_interval(query):
+    m = intervalmatch.match(query)
+    if not m or int(m.group(2)) > int(m.group(3)):
+        raise ValueError('invalid interval {}'.format(query))
+    return Interval(m.group(1), int(m.group(2)), int(m.group(3)))
+
+@app.route('/api/v1/pairs')
+def api_pairs():
+    # paginated name search
+    name = request.args.get('name', '')
+    try:
+        page = int(request.args.get('page', 1))
+        perPage = min(int(request.args.get('per_page', 50)), API_MAXPAGE)
+        assert page > 0 and perPage > 0
+    except (ValueError, AssertionError):
+        return api_error(400, 'page and per_page must be positive integers')
+    db = database()
+    version = db.version()
+    total, pairs = db.search(name, offset=(page-1)*perPage, limit=perPage)
+    return api_response(version, {
+        'version': version,
+        'total': total,
+        'page': page,
+        'per_page': perPage,
+        'next': url_for('api_pairs', name=name, page=page+1, per_page=perPage) if page*perPage < total else None,
+        'pairs': [ pair_json(p) for p in pairs ]
+    })
+
+@app.route('/api/v1/query', methods=['POST'])
+def api_query():
+    # batch lookup of intervals and names (answered in one database transaction)
+    spec = request.get_json(silent=True)
+    if not isinstance(spec, dict):
+        return api_error(400, 'expected JSON object with intervals and/or names')
+    names = [ str(n) for n in spec.get('names', []) ]
+    intervals = [ str(i) for i in spec.get('intervals', []) ]
+    if len(names) + len(intervals) > API_MAXBATCH:
+        return api_error(413, 'at most {} queries per request'.format(API_MAXBATCH))
+    try:
+        queries = map(parse_interval, intervals) + names
+    except ValueError as e:
+        return api_error(400, str(e))
+    db = database()
+    version = db.version()
+    results = [ [ pair_json(p) for p in pairs ] for pairs in db.queryMany(queries) ]
+    return api_response(version, {
+        'version': version,
+        'intervals': dict(zip(intervals, results[:len(intervals)])),
+        'names': dict(zip(names, results[len(intervals):]))
+    })
+
 @app.route('/update_location/<primername>/<int:vessel>/<well>', methods=['PUT','GET','POST'])
 def update_Location2(primername,vessel,well):
-    # read config
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'])
     # run zippy and render
-    updateStatus = updateLocation(primername, Location(vessel, well), db, False)
+    updateStatus = updateLocation(primername, Location(vessel, well), database(), False)
     return render_template('location_updated.html', status=updateStatus)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+'''micro benchmarks (run with: python benchmark.py [name ...])'''
+
+import os
+import sys
+import time
+import tempfile
+import resource
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import random
+from copy import copy
+from collections import defaultdict
+from zippylib.interval import Interval, IntervalList
+from zippylib.memorydb import MemoryDB
+from zippylib.database import PrimerDB
+from zippylib.files import GenePred, SNPpy, readBatch
+from zippylib.annotation import compileAnnotation, openAnnotation
+from test import primerPair
+
+'''times function call (best of repeats)'''
+def timeit(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+'''times function in child process (returns seconds and peak memory increase in MB)'''
+def peak(func):
+    queue = multiprocessing.Queue()
+    def run():
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        result = func()
+        queue.put((time.time()-start, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-before)/1024.0))
+    process = multiprocessing.Process(target=run)
+    process.start()
+    measured = queue.get()
+    process.join()
+    return measured
+
+'''store and query primer pairs with storage engine'''
+def bench_database(n=2000, queries=500):
+    pairs = [ primerPair('GENE_{}'.format(i), str(1+i%22), 1000*i, 1000*i+400, i) for i in range(n) ]
+    intervals = [ Interval(str(1+i%22), 1000*i+100, 1000*i+200) for i in range(0, n, n/queries) ]
+    fd, sqlite = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        for name, db in [ ('memory', MemoryDB()), ('sqlite', PrimerDB(sqlite)) ]:
+            print '{:<10} addPair   {:>5d} pairs     {:8.3f}s'.format(name, n, timeit(lambda: db.addPair(*pairs), repeat=1))
+            print '{:<10} query     {:>5d} intervals {:8.3f}s'.format(name, len(intervals), timeit(lambda: [ db.query(iv) for iv in intervals ]))
+            print '{:<10} query     {:>5d} names     {:8.3f}s'.format(name, 50, timeit(lambda: [ db.query('GENE_{}'.format(i)) for i in range(50) ]))
+    finally:
+        os.unlink(sqlite)
+
+'''overlap of gene intervals with variants (predesign selection)'''
+def bench_intersect(genes=20000, variants=2000):
+    random.seed(0)
+    exons = IntervalList([ Interval(str(1+i%22), s, s+random.randint(50,500)) for i, s in \
+        enumerate(random.sample(xrange(10**8), genes)) ])
+    snvs = IntervalList([ Interval(str(1+i%22), s, s+1) for i, s in enumerate(random.sample(xrange(10**8), variants)) ])
+    subset = IntervalList(exons[:genes/10])  # pairwise scan is too slow for all (both methods timed on subset)
+    print '{:<10} {:>5d} x {:>5d}       {:8.3f}s'.format('scan', len(subset), variants, \
+        timeit(lambda: [ e for e in subset if any([ e.overlap(v) for v in snvs ]) ], repeat=1))
+    print '{:<10} {:>5d} x {:>5d}       {:8.3f}s'.format('intersect', len(subset), variants, timeit(lambda: subset.intersect(snvs)))
+    print '{:<10} {:>5d} x {:>5d}       {:8.3f}s'.format('intersect', genes, variants, timeit(lambda: exons.intersect(snvs)))
+
+def bench_annotation(transcripts=20000, genes=5):
+    random.seed(0)
+    fd, refgene = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as fh:
+        for i in range(transcripts):
+            starts = sorted(random.sample(xrange(i*10000, i*10000+9000, 100), random.randint(1,30)))
+            ends = [ s+random.randint(20,90) for s in starts ]
+            fh.write('\t'.join(map(str, [0, 'NM_{}'.format(i), 1+i%22, '+-'[i%2], starts[0], ends[-1], starts[0], ends[-1], \
+                len(starts), ','.join(map(str,starts))+',', ','.join(map(str,ends))+',', 0, 'G{}'.format(i/2)]))+'\n')
+    getgenes = [ 'G{}'.format(i) for i in random.sample(xrange(transcripts/2), genes) ]
+    def parse():
+        with open(refgene) as fh:
+            return GenePred(fh, getgenes=getgenes, interval=200)
+    def lookup():
+        with openAnnotation(refgene) as fh:
+            return GenePred(fh, getgenes=getgenes, interval=200)
+    print '{:<10} {:>5d} genes       {:8.3f}s'.format('parse', genes, timeit(parse))
+    print '{:<10} {:>5d} genes       {:8.3f}s'.format('compile', transcripts/2, timeit(lambda: compileAnnotation(refgene, refgene+'.sqlite'), repeat=1))
+    print '{:<10} {:>5d} genes       {:8.3f}s'.format('lookup', genes, timeit(lookup))
+    os.unlink(refgene)
+    os.unlink(refgene+'.sqlite')
+
+'''read SNPpy batch table (row dictionaries and all columns vs columnar reader)'''
+def bench_snppy(rows=100000, samples=96):
+    random.seed(0)
+    header = ['sampleID','chromosome','position','geneID','transcriptID','rank','HGVS_c','HGVS_p','REF','ALT','GT', \
+        'QUAL','DP','AF','effect','impact','dbSNP','clinvar','comment']
+    fd, table = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write('\t'.join(header)+'\n')
+        for i in range(rows):
+            gene = random.randint(0, 500)
+            position = 1000000*gene + random.randint(0, 50000)
+            fh.write('\t'.join(map(str, ['S{:03d}'.format(i%samples), 'chr{}'.format(1+gene%22), position, 'GENE{}'.format(gene), \
+                'NM_{:06d}.1'.format(gene), '{}/20'.format(random.randint(1,20)), 'c.{}A>G'.format(random.randint(1,5000)), \
+                'p.Lys{}Glu'.format(random.randint(1,1500)), 'A', 'G', random.choice(['0/1','1/1']), random.randint(20,5000), \
+                random.randint(10,500), random.random(), 'missense_variant', 'MODERATE', 'rs{}'.format(i), '.', '.']))+'\n')
+    def rows_and_columns():
+        with open(table) as fh:
+            intervals = SNPpy(fh, flank=15)
+        sampleVariants = {}
+        for iv in intervals:
+            try:
+                sampleVariants[iv.sample].append(iv)
+            except KeyError:
+                sampleVariants[iv.sample] = IntervalList([iv],source='SNPpy')
+        return sampleVariants, sorted(list(set(intervals.data['geneID']))), intervals
+    for name, func in [ ('SNPpy', rows_and_columns), ('columnar', lambda: readBatch(table, {'flank': 15})) ]:
+        print '{:<10} {:>6d} rows {:8.3f}s {:8.1f}MB peak'.format(name, rows, *peak(func))
+    os.unlink(table)
+
+'''interval bookkeeping as in getPrimers (dictionary keys, membership, sorting, copies)'''
+def bench_intervals(n=50000, lookups=10):
+    random.seed(0)
+    intervals = [ Interval(str(1+i%22), s, s+random.randint(50,500), 'GENE{}_{}'.format(i/20, i%20)) \
+        for i, s in enumerate(random.sample(xrange(10**8), n)) ]
+    def bookkeeping():
+        ivpairs = defaultdict(list)
+        for iv in intervals:
+            ivpairs[iv].append(iv.name)
+        for i in range(lookups):
+            found = [ iv for iv in intervals if iv in ivpairs and ivpairs[iv] ]
+        return set(found)
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('create', n, timeit(lambda: [ Interval(iv.chrom, iv.chromStart, iv.chromEnd, iv.name) for iv in intervals ]))
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('dict/set', n, timeit(bookkeeping))
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('sort', n, timeit(lambda: sorted(intervals)))
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('copy', n, timeit(lambda: [ copy(iv) for iv in intervals ]))
+
+'''tile and flank exome-sized interval set (per Interval vs IntervalArray)'''
+def bench_tiling(n=200000, interval=500, overlap=10, flank=15):
+    from zippylib.intervalarray import IntervalArray
+    random.seed(0)
+    starts = sorted(random.sample(xrange(10**9), n))
+    ends = [ s + int(random.expovariate(1/170.0)) + 20 for s in starts ]
+    chroms = [ str(1+i*22/n) for i in range(n) ]
+    names = [ 'E{}'.format(i) for i in range(n) ]
+    intervals = [ Interval(c, s, e, name) for c, s, e, name in zip(chroms, starts, ends, names) ]
+    def loop():
+        return [ e.extend(flank) for iv in intervals for e in (iv.tile(interval, overlap) if interval < len(iv) else [ iv ]) ]
+    array = IntervalArray(chroms, starts, ends, names)
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('Interval', n, timeit(loop, repeat=1))  # extends in place
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('array', n, timeit(lambda: array.tile(interval, overlap).extend(flank)))
+    print '{:<10} {:>6d} intervals {:8.3f}s'.format('flatten', n, timeit(lambda: array.flatten()))
+
+'''rank candidate primer pairs of intervals (sorting by comparison vs cached key top-k)'''
+def bench_ranking(intervals=500, candidates=50, pairs=3):
+    import heapq
+    ivpairs = [ [ primerPair('GENE{}_{}'.format(i, j), '1', 1000*j, 1000*j+400, j) for j in range(candidates) ] for i in range(intervals) ]
+    for p in [ p for c in ivpairs for p in c ]:
+        p[0].rank = p[1].rank = len(p.name) % 7
+    def compared():
+        return [ sorted(c, cmp=lambda a, b: cmp(a.sortvalues(), b.sortvalues()))[:pairs] for c in ivpairs ]
+    def cached():
+        return [ heapq.nsmallest(pairs, c, key=lambda x: x.rankkey()) for c in ivpairs ]
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('sortvalues', intervals*candidates, timeit(compared))
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('rankkey', intervals*candidates, timeit(cached))
+
+'''in silico PCR of promiscuous primer pairs (nested loop vs sorted binding sites, loci below alignment limit of 20)'''
+def bench_pcr(pairs=2000, loci=19):
+    from zippylib.primer import Locus
+    random.seed(0)
+    candidates = [ primerPair('GENE{}'.format(i), '1', 1000, 1400, i) for i in range(pairs) ]
+    for p in candidates:
+        for primer in p:
+            primer.loci = [ Locus(str(random.randint(1,3)), random.randint(0,10**6), 20, random.random() < 0.5, 60.0) for j in range(loci) ]
+    def loop(p, sizeRange=[0,10000]):
+        return [ (m, n) for m in p[0].loci for n in p[1].loci if m.chrom == n.chrom and sizeRange[0] <= n.offset + n.length - m.offset <= sizeRange[1] ]
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('loop', pairs, timeit(lambda: [ loop(p) for p in candidates ]))
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('sorted', pairs, timeit(lambda: [ p.products(autoreverse=False) for p in candidates ]))
+
+'''primer pair identities and copies as in importPrimerPairs and batch bookkeeping'''
+def bench_primers(n=20000, lookups=5):
+    from copy import deepcopy
+    pairs = [ primerPair('GENE{}'.format(i), '1', 1000*i, 1000*i+400, i) for i in range(n) ]
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('uniqueid', n, timeit(lambda: [ p.uniqueid() for i in range(lookups) for p in pairs ]))
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('hash', n, timeit(lambda: set([ p for i in range(lookups) for p in pairs ])))
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('deepcopy', n, timeit(lambda: [ deepcopy(x) for p in pairs for x in p ]))
+    print '{:<10} {:>6d} pairs {:8.3f}s'.format('copy', n, timeit(lambda: [ copy(x) for p in pairs for x in p ]))
+
+'''melting temperatures of repeated primer sequences (primer3 vs process cache)'''
+def bench_thermo(n=50000, unique=2000):
+    import primer3
+    from zippylib.thermo import Thermodynamics
+    random.seed(0)
+    seqs = [ ''.join([ random.choice('ACGT') for i in range(20) ]) for j in range(unique) ]
+    queries = [ random.choice(seqs) for i in range(n) ]
+    cache = Thermodynamics()
+    print '{:<10} {:>6d} sequences {:8.3f}s'.format('primer3', n, timeit(lambda: [ primer3.calcTm(s) for s in queries ]))
+    print '{:<10} {:>6d} sequences {:8.3f}s ({:.0%} hits)'.format('cached', n, timeit(lambda: [ cache.tm(s) for s in queries ]), cache.ratio())
+
+if __name__ == '__main__':
+    benchmarks = sorted([ k for k in globals().keys() if k.startswith('bench_') ])
+    for b in benchmarks:
+        if len(sys.argv) < 2 or b[6:] in sys.argv[1:]:
+            print '== {} =='.format(b[6:])
+            globals()[b]()
@@ -1,20 +1,218 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import json
+import shutil
+import tempfile
+import multiprocessing
+import subprocess
+import sqlite3
+import time
+from copy import copy
+from StringIO import StringIO
 import unittest
+from hashlib import sha1
+zippydir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, zippydir)
+import zippy
+from zippylib.interval import Interval, IntervalList
+from zippylib.primer import Primer, PrimerPair, Locus, Location, rankedPairs
+from zippylib.memorydb import MemoryDB
+from zippylib.pcr import Multiplex
+from zippylib.database import PrimerDB
+from zippylib.jobs import JobQueue, JobProgress
+from zippylib import Progressbar, addProgressSink, removeProgressSink
+from zippylib.registry import Registry
+from zippylib.metrics import Metrics, metrics, exportMetrics
+from zippylib.thermo import Thermodynamics
+from zippylib.daemon import DesignDaemon, forward
+import gzip
+from zippylib.files import GenePred, SNPpyTable, readTargets, iterTargets, chunks
+from zippylib.annotation import compileAnnotation, openAnnotation, AnnotationStore
+
+'''builds primer pair with unique sequences around amplicon'''
+def primerPair(name, chrom, start, end, n):
+    seqs = [ ''.join([ 'ACGT'[(n*7+i*i) % 4] for i in range(20) ]), ''.join([ 'TGCA'[(n*5+i*3) % 4] for i in range(20) ]) ]
+    left = Primer(name+'_fwd', seqs[0], Locus(chrom, start, 20, False, 60.0), tag='M13')
+    right = Primer(name+'_rev', seqs[1], Locus(chrom, end-20, 20, True, 60.0), tag='M13')
+    left.loci, right.loci = [ left.targetposition ], [ right.targetposition ]
+    return PrimerPair([left, right], name=name)
+
+'''stubs primer3 design, alignment import and SNP check (designs one pair for each named amplicon)'''
+class DesignStub(object):
+    def __init__(self, amplicons):
+        self.amplicons = amplicons  # target name -> (chrom, start, end)
+        self.designed = []  # target names in design order
+        self.pending = []  # designed but not imported
+        with open(os.path.join(zippydir, 'zippy.json')) as fh:
+            self.config = json.load(fh)
+        self.config['design']['processes'] = 1
+        self.config['blacklistcache'] = tempfile.mktemp(suffix='.cache')
+
+    def pair(self, name):
+        pair = primerPair(name, *(self.amplicons[name] + (0,)))
+        for i, primer in enumerate(pair):  # unique sequences
+            primer.seq = ''.join([ 'ACGT'[int(c, 16) % 4] for c in sha1(name+str(i)).hexdigest()[:20] ])
+        return pair
+
+    def design(self, args):
+        self.designed.append(args[3])
+        if args[3] not in self.amplicons:
+            return [], 0.0
+        self.pending.append(args[3])
+        return [ tuple(self.pair(args[3])) ], 0.0
+
+    def importPairs(self, fasta, config, primer3=True):
+        pairs, self.pending = [ self.pair(name) for name in self.pending ], []
+        return pairs
+
+    def __enter__(self):
+        self.originals = (zippy.primer3Design, zippy.importPrimerPairs, Primer.snpCheckPrimer)
+        zippy.primer3Design, zippy.importPrimerPairs = self.design, self.importPairs
+        Primer.snpCheckPrimer = lambda primer, vcf: setattr(primer, 'snp', [])
+        return self
+
+    def __exit__(self, *exc):
+        zippy.primer3Design, zippy.importPrimerPairs, Primer.snpCheckPrimer = self.originals
+        if os.path.exists(self.config['blacklistcache']):
+            os.unlink(self.config['blacklistcache'])
+
+'''checks if query is answered from replica'''
+def fromReplica(db):
+    with db.reader() as cursor:
+        return cursor.connection in db.replicareaders
 
 class TestPrimers(unittest.TestCase):
 
+    def openDatabase(self):
+        return MemoryDB()
+
     def setUp(self):
         # add primers to database
-        raise NotImplementedError
+        self.db = self.openDatabase()
+        self.db.addPair(*[ primerPair('GENE_{}'.format(i), '1', 1000*i, 1000*i+400, i) for i in range(1,6) ])
 
     def test_retrival(self):
         # get
-        raise NotImplementedError
+        pairs = self.db.query(Interval('1', 3100, 3200))
+        self.assertEqual([ p.name for p in pairs ], ['GENE_3'])
+        self.assertEqual(self.db.query(Interval('1', 3000, 3200)), [])  # overlaps primer
+        self.assertEqual(self.db.query(Interval('2', 3100, 3200)), [])
+        self.assertEqual(len(self.db.query('GENE')), 5)
+        # storage and blacklist
+        self.assertTrue(self.db.storePrimer('GENE_2_fwd', Location(1, 'A1')))
+        self.assertFalse(self.db.storePrimer('GENE_3_fwd', Location(1, 'A1')))
+        self.assertEqual(self.db.getLocation(Location(1, 'A1')), ['GENE_2_fwd'])
+        self.assertEqual(self.db.blacklist('GENE_3'), ['GENE_3'])
+        self.assertEqual(self.db.query(Interval('1', 3100, 3200)), [])
+        self.assertEqual(sorted(self.db.removeOrphans()), ['GENE_3_fwd', 'GENE_3_rev'])
+
+    def test_batch(self):
+        pairs = self.db.queryMany([Interval('1', 3100, 3200), Interval('2', 3100, 3200), 'GENE_4'])
+        self.assertEqual([ [ p.name for p in x ] for x in pairs ], [['GENE_3'], [], ['GENE_4']])
+        total, pairs = self.db.search('gene', offset=1, limit=2)
+        self.assertEqual(total, 5)
+        self.assertEqual([ p.name for p in pairs ], ['GENE_2', 'GENE_3'])
+
+    def test_redundant(self):
+        # GENE_1 and GENE_5 primers have same sequences and tags, stored primer is kept before older records
+        self.assertTrue(self.db.storePrimer('GENE_5_fwd', Location(1, 'A1')))
+        self.assertEqual(sorted([ r[2] for r in self.db.getRedundantPrimers()[0] ]), ['GENE_1_fwd,GENE_5_fwd', 'GENE_1_rev,GENE_5_rev'])
+        self.assertEqual(sorted(self.db.mergeRedundantPrimers()), [('GENE_1_fwd', 'GENE_5_fwd'), ('GENE_5_rev', 'GENE_1_rev')])
+        self.assertEqual(self.db.getRedundantPrimers()[0], [])
+        # pairs reference merged primers
+        pairs = { row[0]: (row[2], row[4]) for row in self.db.pairTable() }
+        self.assertEqual((pairs['GENE_1'], pairs['GENE_5']), (('GENE_5_fwd', 'GENE_1_rev'), ('GENE_5_fwd', 'GENE_1_rev')))
+        self.assertEqual(pairs['GENE_2'], ('GENE_2_fwd', 'GENE_2_rev'))
+        self.assertEqual(sorted([ p.name for p in self.db.query('GENE') ]), ['GENE_1', 'GENE_2', 'GENE_3', 'GENE_4', 'GENE_5'])
+
+    def test_version(self):
+        version = self.db.version()
+        self.db.blacklist('GENE_3')
+        self.assertTrue(self.db.version() > version)
+        self.assertEqual(self.db.version(), self.db.version())
+
+    def test_ranking(self):
+        pairs = [ primerPair('GENE_{}'.format(i), '1', 1000*i, 1000*i+400, i) for i in range(1,6) ]
+        for i, p in enumerate(pairs):
+            p[0].rank = p[1].rank = 5-i
+        self.assertEqual([ p.name for p in rankedPairs(pairs) ], ['GENE_5', 'GENE_4', 'GENE_3', 'GENE_2', 'GENE_1'])
+        # cached key is invalidated by mispriming and (critical) SNPs
+        pairs[4][0].loci = pairs[4][0].loci + (Locus('2', 500, 20, False, 60.0),)
+        pairs[3][1].snp = [ (None, 0, 1) ]
+        self.assertEqual([ p.name for p in rankedPairs(pairs) ], ['GENE_3', 'GENE_2', 'GENE_1', 'GENE_5', 'GENE_4'])
+        self.assertEqual(sorted(pairs), list(rankedPairs(pairs)))
+        pairs[2][0].rank = pairs[2][1].rank = 9
+        self.assertEqual([ p.name for p in rankedPairs(pairs) ], ['GENE_2', 'GENE_1', 'GENE_3', 'GENE_5', 'GENE_4'])
+        # equal pairs (same name) hash equal
+        other = primerPair('GENE_1', '2', 9000, 9400, 9)
+        self.assertEqual(other, pairs[0])
+        self.assertEqual(hash(other), hash(pairs[0]))
+
+    def test_pcr(self):
+        pairs = [ primerPair('GENE_{}'.format(i), '1', 1000*i, 1000*i+400, i) for i in range(1,4) ]
+        pairs[0][1].loci = list(pairs[0][1].loci) + [ Locus('1', 1900, 20, True, 60.0) ]  # second product
+        self.assertEqual([ (m.offset, n.offset) for m, n in pairs[0].products([100,2000]) ], [(1000, 1380), (1000, 1900)])
+        self.assertEqual(len(pairs[0].products([100,500])), 1)
+        # products between neighbouring pairs in multiplex (own mispriming is not reported)
+        offtarget = Multiplex(pairs).offtarget([100,1500])
+        self.assertEqual(sorted([ (f[1].name, r[1].name) for f, r in offtarget ]), [('GENE_1_fwd', 'GENE_2_rev'), ('GENE_2_fwd', 'GENE_3_rev')])
+
+    def test_values(self):
+        pair = primerPair('GENE_1', '1', 1000, 1400, 1)
+        uniqueid = pair.uniqueid()
+        self.assertEqual(pair.uniqueid(), uniqueid)
+        # copies share loci until replaced, derived values follow tag changes
+        primer = copy(pair[0])
+        self.assertTrue(primer.loci is pair[0].loci)
+        with self.assertRaises(AttributeError):
+            primer.loci.append(Locus('2', 500, 20, False, 60.0))  # replaced, never changed in place
+        primer.tag = 'TAG'
+        self.assertEqual((primer.label(), pair[0].label()), ('TAG-'+pair[0].seq, 'M13-'+pair[0].seq))
+        pair[0] = primer
+        self.assertNotEqual(pair.uniqueid(), uniqueid)
+        with self.assertRaises(AttributeError):
+            primer.undefined = True
 
     def test_design(self):
-        # get with design
-        raise NotImplementedError
+        # get from database and design
+        intervals = [ Interval('1', 3100, 3200, name='GENE_3'), Interval('1', 8100, 8200, name='NEW') ]
+        with DesignStub({ 'NEW': ('1', 8000, 8400) }) as stub:
+            ivpairs = zippy.findPrimers(intervals, self.db, True, stub.config)[0]
+            self.assertEqual([ [ p.name for p in ivpairs[iv] ] for iv in intervals ], [['GENE_3'], ['NEW']])
+            self.assertFalse(os.path.exists(stub.config['blacklistcache']))  # nothing blacklisted
+            # blacklisted designs are discarded
+            ivpairs = zippy.findPrimers(intervals[1:], None, True, stub.config, blacklist=[ stub.pair('NEW').uniqueid() ])[0]
+            self.assertEqual(ivpairs[intervals[1]], [])
+
+    def test_batch_design(self):
+        # variant shared by samples is designed once, samples select own copies covering own variants
+        sampleVariants = { 'S1': [ Interval('1', 8100, 8200, name='SHARED', sample='S1'), Interval('1', 3100, 3200, name='OWN', sample='S1') ],
+            'S2': [ Interval('1', 8100, 8200, name='SHARED', sample='S2') ] }
+        sampleVariants = dict([ (s, IntervalList(v, source='SNPpy')) for s, v in sampleVariants.items() ])
+        stored = []
+        self.db.addPair = lambda *pairs: stored.extend(pairs)
+        with DesignStub({ 'SHARED': ('1', 8000, 8400) }) as stub:
+            table, samplePairs, missed = zippy.batchPrimers(sampleVariants, self.db, True, stub.config)
+        self.assertEqual(stub.designed, ['SHARED'])
+        self.assertEqual(missed, {})
+        variants = sorted([ (sample, pair.name.split('_')[0], [ (v.name, v.sample) for v in pair.variants ]) for sample, pair in samplePairs ])
+        self.assertEqual(variants, [('S1', 'GENE', [('OWN', 'S1')]), ('S1', 'SHARED', [('SHARED', 'S1')]), ('S2', 'SHARED', [('SHARED', 'S2')])])
+        self.assertEqual(sorted([ (row[0], row[1]) for row in table ]), [('S1', 'OWN'), ('S1', 'SHARED'), ('S2', 'SHARED')])
+        self.assertEqual(sorted([ p.name.split('_')[0] for p in stored ]), ['GENE', 'SHARED'])  # stored once
+
+    def test_clustered_design(self):
+        # nearby variants share one amplicon, members of clusters without design fall back to own amplicons
+        intervals = IntervalList([ Interval('1', 8100, 8110, 'A'), Interval('1', 8200, 8210, 'B'), \
+            Interval('1', 20100, 20110, 'C'), Interval('1', 20250, 20260, 'D') ], source='SNPpy')
+        with DesignStub({ 'A_B': ('1', 8000, 8400), 'C': ('1', 20000, 20300), 'D': ('1', 20150, 20450) }) as stub:
+            ivpairs = zippy.findClusteredPrimers(intervals, self.db, True, stub.config)
+            primerTable, resultList, missedIntervals = zippy.selectPrimers(intervals, ivpairs, stub.config)
+        self.assertEqual(sorted(set(stub.designed)), ['A_B', 'C', 'C_D', 'D'])
+        self.assertEqual(missedIntervals, [])
+        self.assertEqual(sorted([ (p.name, [ v.name for v in p.variants ]) for p in resultList ]), \
+            [('A_B', ['A', 'B']), ('C', ['C']), ('D', ['D'])])
 
     def test_isupper(self):
         self.assertTrue('FOO'.isupper())
@@ -27,5 +225,350 @@ class TestPrimers(unittest.TestCase):
         with self.assertRaises(TypeError):
             s.split(2)
 
+class TestPrimersSQLite(TestPrimers):
+
+    def openDatabase(self):
+        fd, self.sqlite = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        return PrimerDB(self.sqlite)
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.sqlite+suffix):
+                os.unlink(self.sqlite+suffix)
+
+    def test_snapshot(self):
+        snapshot = self.db.snapshot(self.sqlite+'.snapshot')
+        try:
+            self.assertEqual(os.stat(snapshot).st_mode & 0222, 0)  # read-only
+            self.assertEqual(len(PrimerDB(snapshot).query('GENE')), 5)
+            self.assertFalse(os.path.exists(snapshot+'-wal'))  # opened in rollback journal mode (also as root)
+            self.assertEqual(sqlite3.connect(snapshot).execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            # writers proceed during long read transactions (write-ahead log)
+            reader = sqlite3.connect(self.sqlite, isolation_level=None)
+            reader.execute('BEGIN')
+            reader.execute('SELECT COUNT(*) FROM primer').fetchone()
+            self.db.timeout, self.db.retries = 0.1, 0
+            self.assertEqual(self.db.blacklist('GENE_3'), ['GENE_3'])
+            reader.close()
+        finally:
+            os.unlink(snapshot)
+
+    def test_replica(self):
+        replica = PrimerDB(self.sqlite, replica=self.sqlite+'.replica', refresh=3600)
+        try:
+            # missing replica is refreshed in background by one process (primary answers meanwhile)
+            with open(self.sqlite+'.replica.lock', 'w') as fh:
+                fh.write(str(os.getpid()))
+            self.assertEqual(len(replica.query('GENE')), 5)
+            self.assertFalse(os.path.exists(self.sqlite+'.replica'))
+            os.unlink(self.sqlite+'.replica.lock')
+            replica.refreshReplica().join()
+            self.assertFalse(os.path.exists(self.sqlite+'.replica.lock'))
+            self.db.blacklist('GENE_3')
+            self.assertEqual(len(replica.query('GENE')), 5)  # within refresh interval
+            self.assertEqual(replica.version(primary=True), self.db.version())  # batch cache is keyed on primary
+            self.assertTrue(replica.version() < self.db.version())
+            replica.blacklist('GENE_2')
+            self.assertEqual(len(replica.query('GENE')), 3)  # own writes from primary
+            replica.aftercommit = True
+            replica.blacklist('GENE_4')
+            self.assertEqual(len(replica.query('GENE')), 2)
+            while os.path.exists(self.sqlite+'.replica.lock'):
+                time.sleep(0.01)
+            self.assertTrue(fromReplica(replica))
+            # own writes are read from replica once any instance has refreshed it
+            writer = PrimerDB(self.sqlite, replica=self.sqlite+'.replica', refresh=3600)
+            writer.blacklist('GENE_5')
+            self.assertFalse(fromReplica(writer))
+            self.assertEqual(len(writer.query('GENE')), 0)  # GENE_1 has same sequences
+            replica.refreshReplica().join()
+            self.assertTrue(fromReplica(writer))
+            self.assertEqual(len(writer.query('GENE')), 0)
+            # connections in use are closed when their readers finish
+            with writer.reader() as cursor:
+                writer.close()
+                self.assertEqual(cursor.execute('SELECT COUNT(*) FROM primer').fetchone()[0], 10)
+            self.assertEqual((writer.replicareaders, writer.retired), ({}, set()))
+            with self.assertRaises(sqlite3.ProgrammingError):
+                cursor.connection.execute('SELECT 1')
+        finally:
+            os.unlink(self.sqlite+'.replica')
+
+class TestIntervals(unittest.TestCase):
+
+    def test_cluster(self):
+        variants = IntervalList([ Interval('1', 1000, 1010, 'a'), Interval('1', 1150, 1160, 'b'), \
+            Interval('1', 1400, 1410, 'c'), Interval('2', 1420, 1430, 'd'), Interval('1', 5000, 5010, 'e') ])
+        clusters = variants.cluster(200, 300)
+        self.assertEqual([ (c.name, c.chromStart, c.chromEnd) for c in clusters ], \
+            [('a_b', 1000, 1160), ('c', 1400, 1410), ('e', 5000, 5010), ('d', 1420, 1430)])
+        self.assertEqual([ iv.name for iv in clusters[0].subintervals ], ['a', 'b'])
+        self.assertEqual(len(variants.cluster(300, 500)[0].subintervals), 3)
+
+    def test_identity(self):
+        a, b = Interval('1', 100, 200, 'a'), Interval('1', 100, 200, 'a')
+        self.assertTrue(a == b and not a != b and len(set([a, b])) == 1)
+        self.assertTrue(a._subintervals is None and not a.subintervals)  # created on access
+        ivpairs = { a: [] }
+        b.extend(10)  # key changes with location
+        self.assertTrue(b not in ivpairs and a in ivpairs)
+        b.chromStart, b.chromEnd, b.name = 100, 200, 'b'
+        self.assertEqual((a != b, sorted([b, a]), b.key()), (True, [b, a], (('1', 100, 200), 'b')))
+
+    def test_intervalarray(self):
+        from zippylib.intervalarray import intervalArray
+        intervals = [ Interval('1', 100, 1100, 'a', True, 'S1'), Interval('2', 0, 300, 'b'), Interval('1', 1050, 1200), Interval('10', 5, 5) ]
+        array = intervalArray(intervals)
+        self.assertEqual([ (str(iv), iv.strand, iv.sample) for iv in array.intervals() ], [ (str(iv), iv.strand, iv.sample) for iv in intervals ])
+        self.assertEqual([ str(iv) for iv in array.sort().intervals() ], [ str(iv) for iv in sorted(intervals) ])
+        self.assertEqual([ str(iv) for iv in array.flatten().intervals() ], ['1\t100\t1200\ta_1:1050-1200', '10\t5\t5\t10:5-5', '2\t0\t300\tb'])
+        tiles = [ e for iv in intervals for e in (iv.tile(400, 10) if len(iv) > 400 else [ iv ]) ]
+        self.assertEqual([ (str(iv), iv.strand) for iv in array.tile(400, 10).extend(5).intervals() ], \
+            [ (str(iv.extend(5)), iv.strand) for iv in tiles ])
+
+    def test_intersect(self):
+        exons = IntervalList([ Interval('1', 100, 5000, 'long'), Interval('1', 6000, 6100, 'a'), \
+            Interval('1', 7000, 7100, 'b'), Interval('2', 6000, 6100, 'c') ])
+        variants = [ Interval('1', 4000, 4001), Interval('1', 7100, 7101), Interval('3', 6050, 6051) ]
+        self.assertEqual([ e.name for e in exons.intersect(variants) ], ['long', 'b'])  # bookended included
+        self.assertEqual(exons.intersect([]), [])
+
+    def test_annotation(self):
+        refgene = [ '0\tNM_1\t1\t+\t100\t1000\t150\t900\t4\t100,300,360,800,\t200,340,400,1000,\t0\tA\n', \
+            '0\tNM_2\t1\t+\t100\t1000\t150\t900\t2\t100,500,\t200,600,\t0\tA\n', \
+            '0\tNR_3\t1\t-\t2000\t2500\t2500\t2500\t1\t2000,\t2500,\t0\tB\n' ]
+        directory = tempfile.mkdtemp()
+        genepred = os.path.join(directory, 'refGene')
+        with open(genepred, 'w') as fh:
+            fh.writelines(refgene)
+        self.assertEqual(compileAnnotation(genepred, genepred+'.sqlite'), 1)
+        store = openAnnotation(genepred)
+        self.assertTrue(isinstance(store, AnnotationStore))
+        compiled = sorted([ str(iv) for iv in GenePred(store, getgenes=['A','B'], interval=200) ])
+        self.assertEqual(compiled, sorted([ str(iv) for iv in GenePred(refgene, getgenes=['A','B'], interval=200) ]))
+        self.assertEqual(compiled, ['1\t150\t200\tA_1', '1\t300\t400\tA_2+3', '1\t500\t600\tA_4', '1\t800\t900\tA_5'])
+        with open(genepred, 'a') as fh:  # outdated
+            fh.write(refgene[2])
+        os.utime(genepred, (0, 0))
+        with openAnnotation(genepred) as fh:
+            self.assertFalse(isinstance(fh, AnnotationStore))
+        shutil.rmtree(directory)
+
+    def test_targets(self):
+        bed = [ '#comment\n', '1\t100\t200\tA\n', '1\t300\t1000\tB\n', '2\t100\t200\tA\n', '2\t500\t1200\n' ]
+        directory = tempfile.mkdtemp()
+        with gzip.open(os.path.join(directory, 'targets.bed.gz'), 'w') as fh:
+            fh.writelines(bed)
+        tiling = { 'interval': 400, 'overlap': 10, 'flank': 5 }
+        targets = iterTargets(os.path.join(directory, 'targets.bed.gz'), tiling)
+        self.assertEqual(next(targets).name, 'A-01')  # streamed
+        self.assertEqual([ str(iv) for iv in readTargets(os.path.join(directory, 'targets.bed.gz'), tiling) ], \
+            ['1\t95\t205\tA-01', '1\t295\t660\tB_1', '1\t640\t1005\tB_2', '2\t95\t205\tA-02', \
+            '2\t495\t860\t2:500-855', '2\t840\t1205\t2:845-1200'])
+        self.assertEqual(map(len, chunks(iterTargets(os.path.join(directory, 'targets.bed.gz'), tiling), 4)), [4, 2])
+        self.assertEqual(readTargets(os.path.join(directory, 'targets.bed.gz'), tiling).source, 'BED')
+        # pipes cannot be read twice
+        os.mkfifo(os.path.join(directory, 'targets.bed'))
+        with self.assertRaisesRegexp(Exception, 'NotRegularFile'):
+            next(iterTargets(os.path.join(directory, 'targets.bed'), tiling))
+        shutil.rmtree(directory)
+
+    def test_snppy(self):
+        table = SNPpyTable(StringIO('sampleID\tchromosome\tposition\tgeneID\tGT\tREF\tALT\tQUAL\n' + \
+            'B\tchr1\t100\tG1\t0/1\tA\tCT\t50\nA\t2\t200-260\tG2\t1/1\t.\t.\t60\nB\tchr1\t300\tG1\t0/1\tA\tC\t70\n'), flank=5)
+        self.assertEqual((len(table), table.samples(), table.genes()), (3, ['A', 'B'], ['G1', 'G2']))
+        self.assertEqual([ (iv.chromStart, iv.chromEnd, iv.name) for iv in table.intervals('B') ], \
+            [(95, 107, 'G1%2C100%2C0/1'), (295, 306, 'G1%2C300%2C0/1')])
+        self.assertTrue(table.sample[0] is table.sample[2])  # interned
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.sqlite = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.queue = JobQueue(self.sqlite)
+
+    def tearDown(self):
+        os.unlink(self.sqlite)
+
+    def test_queue(self):
+        first = self.queue.submit('batch', {'targets': 'a.txt', 'deep': None})
+        second = self.queue.submit('adhoc', {'targets': '1:100-200'})
+        job = self.queue.claim()
+        self.assertEqual((job['id'], job['status'], job['spec']['targets']), (first, 'running', 'a.txt'))
+        self.queue.finish(first, {'outputFiles': ['a.pdf']})
+        self.assertEqual(self.queue.get(first)['result'], {'outputFiles': ['a.pdf']})
+        self.assertEqual(self.queue.claim()['id'], second)
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.recover(), [])  # worker (this process) alive
+        self.queue.fail(second, 'Exception: failed')
+        self.assertEqual(self.queue.get(second)['status'], 'failed')
+        # identical submissions attach to queued job
+        third = self.queue.submit('batch', {'targets': 'a.txt'}, key='abc')
+        self.assertEqual(self.queue.submit('batch', {'targets': 'a.txt'}, key='abc'), third)
+        self.assertNotEqual(self.queue.submit('batch', {'targets': 'a.txt'}), third)
+
+    def test_progress(self):
+        jobid = self.queue.submit('batch', {})
+        events = []
+        progress = JobProgress(self.queue, jobid)
+        addProgressSink(events.append)
+        addProgressSink(progress)
+        try:
+            bar = Progressbar(1000, 'Designing primers', interval=60)
+            for i in range(1001):
+                bar.update(i)
+        finally:
+            removeProgressSink(progress)
+            removeProgressSink(events.append)
+            progress.close('done')
+        self.assertEqual([ (e['done'], e['total']) for e in events ], [(0, 1000), (1000, 1000)])  # throttled
+        with open(self.queue.events(jobid)) as fh:
+            self.assertEqual(len(fh.readlines()), 3)
+        os.unlink(self.queue.events(jobid))
+        os.rmdir(os.path.dirname(self.queue.events(jobid)))
+        self.assertEqual(self.queue.get(jobid)['message'], 'Designing primers 1000/1000')
+
+class TestRegistry(unittest.TestCase):
+
+    def test_reload(self):
+        directory = tempfile.mkdtemp()
+        configfile = os.path.join(directory, 'zippy.json')
+        with open(configfile, 'w') as fh:
+            fh.write('{"database": "a.sqlite"}')
+        try:
+            registry = Registry(configfile)
+            opened = []
+            factory = lambda config: opened.append(config['database']) or len(opened)
+            self.assertEqual([ registry.resource('database', factory) for i in range(3) ], [1, 1, 1])
+            with open(configfile, 'w') as fh:
+                fh.write('{"database": "b.sqlite"}')
+            os.utime(configfile, (0, 0))  # file changed
+            self.assertEqual(registry.config()['database'], 'b.sqlite')
+            self.assertEqual(registry.resource('database', factory), 2)
+            self.assertEqual(opened, ['a.sqlite', 'b.sqlite'])
+            # resources of previous configuration are closed
+            db = PrimerDB(os.path.join(directory, 'primers.sqlite'), replica=os.path.join(directory, 'primers.replica'))
+            db.snapshot(db.replica)
+            self.assertTrue(fromReplica(registry.resource('primers', lambda config: db)))
+            self.assertEqual(len(db.replicareaders), 1)
+            os.utime(configfile, (1, 1))
+            registry.config()
+            self.assertEqual(db.replicareaders, {})
+            self.assertFalse(fromReplica(db))
+        finally:
+            shutil.rmtree(directory)
+
+class TestThermo(unittest.TestCase):
+
+    def test_cache(self):
+        import primer3
+        thermo = Thermodynamics(size=2)
+        self.assertEqual(thermo.tm('ACGTACGTACGTACGTACGT'), primer3.calcTm('ACGTACGTACGTACGTACGT'))
+        thermo.tm('ACGTACGTACGTACGTACGT')
+        thermo.heterodimerTm('ACGTACGTACGTACGTACGT', 'TTTTTTTTTTTTTTTTTTTT')
+        self.assertEqual((thermo.hits, thermo.misses, thermo.ratio()), (1, 2, 1/3.0))
+        # conditions are part of key and least recently used are evicted
+        thermo.configure(mv_conc=100)
+        thermo.tm('ACGTACGTACGTACGTACGT')
+        self.assertEqual((thermo.misses, len(thermo)), (3, 2))
+        self.assertRaises(ValueError, thermo.configure, temperature=37)
+        # persisted
+        cachefile = tempfile.mktemp(suffix='.cache')
+        try:
+            thermo.save(cachefile)
+            restored = Thermodynamics(size=10, mv_conc=100)
+            restored.load(cachefile)
+            restored.tm('ACGTACGTACGTACGTACGT')
+            self.assertEqual((restored.hits, len(restored)), (1, 2))
+        finally:
+            os.unlink(cachefile)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        worker, web = Metrics(), Metrics()
+        for m in [worker, web]:
+            m.inc('zippy_bowtie2_records_total', 10)
+            with m.timer('zippy_primer3_seconds', tier=1):
+                pass
+            m.hit('resource', True)
+        web.merge(json.loads(json.dumps(worker.snapshot())))  # as read from worker file
+        web.set('zippy_jobs', 3, status='queued')
+        lines = web.render().splitlines()
+        self.assertIn('# TYPE zippy_bowtie2_records_total counter', lines)
+        self.assertIn('zippy_bowtie2_records_total 20.0', lines)
+        self.assertIn('zippy_primer3_seconds_count{tier="1"} 2', lines)
+        self.assertIn('zippy_cache_requests_total{cache="resource",result="hit"} 2.0', lines)
+        self.assertIn('zippy_jobs{status="queued"} 3.0', lines)
+
+    def test_since(self):
+        daemon = Metrics()
+        daemon.inc('zippy_bowtie2_records_total', 10)
+        daemon.observe('zippy_primer3_seconds', 1.0)
+        start = daemon.snapshot()  # forwarded command starts
+        daemon.inc('zippy_bowtie2_records_total', 5)
+        daemon.set('zippy_jobs', 1)
+        lines = daemon.since(start).render().splitlines()
+        self.assertIn('zippy_bowtie2_records_total 5.0', lines)
+        self.assertIn('zippy_jobs 1.0', lines)
+        self.assertFalse([ l for l in lines if l.startswith('zippy_primer3_seconds') ])
+
+    def test_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            exited = Metrics()
+            exited.inc('zippy_export_total', 7)
+            process = subprocess.Popen(['true'])
+            process.wait()
+            exited.save(os.path.join(directory, '{}.json'.format(process.pid)))
+            metrics.inc('zippy_export_total')
+            # exited processes are retired, counters stay monotonic and this process is counted once
+            for i in range(2):
+                self.assertIn('zippy_export_total 8.0', exportMetrics(directory).splitlines())
+            self.assertEqual(sorted(os.listdir(directory)), sorted(['{}.json'.format(os.getpid()), 'retired.json', 'retired.lock']))
+        finally:
+            shutil.rmtree(directory)
+
+class TestDaemon(unittest.TestCase):
+
+    def test_forward(self):
+        socketpath = tempfile.mktemp(suffix='.sock')
+        def run(argv):
+            print 'cwd', os.getcwd()
+            print >> sys.stderr, ' '.join(argv)
+            sys.exit(3)
+        daemon = DesignDaemon(socketpath, run)
+        server = multiprocessing.Process(target=daemon.handle_request)  # own sys.stdout and sys.stderr
+        server.start()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            status = forward(socketpath, ['get', '1:100-200'], '/')
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            server.join()
+            daemon.server_close()
+            os.unlink(socketpath)
+        self.assertEqual(status, 3)
+        self.assertEqual(output, 'cwd /\n')
+        self.assertEqual(errors, 'get 1:100-200\n')
+        self.assertEqual(forward(socketpath, ['get'], '/'), None)  # not running
+
+class TestImports(unittest.TestCase):
+
+    def test_deferred(self):
+        # light subcommands (query, update, dump) must not load design, report or subcommand modules
+        deferred = ['pysam', 'primer3', 'reportlab', 'zippylib.jobs', 'zippylib.daemon', 'zippylib.annotation', 'zippylib.metrics']
+        code = '; '.join([
+            'import sys',
+            'import zippy',
+            'print ",".join([ m for m in {!r} if m in sys.modules ])'.format(deferred) ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([zippydir, os.environ.get('PYTHONPATH', '')]))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=tempfile.gettempdir()).splitlines()
+        self.assertEqual(output, [''])
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,16 +4,18 @@ import sys
 import os
 import re
 import json
+import time
 import bcrypt
 import hashlib
+import tempfile
 import subprocess
 from functools import wraps
-from flask import Flask, render_template, request, redirect, send_from_directory, session, flash, url_for
-from celery import Celery
+from flask import Flask, render_template, request, redirect, send_from_directory, session, flash, url_for, jsonify, Response
 from werkzeug.utils import secure_filename
 from . import app
-from .zippy import zippyBatchQuery, zippyPrimerQuery, updateLocation, searchByName, updatePrimerName, updatePrimerPairName, blacklistPair, readprimerlocations
-from .zippylib import ascii_encode_dict
+from .zippy import zippyJobQueue, batchKey, cachedBatchResult, updateLocation, searchByName, updatePrimerName, updatePrimerPairName, blacklistPair, readprimerlocations
+from .zippylib.registry import Registry
+from .zippylib.metrics import exportMetrics, saveSnapshot
 from .zippylib.primer import Location
 from .zippylib.database import PrimerDB
 
@@ -22,14 +24,50 @@ app.secret_key = 'Zippy is the best handpuppet out there'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DOWNLOAD_FOLDER'] = 'results'
 app.config['CONFIG_FILE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zippy.json')
-# read password (SHA1 hash, not the safest)
-with open(app.config['CONFIG_FILE']) as conf:
-    config = json.load(conf, object_hook=ascii_encode_dict)
-    app.config['PASSWORD'] = config['password']
+# configuration (reloaded on change) and shared resources
+registry = Registry(app.config['CONFIG_FILE'])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in app.config['ALLOWED_EXTENSIONS']
 
+def save_upload(uploadFile, filename, blocksize=2**20):
+    # writes uploaded file to content addressed path (<upload folder>/<SHA1>/<filename>), returns path and SHA1
+    sha1 = hashlib.sha1()
+    fd, temp = tempfile.mkstemp(prefix='.upload.', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            while True:
+                block = uploadFile.stream.read(blocksize)
+                if not block:
+                    break
+                sha1.update(block)
+                fh.write(block)
+        folder = os.path.join(app.config['UPLOAD_FOLDER'], sha1.hexdigest())
+        try:
+            os.mkdir(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+        target = os.path.join(folder, filename)
+        os.rename(temp, target)  # same content if already uploaded
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+    return target, sha1.hexdigest()
+
+def open_database(config):
+    # queries read from replica if configured (writes go to primary database)
+    replica = config['replica'] if 'replica' in config.keys() else {}
+    return PrimerDB(config['database'], dump=config['ampliconbed'], replica=replica.get('path'), \
+        **{ k: v for k,v in replica.items() if k in ['refresh','aftercommit','mmap','cachesize'] })
+
+def database():
+    return registry.resource('database', open_database)
+
+def job_queue():
+    return registry.resource('jobs', zippyJobQueue)
+
 def login_required(func):
     @wraps(func)
     def wrap(*args, **kwargs):
@@ -51,7 +89,8 @@ def index():
 def login():
     error = None
     if request.method == 'POST':
-        if bcrypt.hashpw(request.form['password'].rstrip().encode('utf-8'), app.config['PASSWORD']) == app.config['PASSWORD']:
+        password = registry.config()['password']  # SHA1 hash, not the safest
+        if bcrypt.hashpw(request.form['password'].rstrip().encode('utf-8'), password) == password:
             session['logged_in'] = True
             return redirect(url_for('index'))
         else:
@@ -97,25 +136,30 @@ def upload():
         filename = secure_filename(uploadFile.filename)
         print >> sys.stderr, "Uploaded: ", filename
 
-        # save file
-        uploadedFile = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        uploadFile.save(uploadedFile)
+        # save file (hashed while streaming to disk, stored by content)
+        uploadedFile, uploadHash = save_upload(uploadFile, filename)
         print >> sys.stderr, "file saved to %s" % uploadedFile
 
-        # open config file and database
-        with open(app.config['CONFIG_FILE']) as conf:
-            config = json.load(conf, object_hook=ascii_encode_dict)
-            db = PrimerDB(config['database'],dump=config['ampliconbed'])
+        # configuration
+        config = registry.config()
 
         # create output folder
-        downloadFolder = os.path.join(app.config['DOWNLOAD_FOLDER'], hashlib.sha1(open(uploadedFile).read()).hexdigest())
+        downloadFolder = os.path.join(app.config['DOWNLOAD_FOLDER'], uploadHash)
         subprocess.check_call(['mkdir', '-p', downloadFolder], shell=False)
 
-        # run Zippy to design primers
+        # return cached results (same upload, options, configuration and database version)
         shortName = os.path.splitext(filename)[0]
         downloadFile = os.path.join(downloadFolder, outfile) if outfile else os.path.join(downloadFolder, shortName)
-        arrayOfFiles, missedIntervalNames = zippyBatchQuery(config, uploadedFile, design, downloadFile, db, predesign, deep)
-        return render_template('file_uploaded.html', outputFiles=arrayOfFiles, missedIntervals=missedIntervalNames)
+        key = batchKey(config, uploadHash, downloadFile, design, predesign, deep)
+        result = cachedBatchResult(downloadFile, key, database())
+        if result:
+            print >> sys.stderr, "returning cached results for %s" % uploadedFile
+            return render_template('file_uploaded.html', **result)
+
+        # queue Zippy batch design (or attach to identical queued/running design)
+        jobid = job_queue().submit('batch', { 'targets': uploadedFile, 'upload': uploadHash, \
+            'design': design, 'outfile': downloadFile, 'predesign': predesign, 'deep': deep }, key=key)
+        return redirect(url_for('job_result', jobid=jobid))
     else:
         print("file for upload not supplied or file-type not allowed")
         return redirect('/no_file')
@@ -144,24 +188,91 @@ def adhocdesign():
             print >> sys.stderr, "file saved to %s" % target
         else:
             target = locus
-        # read config
-        with open(app.config['CONFIG_FILE']) as conf:
-            config = json.load(conf, object_hook=ascii_encode_dict)
-            db = PrimerDB(config['database'],dump=config['ampliconbed'])
-        # run Zippy
-        primerTable, resultList, missedIntervals = zippyPrimerQuery(config, target, design, None, db, store, deep, gap)
-
-        print >> sys.stderr, primerTable
-
-        # get missed and render template
-        missedIntervalNames = []
-        for interval in missedIntervals:
-            missedIntervalNames.append(interval.name)
-        return render_template('/adhoc_result.html', primerTable=primerTable, resultList=resultList, missedIntervals=missedIntervalNames)
+        # queue Zippy design
+        jobid = job_queue().submit('adhoc', { 'targets': target, 'design': design, \
+            'store': store, 'deep': deep, 'gap': gap })
+        return redirect(url_for('job_result', jobid=jobid))
     else:
         print >> sys.stderr, "no locus or file given"
         return render_template('/adhoc_result.html', primerTable=[], resultList=[], missedIntervals=[])
 
+@app.route('/job/<jobid>')
+def job_result(jobid):
+    job = job_queue().get(jobid)
+    if not job:
+        flash('Unknown job %s' % (jobid,), 'warning')
+        return redirect('/index')
+    elif job['status'] == 'done' and job['kind'] == 'batch':
+        return render_template('file_uploaded.html', **job['result'])
+    elif job['status'] == 'done' and job['kind'] == 'adhoc':
+        return render_template('/adhoc_result.html', **job['result'])
+    # queued, running or failed
+    return render_template('job_status.html', job=job)
+
+@app.route('/job/<jobid>/status')
+def job_status(jobid):
+    job = job_queue().get(jobid)
+    if not job:
+        return jsonify(error='unknown job'), 404
+    status = { k: job[k] for k in ['id','kind','status','progress','message','submitted','started','finished'] }
+    if job['status'] == 'done':
+        status['result'] = url_for('job_result', jobid=jobid)
+        if job['kind'] == 'batch':
+            status['files'] = [ '/file_uploaded/'+f for f in job['result']['outputFiles'] ]
+    return jsonify(**status)
+
+@app.route('/job/<jobid>/events')
+def job_events(jobid):
+    queue = job_queue()
+    if not queue.get(jobid):
+        return jsonify(error='unknown job'), 404
+    def stream():
+        # follow progress event file until job has finished (server-sent events)
+        position, idle = 0, 0.0
+        while True:
+            lines = []
+            if os.path.exists(queue.events(jobid)):
+                with open(queue.events(jobid)) as fh:
+                    fh.seek(position)
+                    chunk = fh.read()
+                chunk = chunk[:chunk.rfind('\n')+1]  # complete lines only
+                position += len(chunk)
+                lines = chunk.splitlines()
+            for line in lines:
+                yield 'data: {}\n\n'.format(line)
+                if 'status' in json.loads(line):
+                    return
+            if lines:
+                idle = 0.0
+            elif idle >= 15.0:
+                # keep connection alive and catch jobs that finished without events
+                job = queue.get(jobid)
+                if job['status'] in ['done','failed']:
+                    yield 'data: {}\n\n'.format(json.dumps({ 'status': job['status'] }))
+                    return
+                yield ': keepalive\n\n'
+                idle = 0.0
+            time.sleep(0.5)
+            idle += 0.5
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.after_request
+def save_metrics(response):
+    # snapshot of this process (any prefork process can serve /metrics)
+    try:
+        saveSnapshot(job_queue().metrics(), interval=5)
+    except (OSError, IOError):
+        print >> sys.stderr, 'WARNING: could not write metrics snapshot'
+    return response
+
+@app.route('/metrics')
+def metrics():
+    # metrics of webservice and job workers (Prometheus text format)
+    queue = job_queue()
+    depth = queue.counts()
+    gauges = [ ('zippy_jobs', {'status': s}, depth.get(s, 0)) for s in ['queued','running','done','failed'] ]
+    return Response(exportMetrics(queue.metrics(), gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/update_location/', methods=['POST'])
 def updatePrimerLocation():
     primername = request.form.get('primername')
@@ -174,10 +285,7 @@ def updatePrimerLocation():
     except:
         print >> sys.stderr, 'Please fill in all fields (PrimerName VesselNumber Well)'
         return render_template('location_updated.html', status=None)
-    # read config
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'],dump=config['ampliconbed'])
+    db = database()
     # run zippy and render
     updateStatus = updateLocation(primername, loc, db, force)
     return render_template('location_updated.html', status=updateStatus)
@@ -192,13 +300,11 @@ def update_pair_name(pairName):
     if newName == pairName:
         flash('New name is the same as current', 'warning')
         return render_template('update_pair.html', pairName=pairName)
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'],dump=config['ampliconbed'])
-        if updatePrimerPairName(pairName, newName, db):
-            flash('Pair "%s" renamed "%s"' % (pairName, newName), 'success')
-        else:
-            flash('Pair renaming failed', 'warning')
+    db = database()
+    if updatePrimerPairName(pairName, newName, db):
+        flash('Pair "%s" renamed "%s"' % (pairName, newName), 'success')
+    else:
+        flash('Pair renaming failed', 'warning')
     return render_template('update_pair.html', pairName=newName)
 
 @app.route('/select_primer_to_update/<primerName>/<primerLoc>')
@@ -219,9 +325,7 @@ def updateLocationFromTable(primerInfo):
         except:
             print >> sys.stderr, 'Please fill in all fields (PrimerName VesselNumber Well)'
             return render_template('location_updated.html', status=None)
-        with open(app.config['CONFIG_FILE']) as conf:
-            config = json.load(conf, object_hook=ascii_encode_dict)
-            db = PrimerDB(config['database'],dump=config['ampliconbed'])
+        db = database()
         # run zippy and render
         updateStatus = updateLocation(primerName, loc, db, force)
         if updateStatus[0] == 'occupied':
@@ -256,13 +360,11 @@ def update_name_of_primer(primerInfo):
     if newName == currentName:
         flash('Primer renaming failed - new name is the same as current', 'warning')
         return render_template('update_location_from_table.html', primerName=newName, primerLoc=primerLoc)
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'],dump=config['ampliconbed'])
-        if updatePrimerName(currentName, newName, db):
-            flash('Primer "%s" renamed "%s"' % (currentName, newName), 'success')
-        else:
-            flash('Primer renaming failed', 'warning')
+    db = database()
+    if updatePrimerName(currentName, newName, db):
+        flash('Primer "%s" renamed "%s"' % (currentName, newName), 'success')
+    else:
+        flash('Primer renaming failed', 'warning')
     return render_template('update_location_from_table.html', primerName=newName, primerLoc=primerLoc)
 
 @app.route('/specify_searchname/', methods=['POST'])
@@ -274,21 +376,17 @@ def searchName():
 @app.route('/search_by_name/')
 def search_by_name():
     searchName = session['searchName']
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'],dump=config['ampliconbed'])
-        searchResult = searchByName(searchName, db)
+    db = database()
+    searchResult = searchByName(searchName, db)
     return render_template('searchname_result.html', searchResult=searchResult, searchName=searchName)
 
 @app.route('/blacklist_pair/<pairname>', methods=['POST'])
 def blacklist_pair(pairname):
     print >> sys.stderr, 'This is the pairname: ' + pairname
-    with open(app.config['CONFIG_FILE']) as conf:
-        config = json.load(conf, object_hook=ascii_encode_dict)
-        db = PrimerDB(config['database'],dump=config['ampliconbed'])
-        blacklisted = blacklistPair(pairname, db)
-        for b in blacklisted:
-            flash('%s added to blacklist' % (b,), 'success')
+    db = database()
+    blacklisted = blacklistPair(pairname, db)
+    for b in blacklisted:
+        flash('%s added to blacklist' % (b,), 'success')
     return redirect('/search_by_name/')
 
 @app.route('/upload_batch_locations/', methods=['POST'])
@@ -302,16 +400,14 @@ def upload_samplesheet():
             saveloc = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             locationsheet.save(saveloc)
             updateList = readprimerlocations(saveloc)
-            with open(app.config['CONFIG_FILE']) as conf:
-                config = json.load(conf, object_hook=ascii_encode_dict)
-                db = PrimerDB(config['database'],dump=config['ampliconbed'])
-                for item in updateList:
-                    updateStatus = updateLocation(item[0], item[1], db, True) # Force is set to True, will force primers into any occupied locations
-                    if updateStatus[0] == 'occupied':
-                        flash('Location already occupied by %s' % (' and '.join(updateStatus[1])), 'warning')
-                    elif updateStatus[0] == 'success':
-                        flash('%s location sucessfully set to %s' % (item[0], str(item[1])), 'success')
-                    else:
-                        flash('%s location update to %s failed' % (item[0], str(item[1])), 'warning')
+            db = database()
+            for item in updateList:
+                updateStatus = updateLocation(item[0], item[1], db, True) # Force is set to True, will force primers into any occupied locations
+                if updateStatus[0] == 'occupied':
+                    flash('Location already occupied by %s' % (' and '.join(updateStatus[1])), 'warning')
+                elif updateStatus[0] == 'success':
+                    flash('%s location sucessfully set to %s' % (item[0], str(item[1])), 'success')
+                else:
+                    flash('%s location update to %s failed' % (item[0], str(item[1])), 'warning')
             print >> sys.stderr, 'Updated locations using :', updateList
     return redirect('/index')
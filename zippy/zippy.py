@@ -22,18 +22,20 @@ import json
 import tempfile
 import hashlib
 import csv
-from zippylib.files import VCF, BED, GenePred, Interval, Data, readTargets, readBatch
-from zippylib.primer import Genome, MultiFasta, Primer3, Primer, PrimerPair, Location, parsePrimerName
-from zippylib.reports import Test
+import time
+import heapq
+import itertools
+import multiprocessing
+from zippylib.files import VCF, BED, GenePred, Interval, Data, readTargets, iterTargets, readBatch, chunks
+from zippylib.primer import Genome, MultiFasta, Primer3, Primer, PrimerPair, Location, parsePrimerName, preloadResources, rankedPairs
 from zippylib.database import PrimerDB
 from zippylib.interval import IntervalList
-from zippylib import ConfigError, Progressbar, banner
-from zippylib.reports import Worksheet
+from zippylib.thermo import thermo
+from zippylib import ConfigError, Progressbar, banner, ascii_encode_dict
 from argparse import ArgumentParser
-from copy import deepcopy
-from collections import defaultdict, Counter
+from copy import deepcopy, copy
+from collections import defaultdict, Counter, OrderedDict
 from urllib import unquote
-import cPickle as pickle
 
 '''file MD5'''
 def fileMD5(fi, block_size=2**20):
@@ -134,7 +136,7 @@ def importPrimerPairs(inputfile,config,primer3=True):
         delete=False,tags=primertags, \
         tmThreshold=config['design']['mispriming']['minimaltm'], \
         endMatch=config['design']['mispriming']['identity3prime'])  # places in genome
-    # pair primers (by name or by primerset) MAKE COPIES!!!!
+    # pair primers (by name or by primerset) MAKE COPIES (share loci until changed)
     pairs = {}
     for p in primers:
         setnames = primersets[p.name] \
@@ -156,13 +158,13 @@ def importPrimerPairs(inputfile,config,primer3=True):
             reverse = p.targetposition.reverse if p.targetposition else parsePrimerName(p.name)[1] < 0
             try:
                 if reverse and pairs[setname][1] is None:
-                    pairs[setname][1] = deepcopy(p)
+                    pairs[setname][1] = copy(p)
                 else:
                     if pairs[setname][0] is None:
-                        pairs[setname][0] = deepcopy(p)
+                        pairs[setname][0] = copy(p)
                     else:
                         assert pairs[setname][1] is None
-                        pairs[setname][1] = deepcopy(p)
+                        pairs[setname][1] = copy(p)
             except:
                 print >> sys.stderr, "ERROR: Primer pair strand conflict?"
                 print >> sys.stderr, "PRIMER0", pairs[setname][0]
@@ -210,8 +212,7 @@ def importPrimerPairs(inputfile,config,primer3=True):
                         continue
                     else:  # add new loci
                         for i,loc in enumerate(newLoci):
-                            p[i].loci += loc
-                            p[i].loci = list(set(p[i].loci))  # remove redundancy
+                            p[i].loci = set(p[i].loci + tuple(loc))  # remove redundancy (stored as tuple shared with copies)
                     # store new amplicon
                     amplicons = p.amplicons(config['import']['ampliconsize'],autoreverse=True)
                     if amplicons:
@@ -228,17 +229,43 @@ def importPrimerPairs(inputfile,config,primer3=True):
                 validPairs.append(p)
     return validPairs
 
-'''get primers from intervals'''
+'''sequence pair hashing function'''
+def seqhash(x, y):
+    return hashlib.sha1(','.join([x,y])).hexdigest()
+
+'''Primer3 design of one target (top level function for process pools)'''
+def primer3Design(args):
+    genome, locus, flank, name, pars = args
+    start = time.time()
+    p3 = Primer3(genome, locus, flank)
+    p3.design(name, pars)
+    return p3.pairs, time.time()-start
+
+'''get primers from intervals (finds stored or designs primer pairs and selects best for each interval)'''
 def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible=False):
-    ivpairs = defaultdict(list)  # found/designed primer pairs (from database or design)
+    ivpairs, compatible = findPrimers(intervals, db, design, config, deep, rename, compatible)
+    return selectPrimers(intervals, ivpairs, config, compatible)
+
+'''returns blacklisted primer pair ids (from database and blacklist cache)'''
+def readBlacklist(db, config):
+    import cPickle as pickle
     blacklist = db.blacklist() if db else []
     try:
         blacklist += pickle.load(open(config['blacklistcache'],'rb'))
     except:
         print >> sys.stderr, 'Could not read blacklist cache, check permissions'
         print >> sys.stderr, os.getcwd(), config['blacklistcache']
+    return blacklist
+
+'''returns candidate primer pairs for intervals (from database and design) and compatibility list'''
+def findPrimers(intervals, db, design, config, deep=True, rename=None, compatible=False, blacklist=None):
+    import cPickle as pickle
+    ivpairs = defaultdict(list)  # found/designed primer pairs (from database or design)
+    if blacklist is None:
+        blacklist = readBlacklist(db, config)
+    knownBlacklisted = len(blacklist)
     maxTier = len(config['design']['primer3']) if deep or compatible else 1  # only search first tier unless deep or compatibility mode
-    seqhash = lambda x,y: hashlib.sha1(','.join([x,y])).hexdigest()  # sequence pair hashing function
+    processes = config['design']['processes'] if 'processes' in config['design'].keys() else 1
     # build gap primers and hash valid pairs
     if compatible:
         assert len(intervals)==2
@@ -249,7 +276,7 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
         # design primers
         progress = Progressbar(maxTier,'Building compatibility list')
         for tier in range(maxTier):
-            sys.stderr.write('\r'+progress.show(tier))
+            progress.update(tier)
             # get sequence
             maxFlank = max([ max(x) for x in config['design']['primer3'][tier]['PRIMER_PRODUCT_SIZE_RANGE'] ])
             p3 = Primer3(config['design']['genome'], gap.locus(), maxFlank)
@@ -263,13 +290,13 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
             if p3.pairs:
                 for p in p3.pairs:
                     compatible.add(seqhash(p[0].seq, p[1].seq))
-        sys.stderr.write('\r'+progress.show(maxTier)+'\n')
+        progress.update(maxTier)
 
     # primer searching in database by default
     if db:
         progress = Progressbar(len(intervals),'Querying database')
         for i, iv in enumerate(intervals):
-            sys.stderr.write('\r'+progress.show(i))
+            progress.update(i)
             ivpairs[iv] = []
             primerpairs = db.query(iv)
             if primerpairs:
@@ -277,12 +304,13 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
                     ivpairs[iv].append(pair)
                 # remove excess primers (ordered by midpointdistance)
                 ivpairs[iv] = ivpairs[iv][:config['report']['pairs']]
-        sys.stderr.write('\r'+progress.show(len(intervals))+'\n')
+        progress.update(len(intervals))
         # print query count
         print >> sys.stderr, 'Found primers for {:d} out of {:d} intervals in database'.format(len([ iv for iv in intervals if ivpairs[iv]]), len(intervals))
 
     # designing
     if design:
+        from zippylib.metrics import metrics
         for tier in range(maxTier):
             # get intervals which do not satisfy minimum amplicon number
             insufficentAmpliconIntervals = [ iv for iv in intervals if config['report']['pairs']>len(ivpairs[iv]) ]
@@ -291,20 +319,30 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
             print >> sys.stderr, "Round #{} ({} intervals)".format(tier+1, len(insufficentAmpliconIntervals))
             # Primer3 design
             designedPairs = {}
-            progress = Progressbar(len(insufficentAmpliconIntervals),'Designing primers')
-            for i,iv in enumerate(insufficentAmpliconIntervals):
-                sys.stderr.write('\r'+progress.show(i))
-                try:
-                    designIntervalOversize = max([ max(x) for x in config['design']['primer3'][tier]['PRIMER_PRODUCT_SIZE_RANGE'] ])
-                except:
-                    print >> sys.stderr, "WARNING: could not determine maximum amplicon size, default setting applied"
-                    designIntervalOversize = 2000
-                p3 = Primer3(config['design']['genome'], iv.locus(), designIntervalOversize)
-                p3.design(iv.name, config['design']['primer3'][tier])
-                if p3.pairs:
-                    designedPairs[iv] = p3.pairs
-                #else: print >> sys.stderr, '\n' +'\n'.join(p3.explain)
-            sys.stderr.write('\r'+progress.show(len(insufficentAmpliconIntervals))+'\n')
+            try:
+                designIntervalOversize = max([ max(x) for x in config['design']['primer3'][tier]['PRIMER_PRODUCT_SIZE_RANGE'] ])
+            except:
+                print >> sys.stderr, "WARNING: could not determine maximum amplicon size, default setting applied"
+                designIntervalOversize = 2000
+            designTargets = [ (config['design']['genome'], iv.locus(), designIntervalOversize, iv.name, \
+                config['design']['primer3'][tier]) for iv in insufficentAmpliconIntervals ]
+            # parallel design (not from daemonic job workers which cannot have child processes)
+            pool = multiprocessing.Pool(processes) if processes > 1 and len(designTargets) > 1 and \
+                not multiprocessing.current_process().daemon else None
+            try:
+                progress = Progressbar(len(insufficentAmpliconIntervals),'Designing primers')
+                designs = pool.imap(primer3Design, designTargets) if pool else itertools.imap(primer3Design, designTargets)
+                for i, (iv, (p3pairs, seconds)) in enumerate(itertools.izip(insufficentAmpliconIntervals, designs)):
+                    progress.update(i)
+                    metrics.observe('zippy_primer3_seconds', seconds, tier=tier+1)
+                    metrics.inc('zippy_primer3_pairs_total', len(p3pairs), tier=tier+1)
+                    if p3pairs:
+                        designedPairs[iv] = p3pairs
+                progress.update(len(insufficentAmpliconIntervals))
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
             if designedPairs:
                 ## import designed primer pairs (place on genome and get amplicons)
                 with tempfile.NamedTemporaryFile(suffix='.fa',prefix="primers_",delete=False) as fh:
@@ -331,10 +369,10 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
                 ## add SNPinfo (SNPcheck) for main target
                 progress = Progressbar(len(pairs),'SNPcheck')
                 for i, pair in enumerate(pairs):
-                    sys.stderr.write('\r'+progress.show(i))
+                    progress.update(i)
                     for p in pair:
                         p.snpCheckPrimer(config['snpcheck']['common'])
-                sys.stderr.write('\r'+progress.show(len(pairs))+'\n')
+                progress.update(len(pairs))
 
                 # assign designed primer pairs to intervals (remove ranks and tag)
                 intervalindex = { iv.name: iv for iv in intervals }
@@ -364,12 +402,13 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
                     if len(v)==0:
                         print >> sys.stderr, 'WARNING: Target {} failed on designlimits'.format(k)
 
-    # save blacklist cache
-    try:
-        pickle.dump(list(set(blacklist)),open(config['blacklistcache'],'wb'))
-    except:
-        print >> sys.stderr, 'Could not write to blacklist cache, check permissions'
-        print >> sys.stderr, os.getcwd(), config['blacklistcache']
+    # save blacklist cache (if designs were blacklisted)
+    if len(blacklist) > knownBlacklisted:
+        try:
+            pickle.dump(list(set(blacklist)),open(config['blacklistcache'],'wb'))
+        except:
+            print >> sys.stderr, 'Could not write to blacklist cache, check permissions'
+            print >> sys.stderr, os.getcwd(), config['blacklistcache']
 
     # print primer pair count and build database table
     failure = [ iv.name for iv,p in ivpairs.items() if config['report']['pairs']>len(p) ]
@@ -378,7 +417,38 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
     print >> sys.stderr, '-'*41
     for iv,p in sorted(ivpairs.items(),key=lambda x:x[0].name):
         print >> sys.stderr, '{:<20} {:9} {:<10}'.format(unquote(iv.name), len(p), "FAIL" if len(p)<config['report']['pairs'] else "OK")
+    return ivpairs, compatible
+
+'''returns candidate primer pairs for intervals (nearby intervals without stored primers are designed as one amplicon)'''
+def findClusteredPrimers(intervals, db, design, config, deep=True, rename=None):
+    distance = config['design']['clusterdistance'] if 'clusterdistance' in config['design'].keys() else 0
+    blacklist = readBlacklist(db, config)  # shared by all designs (extended by design limit failures)
+    ivpairs = findPrimers(intervals, db, False, config, deep, rename, blacklist=blacklist)[0]
+    unresolved = IntervalList([ iv for iv in intervals if config['report']['pairs']>len(ivpairs[iv]) ], source=intervals.source)
+    if not design or not unresolved:
+        return ivpairs
+    if distance:
+        # cluster span limited by largest product of first tier (minus primers)
+        tier = config['design']['primer3'][0]
+        maxLength = max([ max(x) for x in tier['PRIMER_PRODUCT_SIZE_RANGE'] ]) - \
+            2 * (tier['PRIMER_MAX_SIZE'] if 'PRIMER_MAX_SIZE' in tier.keys() else 0)
+        clusters = IntervalList([ c for c in unresolved.cluster(distance, maxLength) if len(c.subintervals) > 1 ])
+        if clusters:
+            print >> sys.stderr, "Designing {} clusters of {} nearby variants".format(len(clusters), sum([ len(c.subintervals) for c in clusters ]))
+            clusterpairs = findPrimers(clusters, db, design, config, deep, rename, blacklist=blacklist)[0]
+            for c in clusters:
+                for iv in c.subintervals:
+                    ivpairs[iv] += clusterpairs[c]
+            unresolved = IntervalList([ iv for iv in unresolved if config['report']['pairs']>len(ivpairs[iv]) ], source=intervals.source)
+    # design remaining intervals individually (database already queried)
+    if unresolved:
+        designedpairs = findPrimers(unresolved, None, design, config, deep, rename, blacklist=blacklist)[0]
+        for iv in unresolved:
+            ivpairs[iv] += designedpairs[iv]
+    return ivpairs
 
+'''selects best primer pairs of each interval (returns primer table, primer pairs with covered intervals and missed intervals)'''
+def selectPrimers(intervals, ivpairs, config, compatible=False, logged=None):
     # select primer pairs
     primerTable = []  # primer table (text)
     primerVariants = defaultdict(list)  # primerpair -> intervalnames/variants dict
@@ -386,20 +456,25 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
     print >> sys.stderr, '========'
     if compatible:
         # make pairs and exclude all pairings not in compatibility list score by geometric mean of 1based rank
-        rankedPairs = []
-        for l, left in enumerate(sorted(ivpairs[intervals[0]])):
-            for r, rite in enumerate(sorted(ivpairs[intervals[1]])):
+        rites = sorted(ivpairs[intervals[1]], key=lambda x: x.rankkey())
+        best = None
+        for l, left in enumerate(rankedPairs(ivpairs[intervals[0]])):
+            if best and (l+1) ** (1.0/2) > best[0]:
+                break  # no pairing of lower ranked left pairs scores better
+            for r, rite in enumerate(rites):
                 if seqhash(left[0].seq, rite[1].seq) in compatible:
-                    rankedPairs.append((((l+1)*(r+1)) ** (1.0/2), max(l, r), left, rite))
-        if rankedPairs:
-            rankedPairs.sort()  # sort ranked paired primerpairs
-            primerTable.append([unquote(intervals[0].name)] + str(rankedPairs[0][2]).split('\t'))
-            primerTable.append([unquote(intervals[1].name)] + str(rankedPairs[0][3]).split('\t'))
-            primerVariants[rankedPairs[0][2]].append(intervals[0])
-            primerVariants[rankedPairs[0][3]].append(intervals[1])
+                    ranked = (((l+1)*(r+1)) ** (1.0/2), max(l, r), left, rite)
+                    if best is None or ranked < best:
+                        best = ranked
+                    break  # lower ranked right pairs score worse
+        if best:
+            primerTable.append([unquote(intervals[0].name)] + str(best[2]).split('\t'))
+            primerTable.append([unquote(intervals[1].name)] + str(best[3]).split('\t'))
+            primerVariants[best[2]].append(intervals[0])
+            primerVariants[best[3]].append(intervals[1])
             # add gap interval
             gapInterval = Interval(intervals[0].chrom, intervals[0].chromStart, intervals[1].chromEnd)
-            gapPrimerPair = PrimerPair([rankedPairs[0][2][0], rankedPairs[0][3][1]], name='gap_'+gapInterval.name )
+            gapPrimerPair = PrimerPair([best[2][0], best[3][1]], name='gap_'+gapInterval.name )
             primerTable.append([unquote(gapInterval.name)] + str(gapPrimerPair).split('\t'))
         else:
             missedIntervals = intervals
@@ -409,12 +484,12 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
             print "IV", unquote(iv.name)
             if not ivpairs[iv]:
                 missedIntervals.append(iv)
-            for i, p in enumerate(sorted(ivpairs[iv])):
-                if i == config['report']['pairs']:
-                    break  # only report number of primer pairs requested
+            for p in heapq.nsmallest(config['report']['pairs'], ivpairs[iv], key=lambda x: x.rankkey()):  # only report number of primer pairs requested
                 # log primer design (0 if from database)
-                if p.designrank() >= 0:
+                if p.designrank() >= 0 and (logged is None or p.uniqueid() not in logged):
                     p.log(config['logfile'])
+                    if logged is not None:
+                        logged.add(p.uniqueid())
                 # save result (with interval names)
                 primerVariants[p].append(iv)
                 # save to primer table
@@ -429,9 +504,9 @@ def getPrimers(intervals, db, design, config, deep=True, rename=None, compatible
 # ==============================================================================
 
 # query database / design primer for VCF,BED,GenePred or interval
-def zippyPrimerQuery(config, targets, design=True, outfile=None, db=None, store=False, deep=True, gap=None):
-    intervals = readTargets(targets, config['tiling'])  # get intervals from file or commandline
+def zippyPrimerQuery(config, targets, design=True, outfile=None, db=None, store=False, deep=True, gap=None, region=None):
     if gap:  # gap PCR primers
+        intervals = readTargets(targets, config['tiling'], region)  # get intervals from file or commandline
         try:
             assert len(intervals)==1
             intervals += readTargets(gap, config['tiling'])  # get interval of second breakpoint
@@ -440,22 +515,68 @@ def zippyPrimerQuery(config, targets, design=True, outfile=None, db=None, store=
             print >> sys.stderr, "ERROR: gap-PCR primers can only be designed for a single pair of breakpoint intervals on the same chromosome!"
         except:
             raise
-    primerTable, resultList, missedIntervals = getPrimers(intervals,db,design,config,deep,compatible=True if gap else False)
-    ## print primerTable
-    if outfile:
-        with open(outfile,'w') as fh:
-            print >> fh, '\n'.join([ '\t'.join(map(str,l)) for l in primerTable ])
-    else:
-        print >> sys.stdout, '\n'.join([ '\t'.join(map(str,l)) for l in primerTable ])
-    ## print and store primer pairs
-    # if db:
+        targetChunks = [ intervals ]
+    else:  # stream targets in chunks
+        chunksize = config['design']['chunksize'] if 'chunksize' in config['design'].keys() else 1000
+        targetChunks = chunks(iterTargets(targets, config['tiling'], region), chunksize)
+    primerTable, resultList, missedIntervals = [], [], []
+    selected = set()
+    fh = open(outfile,'w') if outfile else sys.stdout
+    try:
+        for intervals in targetChunks:
+            chunkTable, chunkResults, chunkMissed = getPrimers(intervals,db,design,config,deep,compatible=True if gap else False)
+            ## print primerTable
+            if chunkTable:
+                print >> fh, '\n'.join([ '\t'.join(map(str,l)) for l in chunkTable ])
+                fh.flush()
+            ## store primer pairs
+            if store and db and design:
+                db.addPair(*chunkResults)  # store pairs in database (assume they are correctly designed as mispriming is ignored and capped at 1000)
+            primerTable += chunkTable
+            resultList += [ p for p in chunkResults if p not in selected ]  # pair can be selected in several chunks
+            selected.update(chunkResults)
+            missedIntervals += chunkMissed
+    finally:
+        if outfile:
+            fh.close()
     if store and db and design:
-        db.addPair(*resultList)  # store pairs in database (assume they are correctly designed as mispriming is ignored and capped at 1000)
         print >> sys.stderr, "Primer designs stored in database"
     return primerTable, resultList, missedIntervals
 
+# get/design primers once for variants shared by samples and select for each sample (primer table, sample primer pairs, missed intervals)
+def batchPrimers(sampleVariants, db, design, config, deep=True):
+    targets = OrderedDict()  # locus -> design target
+    for sample, intervals in sorted(sampleVariants.items(),key=lambda x: x[0]):
+        for iv in intervals:
+            targets.setdefault(iv.locus(), iv)
+    print >> sys.stderr, "Getting primers for {} variants ({} unique) in {} samples".format(\
+        sum(map(len,sampleVariants.values())), len(targets), len(sampleVariants))
+    ivpairs = findClusteredPrimers(IntervalList(targets.values(),source='SNPpy'),db,design,config,deep,rename=shortHumanReadable)
+    # select primers for each sample
+    primerTableConcat = []
+    allMissedIntervals = {}
+    samplePairs = []  # (sample, primer pair) tests to run
+    selectedPairs = {}  # uniqueid -> primer pair
+    logged = set()  # designed pairs written to log
+    for sample, intervals in sorted(sampleVariants.items(),key=lambda x: x[0]):
+        # own copies of primer pairs (covered variants differ between samples)
+        sampleIvpairs = { iv: [ copy(p) for p in ivpairs[targets[iv.locus()]] ] for iv in intervals if targets[iv.locus()] in ivpairs }
+        primerTable, resultList, missedIntervals = selectPrimers(intervals,sampleIvpairs,config,logged=logged)
+        if missedIntervals:
+            allMissedIntervals[sample] = missedIntervals
+        # store result list
+        primerTableConcat += [ [sample]+l for l in primerTable ]
+        selectedPairs.update([ (p.uniqueid(), p) for p in resultList ])
+        samplePairs += [ (sample, primerpair) for primerpair in resultList ]
+    # store primers
+    if db:
+        db.addPair(*selectedPairs.values())  # store pairs in database (assume they are correctly designed as mispriming is ignored and capped at 1000)
+    return primerTableConcat, samplePairs, allMissedIntervals
+
 # batch query primer database and create confirmation worksheet
 def zippyBatchQuery(config, targets, design=True, outfile=None, db=None, predesign=False, deep=True):
+    from zippylib.reports import Test, Worksheet  # reportlab
+    from zippylib.annotation import openAnnotation
     print >> sys.stderr, 'Reading batch file {}...'.format(targets)
     sampleVariants, genes = readBatch(targets, config['tiling'])
     print >> sys.stderr, '\n'.join([ '{:<20} {:>2d}'.format(sample,len(variants)) \
@@ -463,44 +584,17 @@ def zippyBatchQuery(config, targets, design=True, outfile=None, db=None, predesi
     # predesign
     if predesign and genes and db:
         print >> sys.stderr, "Designing primers for {} genes..".format(str(len(genes)))
-        # Create interval list
-        intervals = IntervalList([],source='GenePred')
-        # parse gene intervals from refGene and retain those intersecting variants
-        with open(config['design']['annotation']) as fh:
-            for iv in GenePred(fh,getgenes=genes,**config['tiling']):  # get intervals from file or commandline
-                found = False
-                for sl in sampleVariants.values():
-                    for iv2 in sl:
-                        if iv.overlap(iv2):
-                            intervals.append(iv)
-                            found = True
-                        if found: break
-                    if found: break
+        # parse gene intervals from refGene (compiled if available) and retain those intersecting variants
+        with openAnnotation(config['design']['annotation']) as fh:
+            intervals = GenePred(fh,getgenes=genes,**config['tiling']).intersect(\
+                [ iv for variants in sampleVariants.values() for iv in variants ])
         # predesign and store
         primerTable, resultList, missedIntervals = getPrimers(intervals,db,predesign,config,deep)
         if db:
             db.addPair(*resultList)  # store pairs in database (assume they are correctly designed as mispriming is ignored and capped at 1000)
-    # for each sample design
-    primerTableConcat = []
-    allMissedIntervals = {}
-    missedIntervalNames = []
-    tests = []  # tests to run
-    for sample, intervals in sorted(sampleVariants.items(),key=lambda x: x[0]):
-        print >> sys.stderr, "Getting primers for {} variants in sample {}".format(len(intervals),sample)
-        # get/design primers
-        #print >> sys.stderr, intervals
-        primerTable, resultList, missedIntervals = getPrimers(intervals,db,design,config,deep,rename=shortHumanReadable)
-        if missedIntervals:
-            allMissedIntervals[sample] = missedIntervals
-            missedIntervalNames += [ i.name for i in missedIntervals ]
-        # store result list
-        primerTableConcat += [ [sample]+l for l in primerTable ]
-        # store primers
-        if db:
-            db.addPair(*resultList)  # store pairs in database (assume they are correctly designed as mispriming is ignored and capped at 1000)
-        # Build Tests
-        for primerpair in resultList:
-            tests.append(Test(primerpair,sample))
+    primerTableConcat, samplePairs, allMissedIntervals = batchPrimers(sampleVariants, db, design, config, deep)
+    missedIntervalNames = [ i.name for missedIntervals in allMissedIntervals.values() for i in missedIntervals ]
+    tests = [ Test(primerpair,sample) for sample, primerpair in samplePairs ]  # tests to run
     ## print primerTable
     writtenFiles = []
     if not outfile:
@@ -623,15 +717,79 @@ def readprimerlocations(locationfile):
                     raise Exception('InputFormatError')
     return updateList
 
+# fingerprint of design relevant configuration
+def configFingerprint(config):
+    relevant = { k: v for k,v in config.items() if k in ['tiling','design','import','snpcheck','designlimits','report','ordersheet'] }
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True)).hexdigest()
+
+# content key of batch design (upload, options and configuration)
+def batchKey(config, uploadhash, outfile, design, predesign, deep):
+    return hashlib.sha1(json.dumps([uploadhash, outfile, design, predesign, deep, configFingerprint(config)])).hexdigest()
+
+# cached batch result (if written with same key and primary database unchanged since)
+def cachedBatchResult(outfile, key, db):
+    from zippylib.metrics import metrics
+    try:
+        with open(outfile+'.manifest.json') as fh:
+            manifest = json.load(fh, object_hook=ascii_encode_dict)
+    except (IOError, ValueError):
+        metrics.hit('batch', False)
+        return None
+    if manifest['key'] != key or manifest['version'] != db.version(primary=True) or \
+        not all([ os.path.exists(f) for f in manifest['outputFiles'] ]):
+        metrics.hit('batch', False)
+        return None
+    metrics.hit('batch', True)
+    return { 'outputFiles': manifest['outputFiles'], 'missedIntervals': manifest['missedIntervals'] }
+
+# write batch result manifest
+def writeBatchManifest(outfile, key, db, result):
+    with open(outfile+'.manifest.json','w') as fh:
+        json.dump(dict(result, key=key, version=db.version(primary=True)), fh)
+
+# open job queue of webservice
+def zippyJobQueue(config):
+    from zippylib.jobs import JobQueue
+    jobconfig = config['jobs'] if 'jobs' in config.keys() else {}
+    return JobQueue(jobconfig['database'] if 'database' in jobconfig.keys() else \
+        os.path.join(os.path.dirname(config['database']), 'jobs.sqlite'))
+
+# run queued webservice jobs (batch and adhoc design)
+def zippyWorker(config, workers=None):
+    from zippylib.jobs import workerPool
+    jobconfig = config['jobs'] if 'jobs' in config.keys() else {}
+    def batch(spec):
+        db = PrimerDB(config['database'],dump=config['ampliconbed'])
+        key = batchKey(config, spec['upload'], spec['outfile'], spec['design'], spec['predesign'], spec['deep'])
+        result = cachedBatchResult(spec['outfile'], key, db)  # finished by previous job
+        if not result:
+            outputFiles, missedIntervals = zippyBatchQuery(config, spec['targets'], spec['design'], \
+                spec['outfile'], db, spec['predesign'], spec['deep'])
+            result = { 'outputFiles': outputFiles, 'missedIntervals': missedIntervals }
+            writeBatchManifest(spec['outfile'], key, db, result)
+        return result
+    def adhoc(spec):
+        db = PrimerDB(config['database'],dump=config['ampliconbed'])
+        primerTable, resultList, missedIntervals = zippyPrimerQuery(config, spec['targets'], spec['design'], \
+            None, db, spec['store'], spec['deep'], spec['gap'])
+        return { 'primerTable': primerTable, 'resultList': resultList, 'missedIntervals': [ i.name for i in missedIntervals ] }
+    workers = workers if workers else jobconfig['workers'] if 'workers' in jobconfig.keys() else 2
+    print >> sys.stderr, 'Starting {} workers for {}'.format(workers, zippyJobQueue(config))
+    workerPool(zippyJobQueue(config), {'batch': batch, 'adhoc': adhoc}, workers, \
+        jobconfig['poll'] if 'poll' in jobconfig.keys() else 1.0)
+
 # ==============================================================================
 # === CLI ======================================================================
 # ==============================================================================
-def main():
+# socket of design daemon
+def daemonSocket(config):
+    daemonconfig = config['daemon'] if 'daemon' in config.keys() else {}
+    return os.path.expanduser(daemonconfig['socket'] if 'socket' in daemonconfig.keys() else '~/.zippy.sock')
+
+def main(argv=None, daemon=True):
     from zippylib import ascii_encode_dict
     from zippylib import banner
 
-    print >> sys.stderr, banner(__version__)
-
     parser = ArgumentParser(prog="zippy.py", description= 'Zippy - Primer design and database')
     parser.add_argument('--version', action='version', version='%(prog)s '+__version__+'('+__status__+')',\
         help="Displays version")
@@ -640,6 +798,10 @@ def main():
     global_group = parser.add_argument_group('Global options')
     global_group.add_argument("-c", dest="config", default='zippy.json',metavar="JSON_FILE", \
         help="configuration file [zippy.json]")
+    global_group.add_argument("--metrics-out", dest="metrics", default=None, metavar="FILE", \
+        help="write runtime metrics (Prometheus text format) on exit")
+    global_group.add_argument("--local", dest="daemon", default=daemon, action="store_false", \
+        help="run in this process even if design daemon is running")
 
     # run modes
     subparsers = parser.add_subparsers(help='Help for subcommand')
@@ -656,6 +818,8 @@ def main():
         help="File with intervals of interest or CHR:START-END (mandatory for gap-PCR)")
     parser_retrieve.add_argument("--design", dest="design", default=False, action="store_true", \
         help="Design primers if not in database")
+    parser_retrieve.add_argument("--region", dest="region", default=None, metavar="CHR:START-END", \
+        help="Restrict targets to region (bgzip compressed and tabix indexed target file)")
     parser_retrieve.add_argument("--gap", dest="gap", default=None, metavar="CHR:START-END", \
         help="Second break point for gap-PCR")
     parser_retrieve.add_argument("--nodeep", dest="deep", default=True, action='store_false', \
@@ -696,6 +860,8 @@ def main():
         help="Force Location update (resets existing)")
     parser_update.add_argument('-b', dest="blacklist", type=str, \
         help="Blacklist primer")
+    parser_update.add_argument("--merge", dest="merge", default=False, action='store_true', \
+        help="Merge redundant primers (same sequence and tag) into canonical records")
     parser_update.set_defaults(which='update')
 
     ## dump specific datasets from database
@@ -714,11 +880,55 @@ def main():
         help="Output file name")
     parser_dump.set_defaults(which='dump')
 
-    options = parser.parse_args()
+    ## database snapshot
+    parser_snapshot = subparsers.add_parser('snapshot', help='Write compacted read-only copy of database')
+    parser_snapshot.add_argument("--outfile", dest="outfile", default='', type=str, \
+        help="Snapshot file name (default from configuration)")
+    parser_snapshot.set_defaults(which='snapshot')
+
+    ## job worker pool
+    parser_worker = subparsers.add_parser('worker', help='Run queued webservice jobs')
+    parser_worker.add_argument("--workers", dest="workers", default=None, type=int, \
+        help="Number of worker processes (default from configuration)")
+    parser_worker.set_defaults(which='worker')
+
+    ## annotation store
+    parser_annotation = subparsers.add_parser('annotation', help='Compile refGene annotation for fast gene lookups')
+    parser_annotation.set_defaults(which='annotation')
+
+    ## design daemon
+    parser_serve = subparsers.add_parser('serve', help='Run design daemon (keeps genome and indexes open for CLI commands)')
+    parser_serve.add_argument("--socket", dest="socket", default=None, type=str, \
+        help="Unix socket (default from configuration)")
+    parser_serve.set_defaults(which='serve')
+
+    options = parser.parse_args(argv)
+    if options.metrics:
+        from zippylib.metrics import metrics
+        metricsStart = metrics.snapshot()  # metrics of this command only (daemon runs many)
 
-    # read config and open database
+    # read config
     with open(options.config) as conf:
         config = json.load(conf, object_hook=ascii_encode_dict)
+
+    # forward to design daemon (if running)
+    if options.daemon and options.which not in ['serve','worker']:
+        from zippylib.daemon import forward
+        status = forward(daemonSocket(config), sys.argv[1:] if argv is None else argv, os.getcwd())
+        if status is not None:
+            sys.exit(status)
+
+    print >> sys.stderr, banner(__version__)
+
+    # thermodynamics cache (kept warm by daemon between commands)
+    thermoconfig = config['thermo'] if 'thermo' in config.keys() else {}
+    thermo.configure(thermoconfig['cachesize'] if 'cachesize' in thermoconfig.keys() else None, \
+        **(thermoconfig['conditions'] if 'conditions' in thermoconfig.keys() else {}))
+    if 'cachefile' in thermoconfig.keys():
+        thermo.load(thermoconfig['cachefile'])
+    thermoMisses = thermo.misses
+
+    # open database
     here = config['primerbed'] if 'primerbed' in config.keys() and config['primerbed'] else None
     db = PrimerDB(config['database'],dump=here)
 
@@ -778,12 +988,41 @@ def main():
         if options.blacklist:
             print >> sys.stderr, 'BLACKLISTED PAIRS: {}'.format(','.join(db.blacklist(options.blacklist)))
             print >> sys.stderr, 'REMOVED ORPHANS:   {}'.format(','.join(db.removeOrphans()))
+        if options.merge:
+            merged = db.mergeRedundantPrimers()
+            print >> sys.stderr, 'MERGED PRIMERS:    {}'.format(','.join([ '{}>{}'.format(*m) for m in merged ]))
     elif options.which=='get':  # get primers for targets (BED/VCF or interval)
-        zippyPrimerQuery(config, options.targets, options.design, options.outfile, db, options.store, options.deep, options.gap)
+        zippyPrimerQuery(config, options.targets, options.design, options.outfile, db, options.store, options.deep, options.gap, options.region)
     elif options.which=='batch':
         zippyBatchQuery(config, options.targets, options.design, options.outfile, db, options.predesign, options.deep)
     elif options.which=='query':
         searchByName(options.subString, db)
+    elif options.which=='snapshot':
+        snapshotconfig = config['snapshot'] if 'snapshot' in config.keys() else {}
+        target = options.outfile if options.outfile else snapshotconfig['path'] if 'path' in snapshotconfig.keys() else config['database']+'.snapshot'
+        db.snapshot(target)
+        print >> sys.stderr, 'Database snapshot written to {}'.format(target)
+    elif options.which=='annotation':
+        from zippylib.annotation import compileAnnotation
+        target = config['design']['annotation']+'.sqlite'  # used by predesign if up to date
+        count = compileAnnotation(config['design']['annotation'], target)
+        print >> sys.stderr, 'Compiled {} genes to {}'.format(count, target)
+    elif options.which=='worker':
+        zippyWorker(config, options.workers)
+    elif options.which=='serve':
+        from zippylib.daemon import serve
+        preloadResources(config['design']['genome'], config['snpcheck']['common'])
+        serve(options.socket if options.socket else daemonSocket(config), lambda argv: main(argv, daemon=False))
+
+    # save new thermodynamics results
+    if 'cachefile' in thermoconfig.keys() and thermo.misses > thermoMisses:
+        try:
+            thermo.save(thermoconfig['cachefile'])
+        except (IOError, OSError):
+            print >> sys.stderr, 'Could not write to thermodynamics cache, check permissions'
+    thermo.report()
+    if options.metrics:
+        metrics.since(metricsStart).write(options.metrics)
 
 if __name__=="__main__":
     main()
@@ -8,19 +8,33 @@ __maintainer__ = "David Brawand"
 __email__ = "dbrawand@nhs.net"
 __status__ = "Production"
 
-from .primer import Primer, PrimerPair
+import sys
 import time
 import os
 import subprocess
 
 '''version string'''
+# git references (written to REVISION on install, read from git otherwise)
+revisionFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'REVISION')
+revision = []
+
 # pipeline version string
 def githash(prefix=None):
+    if not revision:
+        revision.append(gitrevision())
+    return '-'.join(([ prefix ] if prefix else []) + revision[0])
+
+def gitrevision():
     taghash, headhash = {},{}
-    gitrevision = [ prefix ] if prefix else []
+    gitrevision = []
     head = None
     APP_ROOT = os.path.dirname(os.path.abspath(__file__))
-    for i, line in enumerate(subprocess.check_output(['git', 'show-ref', '--head', '--abbrev=7'],cwd=APP_ROOT).split('\n')):
+    if os.path.exists(revisionFile):
+        with open(revisionFile) as fh:
+            refs = fh.read()
+    else:
+        refs = subprocess.check_output(['git', 'show-ref', '--head', '--abbrev=7'],cwd=APP_ROOT)
+    for i, line in enumerate(refs.split('\n')):
         f = line.split()
         if len(f)==2:
             if f[1] == 'HEAD':
@@ -39,7 +53,7 @@ def githash(prefix=None):
         gitrevision.append(taghash[head])  # return tag name
     except KeyError:
         gitrevision.append(head)  # return hash of revision
-    return '-'.join(gitrevision)
+    return gitrevision
 
 
 '''static stuff'''
@@ -60,6 +74,7 @@ def banner(versionstring=''):
 
 '''recursive function to flatten arbitrarily nested containers (list,tuples)'''
 def flatten(container):
+    from .primer import PrimerPair
     # put in a list if it isn't
     if type(container) is not list and type(container) is not tuple and type(container) is not PrimerPair:
         yield container
@@ -90,18 +105,46 @@ class PlateError(Exception):
     def __str__(self):
         return "[!] PLATE ERROR \n\t", repr(self.value)
 
+'''progress event receivers (functions called with event dictionary)'''
+progressSinks = []
+
+def addProgressSink(sink):
+    progressSinks.append(sink)
+
+def removeProgressSink(sink):
+    progressSinks.remove(sink)
+
 '''simple progress bar with time estimation'''
 class Progressbar(object):
-    def __init__(self,total,name='',maxlen=50,char='|'):
+    def __init__(self,total,name='',maxlen=50,char='|',interval=0.5):
         self.start = time.time()
         self.total = total
         self.name = name
         self.maxlen = maxlen
         self.char = char
+        self.interval = interval  # minimum time between updates (seconds)
+        self.last = None  # time of last update
+        self.finished = False
+
+    def eta(self,i):
+        return int((self.total-i)*float(time.time()-self.start)/float(i)) if i and i/float(self.total)>0.02 else None
 
     def show(self,i):
         if i == 0:
             self.start = time.time()  # set new start time
-        eta = str(int((self.total-i)*float(time.time()-self.start)/float(i))) if i and i/float(self.total)>0.02 else '?'
+        eta = self.eta(i)
         return ("{name:} [{progress:<"+str(self.maxlen)+"}] {done:} (ETA {eta:>2}s)").format(\
-            name=self.name, progress=self.char*( int(self.maxlen*i/float(self.total)) if self.total != 0 else self.maxlen), done=str(i)+'/'+str(self.total), eta=eta)
+            name=self.name, progress=self.char*( int(self.maxlen*i/float(self.total)) if self.total != 0 else self.maxlen), done=str(i)+'/'+str(self.total), eta='?' if eta is None else str(eta))
+
+    def update(self,i):
+        '''writes progress bar and emits progress event (throttled, always on start and completion)'''
+        now = time.time()
+        final = i >= self.total
+        if self.finished or not (i == 0 or final or self.last is None or now-self.last >= self.interval):
+            return
+        self.last = now
+        self.finished = final
+        sys.stderr.write('\r'+self.show(i)+('\n' if final else ''))
+        event = { 'stage': self.name, 'done': i, 'total': self.total, 'eta': self.eta(i), 'time': now }
+        for sink in progressSinks:
+            sink(event)
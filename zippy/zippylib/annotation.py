@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+__doc__=="""Compiled gene annotation (refGene merged per gene and indexed in SQLite)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import os
+import sys
+import sqlite3
+from collections import defaultdict
+from .interval import Interval
+from .files import readGenePred
+from .metrics import metrics
+
+'''file size and modification time (identifies compiled annotation source)'''
+def sourceStat(filename):
+    st = os.stat(filename)
+    return (st.st_size, int(st.st_mtime))
+
+'''genes with flattened exons (metaexons) for coding and noncoding extents, looked up by gene name'''
+class AnnotationStore(object):
+    def __init__(self, sqlite):
+        self.sqlite = sqlite
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def source(self):
+        '''returns (size, mtime) of compiled refGene'''
+        db = sqlite3.connect(self.sqlite)
+        try:
+            row = db.execute('SELECT size, mtime FROM source').fetchone()
+            return tuple(row) if row else None
+        finally:
+            db.close()
+
+    def genes(self, getgenes=None, noncoding=False):
+        '''returns gene name -> genes (sorted by position, exons as subintervals)'''
+        genes = defaultdict(list)
+        db = sqlite3.connect(self.sqlite)
+        try:
+            with metrics.timer('zippy_annotation_lookup_seconds'):
+                rows = []
+                if getgenes:
+                    names = sorted(set(getgenes))
+                    for i in range(0, len(names), 500):  # below SQLite variable limit
+                        chunk = names[i:i+500]
+                        rows += db.execute('SELECT id, name, chrom, start, end, reverse FROM gene WHERE noncoding = ? AND name IN ({})'.format(\
+                            ','.join(['?']*len(chunk))), [int(noncoding)] + chunk).fetchall()
+                else:
+                    rows = db.execute('SELECT id, name, chrom, start, end, reverse FROM gene WHERE noncoding = ?', (int(noncoding),)).fetchall()
+                byid = {}
+                for geneid, name, chrom, start, end, reverse in sorted(rows, key=lambda x: x[0]):
+                    byid[geneid] = Interval(str(chrom), start, end, str(name), bool(reverse))
+                    genes[byid[geneid].name].append(byid[geneid])
+                ids = sorted(byid.keys())
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i+500]
+                    for geneid, start, end in db.execute('SELECT gene, start, end FROM exon WHERE gene IN ({}) ORDER BY gene, start, end'.format(\
+                        ','.join(['?']*len(chunk))), chunk):
+                        g = byid[geneid]
+                        g.subintervals.append(Interval(g.chrom, start, end, g.name, g.strand < 0))
+        finally:
+            db.close()
+        return genes
+
+'''compiles refGene into annotation store (written to temporary file and renamed)'''
+def compileAnnotation(genepred, sqlite):
+    temp = sqlite+'.tmp'
+    if os.path.exists(temp):
+        os.unlink(temp)
+    db = sqlite3.connect(temp)
+    try:
+        db.execute('CREATE TABLE source(size INT, mtime INT)')
+        db.execute('CREATE TABLE gene(id INTEGER PRIMARY KEY, name TEXT, chrom TEXT, start INT, end INT, reverse INT, noncoding INT)')
+        db.execute('CREATE TABLE exon(gene INT REFERENCES gene(id), start INT, end INT)')
+        db.execute('INSERT INTO source VALUES (?,?)', sourceStat(genepred))
+        geneid = 0
+        for noncoding in [False, True]:
+            with open(genepred) as fh:
+                # coding genes exclude noncoding transcripts (as when reading selected genes)
+                lines = fh if noncoding else ( l for l in fh if l.startswith('#') or l.split()[6] != l.split()[7] )
+                genes = readGenePred(lines, None, noncoding)
+            for genename in sorted(genes.keys()):
+                for g in genes[genename]:
+                    geneid += 1
+                    db.execute('INSERT INTO gene VALUES (?,?,?,?,?,?,?)', \
+                        (geneid, g.name, g.chrom, g.chromStart, g.chromEnd, int(g.strand < 0), int(noncoding)))
+                    db.executemany('INSERT INTO exon VALUES (?,?,?)', [ (geneid, e.chromStart, e.chromEnd) for e in g.subintervals ])
+        db.execute('CREATE INDEX gene_name ON gene(noncoding, name)')
+        db.execute('CREATE INDEX exon_gene ON exon(gene)')
+        db.commit()
+        count = db.execute('SELECT COUNT(DISTINCT name) FROM gene WHERE noncoding = 0').fetchone()[0]
+    finally:
+        db.close()
+    os.rename(temp, sqlite)
+    return count
+
+'''opens compiled annotation if current (else refGene text file)'''
+def openAnnotation(genepred):
+    sqlite = genepred+'.sqlite'
+    if os.path.exists(sqlite):
+        store = AnnotationStore(sqlite)
+        if not os.path.exists(genepred) or store.source() == sourceStat(genepred):
+            return store
+        print >> sys.stderr, 'WARNING: {} is outdated (recompile with: zippy.py annotation)'.format(sqlite)
+    return open(genepred)
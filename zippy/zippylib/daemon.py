@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+__doc__=="""Design daemon (runs CLI commands in a warm process over a Unix socket)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import sys
+import os
+import errno
+import json
+import stat
+import signal
+import socket
+import traceback
+import SocketServer
+
+'''writes stream to client (JSON lines)'''
+class SocketStream(object):
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, data):
+        if data:
+            self.wfile.write(json.dumps({ 'stream': self.name, 'data': data })+'\n')
+            self.wfile.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+'''runs one command per connection (in daemon process to keep resources open)'''
+class CommandHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        home, stdout, stderr = os.getcwd(), sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = SocketStream(self.wfile, 'stdout'), SocketStream(self.wfile, 'stderr')
+        status = 0
+        try:
+            os.chdir(request['cwd'])  # relative paths as in client
+            self.server.run(request['argv'])
+        except SystemExit as e:
+            status = e.code if type(e.code) is int else 0 if e.code is None else 1
+            if type(e.code) is str:
+                print >> sys.stderr, e.code
+        except socket.error:
+            status = None  # client disconnected
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(home)
+        if status is not None:
+            try:
+                self.wfile.write(json.dumps({ 'exit': status })+'\n')
+            except socket.error:
+                pass
+        print >> sys.stderr, '{} -> {}'.format(' '.join(request['argv']), status)
+
+'''design daemon (one command at a time)'''
+class DesignDaemon(SocketServer.UnixStreamServer):
+    def __init__(self, socketpath, run):
+        self.run = run  # function(argv)
+        SocketServer.UnixStreamServer.__init__(self, socketpath, CommandHandler)
+
+def running(socketpath):
+    '''checks if daemon accepts connections on socket'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketpath)
+    except socket.error as e:
+        return e.errno not in [errno.ECONNREFUSED, errno.ENOENT]  # eg. socket of other user
+    else:
+        return True
+    finally:
+        client.close()
+
+'''serves commands on socket until terminated'''
+def serve(socketpath, run):
+    if os.path.exists(socketpath):
+        if running(socketpath):
+            raise Exception('DaemonRunning')
+        os.unlink(socketpath)  # stale socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    mask = os.umask(0177)  # socket created accessible by owner only (commands run with permissions of daemon user)
+    try:
+        server = DesignDaemon(socketpath, run)
+    finally:
+        os.umask(mask)
+    os.chmod(socketpath, stat.S_IRUSR | stat.S_IWUSR)
+    print >> sys.stderr, 'Serving on {}'.format(socketpath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socketpath)
+
+'''forwards command to daemon and returns exit status (None if daemon not running)'''
+def forward(socketpath, argv, cwd):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketpath)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall(json.dumps({ 'argv': argv, 'cwd': cwd })+'\n')
+        for line in client.makefile('r'):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            stream = sys.stdout if message['stream'] == 'stdout' else sys.stderr
+            stream.write(message['data'].encode('utf-8') if type(message['data']) is unicode else message['data'])
+            stream.flush()
+        return 1  # daemon died
+    finally:
+        client.close()
@@ -8,44 +8,54 @@ __maintainer__ = "David Brawand"
 __email__ = "dbrawand@nhs.net"
 __status__ = "Production"
 
-import sys, os, re, ast
+import sys, os, re, ast, errno, stat
+import time
+import random
 import datetime
 import json
 import hashlib
 import sqlite3
 import fnmatch
-import primer3
+import tempfile
+import threading
 from copy import deepcopy
-from collections import defaultdict
+from itertools import groupby
+from contextlib import contextmanager
 from . import flatten
-from .primer import Primer, Locus, PrimerPair, Location, parsePrimerName
+from .primer import Location
+from .store import PrimerStore, changeConflictingName, datematch
 
-# changes conflicting name
-def changeConflictingName(n):
-    f = n.split('_')
-    # find suffix to increment
-    if len(f)==4:  # try to increase suffix
-        try:
-            f[2] = str(int(f[2])+1)
-        except:
-            raise Exception('PrimerNameChangeError')
-        return '_'.join(f)
-    elif len(f)==3:  # add number suffix after exon
-        return '_'.join(f[:2]+[str(1)]+f[2])
-    raise Exception('PrimerNameChangeError')
-
-# Primer Database
-class PrimerDB(object):
-    def __init__(self, database, dump=None):
+# Primer Database (SQLite engine)
+class PrimerDB(PrimerStore):
+    def __init__(self, database, dump=None, timeout=10.0, retries=5, backoff=0.1, \
+        replica=None, refresh=300, aftercommit=False, mmap=268435456, cachesize=65536):
+        PrimerStore.__init__(self, dump)
         # open database and get a cursor
         self.sqlite = database
-        self.db = sqlite3.connect(self.sqlite)
-        self.dump = dump  # Primer BED file created by destructor
+        self.timeout = timeout  # per-call lock timeout (seconds)
+        self.retries = retries  # write lock retries
+        self.backoff = backoff  # initial retry delay (seconds), doubles every retry
+        # read-only replica (snapshot) for queries, writes always go to primary
+        self.replica = replica
+        self.refresh = refresh  # maximum replica age if primary has changed (seconds)
+        self.aftercommit = aftercommit  # refresh replica after every write transaction
+        self.mmap = mmap  # replica memory map size (bytes)
+        self.cachesize = cachesize  # replica page cache (KiB)
+        self.committed = 0  # database version of last own write (replica used once it has caught up)
+        self.replicaconnection = threading.local()
+        self.replicareaders = {}  # open replica connections of all threads -> active readers
+        self.retired = set()  # replica connections closed when last reader finishes
+        self.replicalock = threading.Lock()
+        self.closed = False
+        self.db = sqlite3.connect(self.sqlite, timeout=self.timeout)
         # create file table if not exists
         cursor = self.db.cursor()
         try:
             # TABLE
             cursor.execute('''PRAGMA foreign_keys = ON''')
+            # write-ahead log (snapshots and readers do not block writers), read-only snapshots keep rollback journal
+            if os.stat(self.sqlite).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+                cursor.execute('''PRAGMA journal_mode = WAL''')
             # names unique, reinsertion if identical primers ignored
             cursor.execute('''CREATE TABLE IF NOT EXISTS primer(
                 name TEXT, seq TEXT, tag TEXT, tm REAL, gc REAL, vessel INT,
@@ -66,6 +76,9 @@ class PrimerDB(object):
                 FOREIGN KEY(seq) REFERENCES primer(seq) ON DELETE CASCADE);''')
             cursor.execute('''CREATE TABLE IF NOT EXISTS blacklist(
                 uniqueid TEXT PRIMARY KEY, blacklistdate TEXT);''')
+            # INDEX (covers redundancy scans on sequence and tag)
+            cursor.execute('''CREATE INDEX IF NOT EXISTS primer_seqtag
+                ON primer(seq, tag, name);''')
             self.db.commit()
         except:
             print >> sys.stderr, self.sqlite
@@ -79,427 +92,509 @@ class PrimerDB(object):
     def __str__(self):
         return '<ZippyDB at %s>' % self.sqlite
 
-    def __repr__(self):
+    @contextmanager
+    def writer(self):
+        '''atomic write transaction (BEGIN IMMEDIATE with bounded exponential backoff)'''
+        db = sqlite3.connect(self.sqlite, timeout=self.timeout, isolation_level=None)
         try:
-            self.db = sqlite3.connect(self.sqlite)
+            cursor = db.cursor()
+            # acquire write lock (waits up to timeout, then backs off and retries)
+            for attempt in range(self.retries+1):
+                try:
+                    cursor.execute('BEGIN IMMEDIATE')
+                except sqlite3.OperationalError as e:
+                    if 'locked' not in str(e) or attempt == self.retries:
+                        raise
+                    delay = self.backoff * 2**attempt
+                    print >> sys.stderr, 'WARNING: database locked, retrying in {:.2f}s'.format(delay)
+                    time.sleep(random.uniform(0.5*delay, delay))
+                else:
+                    break
+            # run statements and commit as one unit
+            try:
+                yield cursor
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                # increment database version
+                cursor.execute('PRAGMA user_version')
+                committed = cursor.fetchone()[0]+1
+                cursor.execute('PRAGMA user_version = {:d}'.format(committed))
+                cursor.execute('COMMIT')
+                self.committed = committed
+        finally:
+            db.close()
+        # publish committed changes to replica (own writes are read from primary until refreshed)
+        if self.replica and self.aftercommit:
+            self.refreshReplica()
+
+    @contextmanager
+    def reader(self):
+        '''read cursor (from read-only replica if configured and current)'''
+        replica = self._replicaConnection() if self.replica else None
+        if replica:
+            try:
+                yield replica.cursor()
+            finally:
+                with self.replicalock:
+                    self.replicareaders[replica] -= 1
+                    if replica in self.retired:
+                        self._retire(replica)
+        else:
+            db = sqlite3.connect(self.sqlite, timeout=self.timeout)
+            try:
+                yield db.cursor()
+            finally:
+                db.close()
+
+    def _primaryTime(self):
+        '''returns modification time of primary (committed transactions are in write-ahead log until checkpoint)'''
+        times = [ os.stat(self.sqlite).st_mtime ]
+        if os.path.exists(self.sqlite+'-wal'):
+            times.append(os.stat(self.sqlite+'-wal').st_mtime)
+        return max(times)
+
+    def refreshReplica(self):
+        '''refreshes replica in background thread unless another process does (returns thread or None)'''
+        lock = self.replica+'.lock'
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:  # remove lock of dead process
+                with open(lock) as fh:
+                    os.kill(int(fh.read()), 0)
+            except (IOError, ValueError):
+                pass  # released or being written
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    try:
+                        os.unlink(lock)
+                    except OSError:
+                        pass
+            return None
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        def refresh():
+            try:
+                self.snapshot(self.replica)
+            except Exception as e:
+                print >> sys.stderr, 'WARNING: replica refresh failed ({}), reading from primary'.format(e)
+            finally:
+                os.unlink(lock)
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _retire(self, db):
+        '''closes replica connection once idle (call with replica lock held)'''
+        if self.replicareaders[db]:
+            self.retired.add(db)
+        else:
+            db.close()
+            del self.replicareaders[db]
+            self.retired.discard(db)
+
+    def close(self):
+        '''closes replica connections of all threads (in use ones when their readers finish)'''
+        with self.replicalock:
+            self.closed = True
+            for db in self.replicareaders.keys():
+                self._retire(db)
+
+    def _replicaConnection(self):
+        '''returns persistent per-thread replica connection counted as reader (None if closed, missing, outdated or missing own writes)'''
+        if self.closed:
+            return None
+        # refresh out of band if missing or behind a changed primary for longer than refresh interval (read primary meanwhile)
+        try:
+            replicatime = os.stat(self.replica).st_mtime
+        except OSError:
+            replicatime = None
+        if replicatime is None or (self._primaryTime() > replicatime and time.time()-replicatime > self.refresh):
+            self.refreshReplica()
+            return None
+        # (re)open if replica was replaced (snapshots are renamed into place, never modified)
+        local = self.replicaconnection
+        inode = os.stat(self.replica).st_ino
+        if getattr(local, 'inode', None) != inode:
+            if getattr(local, 'db', None):
+                with self.replicalock:
+                    if local.db in self.replicareaders:
+                        self._retire(local.db)
+            # shared with thread closing database
+            if sys.version_info >= (3, 4):
+                local.db = sqlite3.connect('file:{}?mode=ro'.format(self.replica), timeout=self.timeout, uri=True, check_same_thread=False)
+            else:  # snapshot file is read-only, SQLite opens it in read-only mode
+                local.db = sqlite3.connect(self.replica, timeout=self.timeout, check_same_thread=False)
+            local.db.execute('PRAGMA query_only = ON')
+            local.db.execute('PRAGMA mmap_size = {:d}'.format(self.mmap))
+            local.db.execute('PRAGMA cache_size = -{:d}'.format(self.cachesize))
+            local.version = local.db.execute('PRAGMA user_version').fetchone()[0]
+            local.inode = inode
+            with self.replicalock:
+                self.replicareaders[local.db] = 0
+        if local.version < self.committed:
+            return None  # read own writes from primary until replica (refreshed by any process) has them
+        with self.replicalock:
+            if self.closed:
+                if local.db in self.replicareaders:
+                    self._retire(local.db)
+                return None
+            self.replicareaders[local.db] += 1
+        return local.db
+
+    def snapshot(self, target):
+        '''writes compacted read-only copy of database (single read transaction, concurrent writes proceed in WAL mode)'''
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(target)+'.', dir=os.path.dirname(os.path.abspath(target)))
+        os.close(fd)  # empty file (unique for concurrent snapshots)
+        db = sqlite3.connect(self.sqlite, timeout=self.timeout, isolation_level=None)
+        try:
+            try:  # compacted copy (SQLite 3.27+)
+                db.execute('VACUUM INTO ?', (temp,))
+            except sqlite3.OperationalError:
+                # SQL dump within one read transaction
+                copy = sqlite3.connect(temp)
+                try:
+                    db.execute('BEGIN')
+                    copy.executescript('\n'.join(db.iterdump()))
+                    copy.execute('PRAGMA user_version = {:d}'.format(db.execute('PRAGMA user_version').fetchone()[0]))
+                    db.execute('COMMIT')
+                finally:
+                    copy.close()
+            # rollback journal (read-only file cannot create write-ahead log index)
+            copy = sqlite3.connect(temp)
+            try:
+                copy.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                copy.close()
         except:
+            os.unlink(temp)
             raise
-        else:
-            cursor = self.db.cursor()
+        finally:
+            db.close()
+        # make read-only and replace previous snapshot
+        os.chmod(temp, 0444)
+        os.rename(temp, target)
+        return target
+
+    def version(self, primary=False):
+        '''returns database version (of replica if queries are answered from it, unless primary requested)'''
+        if primary:
+            db = sqlite3.connect(self.sqlite, timeout=self.timeout)
+            try:
+                return db.execute('PRAGMA user_version').fetchone()[0]
+            finally:
+                db.close()
+        with self.reader() as cursor:
+            return cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    def pairTable(self):
+        with self.reader() as cursor:
             cursor.execute('''SELECT DISTINCT
                 p.pairid, p.uniqueid, p.left, l.seq, p.right, r.seq, p.chrom, p.start, p.end, p.dateadded
                 FROM pairs as p
                 LEFT JOIN primer as l ON l.name = p.left
                 LEFT JOIN primer as r ON r.name = p.right;''')
             rows = cursor.fetchall()
-        finally:
-            self.db.close()
-        return "\n".join([ '{:<20} {:40} {:>20} {:<25} {:>20} {:<25} {:>8} {:>9d} {:>9d} {}'.format(*row) for row in rows ])
-
-    def writeAmpliconDump(self):
-        ## dump amplicons to bed file
-        if self.dump:
-            try:
-                self.db = sqlite3.connect(self.sqlite)
-            except:
-                raise
-            else:
-                # get amplicons
-                cursor = self.db.cursor()
-                cursor.execute('''SELECT DISTINCT p.chrom, p.start, p.end, p.pairid
-                    FROM pairs AS p
-                    ORDER BY p.chrom, p.start;''')
-                rows = cursor.fetchall()
-                # write bed file
-                try:
-                    with open(self.dump,'w') as fh:
-                        for row in rows:
-                            print >> fh, '\t'.join(map(str,row))
-                except IOError:
-                    print >> sys.stderr, "cannot write to %s" % self.dump
-                    pass  # fail silently (eg if data cannot be written)
-                except:
-                    raise
-            finally:
-                self.db.close()
+        return rows
 
     def removeOrphans(self):
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            cursor = self.db.cursor()
-            cursor.execute('''
-            SELECT p.name FROM primer AS p WHERE NOT EXISTS (
-            SELECT left FROM pairs AS pp WHERE pp.left = p.name
-            UNION
-            SELECT right FROM pairs AS pp WHERE pp.right = p.name);''')
-            orphans = cursor.fetchall()
-            cursor.executemany('''DELETE FROM primer
-                WHERE name = ?''', (orphans))
-            self.db.commit()
+            with self.writer() as cursor:
+                cursor.execute('''
+                SELECT p.name FROM primer AS p WHERE NOT EXISTS (
+                SELECT left FROM pairs AS pp WHERE pp.left = p.name
+                UNION
+                SELECT right FROM pairs AS pp WHERE pp.right = p.name);''')
+                orphans = cursor.fetchall()
+                cursor.executemany('''DELETE FROM primer
+                    WHERE name = ?''', (orphans))
             return [ x[0] for x in orphans ]
         finally:
-            self.db.close()
             self.writeAmpliconDump()
 
     '''show/update blacklist'''
     def blacklist(self,add=None):
-        try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            if add:
-                # get uniqueid from status table for pairid
-                blacklisttime = datetime.datetime.now()
-                cursor = self.db.cursor()
-                cursor.execute('PRAGMA foreign_keys = ON')
-                cursor.execute('''SELECT DISTINCT p.uniqueid
-                    FROM pairs AS p WHERE p.pairid = ?;''', (add,))
-                bl_uniqueid = [ row[0] for row in cursor.fetchall() ]
-                # get list of pairs from pairs table with uniqueid
-                second_cursor = self.db.cursor()
-                second_cursor.execute('PRAGMA foreign_keys = OFF')
-                pairlist = []
-                for uid in bl_uniqueid:
-                    # add uniqueid to blacklist
-                    second_cursor.execute('''INSERT INTO blacklist(uniqueid, blacklistdate) VALUES(?,?);''', \
-                    (uid, blacklisttime))
-                    # get list of pairs to be deleted
-                    second_cursor.execute('''SELECT DISTINCT p.pairid
-                    FROM pairs AS p
-                    WHERE p.uniqueid = ?;''', (uid,))
-                    pairlist += [ x[0] for x in second_cursor.fetchall() ]
-                    # delete all those pairs from pairs table
-                    second_cursor.execute('''DELETE FROM pairs
-                    WHERE uniqueid = ?;''', (uid,))
-                    # delete orphan primers
-                    self.db.commit()
+        if add:
+            try:
+                # blacklist and remove pairs in one transaction
+                with self.writer() as cursor:
+                    blacklisttime = datetime.datetime.now()
+                    # get uniqueid from status table for pairid
+                    cursor.execute('''SELECT DISTINCT p.uniqueid
+                        FROM pairs AS p WHERE p.pairid = ?;''', (add,))
+                    bl_uniqueid = [ row[0] for row in cursor.fetchall() ]
+                    # get list of pairs from pairs table with uniqueid
+                    pairlist = []
+                    for uid in bl_uniqueid:
+                        # add uniqueid to blacklist
+                        cursor.execute('''INSERT INTO blacklist(uniqueid, blacklistdate) VALUES(?,?);''', \
+                        (uid, blacklisttime))
+                        # get list of pairs to be deleted
+                        cursor.execute('''SELECT DISTINCT p.pairid
+                        FROM pairs AS p
+                        WHERE p.uniqueid = ?;''', (uid,))
+                        pairlist += [ x[0] for x in cursor.fetchall() ]
+                        # delete all those pairs from pairs table
+                        cursor.execute('''DELETE FROM pairs
+                        WHERE uniqueid = ?;''', (uid,))
                 return pairlist
-            else: #return list of uniqueids from blacklist
-                cursor = self.db.cursor()
+            finally:
+                self.writeAmpliconDump()
+        else: #return list of uniqueids from blacklist
+            with self.reader() as cursor:
                 cursor.execute('''SELECT DISTINCT uniqueid FROM blacklist;''')
                 rows = cursor.fetchall()
                 return [ row[0] for row in rows ]
-        finally:
-            self.db.close()
-            self.writeAmpliconDump()
-
 
     '''adds list of primers to database and automatically renames'''
     def addPrimer(self, *primers):
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            current_time = datetime.datetime.now()
-            cursor = self.db.cursor()
-            for p in primers:
-                # store primers and modify names if necessary
-                while True:
-                    originalName = deepcopy(p.name)
-                    try:
-                        cursor.execute('''INSERT INTO primer(name,seq,tag,tm,gc,dateadded) VALUES(?,?,?,?,?,?)''', \
-                            (p.name, p.seq, p.tag, p.tm, p.gc, current_time))
-                    except sqlite3.IntegrityError:
-                        try:
-                            p.name = changeConflictingName(p.name)
-                        except Exception as e:
-                            raise e
-                    except:
-                        raise
-                    else:
-                        if originalName != p.name:
-                            print >> sys.stderr, "WARNING: renamed primer {} -> {} in database".format(originalName, p.name)
-                        break  # sucessfully stored
-                # store mapping loci
-                for l in p.loci:
-                    cursor.execute('''INSERT OR IGNORE INTO target(seq,chrom,position,reverse,tm) VALUES(?,?,?,?,?)''', \
-                        (p.seq, l.chrom, l.offset, l.reverse, l.tm))
-            self.db.commit()
+            with self.writer() as cursor:
+                self._insertPrimers(cursor, primers)
         finally:
-            self.db.close()
             self.writeAmpliconDump()
         return
 
+    def _insertPrimers(self, cursor, primers):
+        current_time = datetime.datetime.now()
+        for p in primers:
+            # store primers and modify names if necessary
+            while True:
+                originalName = deepcopy(p.name)
+                try:
+                    cursor.execute('''INSERT INTO primer(name,seq,tag,tm,gc,dateadded) VALUES(?,?,?,?,?,?)''', \
+                        (p.name, p.seq, p.tag, p.tm, p.gc, current_time))
+                except sqlite3.IntegrityError:
+                    try:
+                        p.name = changeConflictingName(p.name)
+                    except Exception as e:
+                        raise e
+                except:
+                    raise
+                else:
+                    if originalName != p.name:
+                        print >> sys.stderr, "WARNING: renamed primer {} -> {} in database".format(originalName, p.name)
+                    break  # sucessfully stored
+            # store mapping loci
+            for l in p.loci:
+                cursor.execute('''INSERT OR IGNORE INTO target(seq,chrom,position,reverse,tm) VALUES(?,?,?,?,?)''', \
+                    (p.seq, l.chrom, l.offset, l.reverse, l.tm))
+        return
+
     def addPair(self, *pairs):
         '''adds primer pairs (and individual primers)'''
-        # add primers (and rename if necessary)
-        flat = []
-        for p in pairs:
-            flat.append(p[0])
-            flat.append(p[1])
-        self.addPrimer(*flat)
-        # add pairs
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            current_time = datetime.datetime.now()
-            cursor = self.db.cursor()
-            # add pairs
-            for p in pairs:
-                p.fixName()  # changes name if there is a longer common name (catches primer renaming)
-                # find common substring in name for automatic naming
-                chrom = p[0].targetposition.chrom
-                start = p[0].targetposition.offset
-                end = p[1].targetposition.offset+p[1].targetposition.length
-                cursor.execute('''INSERT OR IGNORE INTO pairs(pairid,uniqueid,left,right,chrom,start,end,dateadded) VALUES(?,?,?,?,?,?,?,?)''', \
-                    (p.name, p.uniqueid(), p[0].name, p[1].name, chrom, start, end, current_time))
-            self.db.commit()
+            # primers and pairs are stored as one transaction
+            with self.writer() as cursor:
+                # add primers (and rename if necessary)
+                flat = []
+                for p in pairs:
+                    flat.append(p[0])
+                    flat.append(p[1])
+                self._insertPrimers(cursor, flat)
+                # add pairs
+                current_time = datetime.datetime.now()
+                for p in pairs:
+                    p.fixName()  # changes name if there is a longer common name (catches primer renaming)
+                    # find common substring in name for automatic naming
+                    chrom = p[0].targetposition.chrom
+                    start = p[0].targetposition.offset
+                    end = p[1].targetposition.offset+p[1].targetposition.length
+                    cursor.execute('''INSERT OR IGNORE INTO pairs(pairid,uniqueid,left,right,chrom,start,end,dateadded) VALUES(?,?,?,?,?,?,?,?)''', \
+                        (p.name, p.uniqueid(), p[0].name, p[1].name, chrom, start, end, current_time))
         finally:
-            self.db.close()
             self.writeAmpliconDump()
         return
 
-    '''query for interval or name'''
-    def query(self, query):
-        '''returns suitable primer pairs for the specified interval'''
-        try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            cursor = self.db.cursor()
-            datematch = re.compile("([0-9\s-]+)$")
-            if datematch.match(str(query)): # query date
-                subSearchName = '%'+query+'%'
-                cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
-                    p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well, 0
-                    FROM pairs AS p
-                    LEFT JOIN primer as l ON p.left = l.name
-                    LEFT JOIN primer as r ON p.right = r.name
-                    where p.dateadded LIKE ?
-                    ORDER BY p.pairid;''', \
-                    (subSearchName,))
-            elif type(query) in [str,unicode]:  # use primerpair name
-                subSearchName = '%'+query+'%'
-                cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
-                    p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well, 0
-                    FROM pairs AS p
-                    LEFT JOIN primer as l ON p.left = l.name
-                    LEFT JOIN primer as r ON p.right = r.name
-                    WHERE p.pairid LIKE ?
-                    ORDER BY p.pairid;''', \
-                    (subSearchName,))
-            else:  # is interval
-                cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
-                    p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well,
-                    abs(p.start+((p.end-p.start)/2) - ?) as midpointdistance
-                    FROM pairs AS p
-                    LEFT JOIN primer as l ON p.left = l.name
-                    LEFT JOIN primer as r ON p.right = r.name
-                    WHERE p.chrom = ?
-                    AND p.start + length(l.seq) <= ?
-                    AND p.end - length(r.seq) >= ?
-                    ORDER BY midpointdistance;''', \
-                    (int(query.chromStart+int(query.chromEnd-query.chromStart)/2.0), query.chrom, query.chromStart, query.chromEnd))
-            rows = cursor.fetchall()
-        finally:
-            self.db.close()
-        # return primer pairs that would match
-        primerPairs = []
-        for row in rows:
-            # build targets
-            leftTargetposition = Locus(row[7], row[8], len(row[3]), False, primer3.calcTm(str(row[3])))
-            rightTargetposition = Locus(row[7], row[9]-len(row[4]), len(row[4]), True, primer3.calcTm(str(row[4])))
-            # build storage locations (if available)
-            leftLocation = Location(*row[10:12]) if all(row[10:12]) else None
-            rightLocation = Location(*row[12:14]) if all(row[12:14]) else None
-            # Build primers
-            leftPrimer = Primer(row[5], row[3], targetposition=leftTargetposition, tag=row[1], location=leftLocation)
-            rightPrimer = Primer(row[6], row[4], targetposition=rightTargetposition, tag=row[2], location=rightLocation)
-            # get reverse status (from name)
-            orientations = [ x[1] for x in map(parsePrimerName,row[5:7]) ]
-            if not any(orientations) or len(set(orientations))==1:
-                print >> sys.stderr, '\rWARNING: {} orientation is ambiguous ({},{}){}\r'.format(row[0],\
-                    '???' if orientations[0]==0 else 'rev' if orientations[0]<0 else 'fwd', \
-                    '???' if orientations[0]==0 else 'rev' if orientations[1]<0 else 'fwd'," "*20)
-                reverse = False
-            elif orientations[0]>0 or orientations[1]<0:
-                reverse = False
-            elif orientations[1]>0 or orientations[0]<0:
-                reverse = True
-            else:
-                raise Exception('PrimerPairStrandError')
-            # Build pair
-            primerPairs.append(PrimerPair([leftPrimer, rightPrimer],name=row[0],reverse=reverse))
-        return primerPairs  # ordered by midpoint distance
+    def queryRows(self, query):
+        '''returns pair rows for interval, pair name or date'''
+        with self.reader() as cursor:
+            return self._queryRows(cursor, query)
+
+    def queryRowsMany(self, queries):
+        '''returns pair rows for each query (one connection)'''
+        with self.reader() as cursor:
+            return [ self._queryRows(cursor, q) for q in queries ]
+
+    def searchRows(self, name, offset=0, limit=None):
+        '''returns number of pairs matching name and rows of requested page'''
+        with self.reader() as cursor:
+            cursor.execute('''SELECT count(*) FROM pairs WHERE pairid LIKE ?;''', ('%'+name+'%',))
+            total = cursor.fetchone()[0]
+            return total, self._queryRows(cursor, name, offset, limit, dates=False)
+
+    def _queryRows(self, cursor, query, offset=0, limit=None, dates=True):
+        from .metrics import metrics
+        kind = 'date' if dates and datematch.match(str(query)) else 'name' if type(query) in [str,unicode] else 'interval'
+        with metrics.timer('zippy_database_query_seconds', kind=kind):
+            return self._queryRowsKind(cursor, query, kind, offset, limit)
+
+    def _queryRowsKind(self, cursor, query, kind, offset, limit):
+        limit = -1 if limit is None else limit  # names and dates only
+        if kind == 'date':
+            subSearchName = '%'+query+'%'
+            cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
+                p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well, 0
+                FROM pairs AS p
+                LEFT JOIN primer as l ON p.left = l.name
+                LEFT JOIN primer as r ON p.right = r.name
+                where p.dateadded LIKE ?
+                ORDER BY p.pairid
+                LIMIT ? OFFSET ?;''', \
+                (subSearchName, limit, offset))
+        elif kind == 'name':  # use primerpair name
+            subSearchName = '%'+query+'%'
+            cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
+                p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well, 0
+                FROM pairs AS p
+                LEFT JOIN primer as l ON p.left = l.name
+                LEFT JOIN primer as r ON p.right = r.name
+                WHERE p.pairid LIKE ?
+                ORDER BY p.pairid
+                LIMIT ? OFFSET ?;''', \
+                (subSearchName, limit, offset))
+        else:  # is interval
+            cursor.execute('''SELECT DISTINCT p.pairid, l.tag, r.tag, l.seq, r.seq, p.left, p.right,
+                p.chrom, p.start, p.end, l.vessel, l.well, r.vessel, r.well,
+                abs(p.start+((p.end-p.start)/2) - ?) as midpointdistance
+                FROM pairs AS p
+                LEFT JOIN primer as l ON p.left = l.name
+                LEFT JOIN primer as r ON p.right = r.name
+                WHERE p.chrom = ?
+                AND p.start + length(l.seq) <= ?
+                AND p.end - length(r.seq) >= ?
+                ORDER BY midpointdistance;''', \
+                (int(query.chromStart+int(query.chromEnd-query.chromStart)/2.0), query.chrom, query.chromStart, query.chromEnd))
+        return cursor.fetchall()  # ordered by midpoint distance
 
     def getLocation(self,loc):
         '''returns whats stored at location'''
-        try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            cursor = self.db.cursor()
+        with self.reader() as cursor:
             cursor.execute('''SELECT DISTINCT name FROM primer
                 WHERE vessel = ? AND well LIKE ?;''', (loc.vessel(),'%'+loc.well()+'%') )
             return [ x[0] for x in cursor.fetchall() ]
-        finally:
-            self.db.close()
 
     def getRedundantPrimers(self):
         '''returns redundant primer (same tag and sequence)'''
-        redundant = defaultdict(list)
-        try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            cursor = self.db.cursor()
-            cursor.execute('''SELECT p1.seq, p1.tag, p1.name
-            FROM primer AS p1 LEFT JOIN primer AS p2 ON p1.seq = p2.seq AND p1.tag = p2.tag
-            GROUP BY p1.name,p1.tag HAVING COUNT(p1.seq) > 1;''')
-            for l in cursor.fetchall():
-                redundant[(l[0],l[1])].append(l[2])
+        with self.reader() as cursor:
+            # single pass over (seq,tag) index, adjacent rows share key
+            cursor.execute('''SELECT seq, tag, name FROM primer
+                ORDER BY seq, tag, name;''')
+            redundant = []
+            for k, g in groupby(cursor, key=lambda x: (x[0],x[1])):
+                names = [ x[2] for x in g ]
+                if len(names) > 1:
+                    redundant.append([ k[0], k[1], ','.join(names) ])
             # return list of list
-            return [ [k[0], k[1], ','.join(v)] for k,v in redundant.items() ], ['seq','tag','synonyms']
+            return redundant, ['seq','tag','synonyms']
+
+    def mergeRedundantPrimers(self):
+        '''merges primers with same sequence and tag into canonical record'''
+        merged = []  # (merged primer, canonical primer)
+        try:
+            with self.writer() as cursor:
+                cursor.execute('''SELECT seq, tag, name, vessel, well, dateadded FROM primer
+                    ORDER BY seq, tag, name;''')
+                rows = cursor.fetchall()
+                for k, g in groupby(rows, key=lambda x: (x[0],x[1])):
+                    synonyms = list(g)
+                    if len(synonyms) < 2:
+                        continue
+                    # canonical is stored primer or oldest record
+                    synonyms.sort(key=lambda x: (x[3] is None or x[4] is None, x[5], x[2]))
+                    canonical = synonyms[0]
+                    for s in synonyms[1:]:
+                        # keep primers stored in a different location (separate tube)
+                        if s[3] is not None and s[4] is not None and (s[3],s[4]) != (canonical[3],canonical[4]):
+                            continue
+                        cursor.execute('''UPDATE pairs SET left = ? WHERE left = ?;''', (canonical[2], s[2]))
+                        cursor.execute('''UPDATE pairs SET right = ? WHERE right = ?;''', (canonical[2], s[2]))
+                        cursor.execute('''DELETE FROM primer WHERE name = ?;''', (s[2],))
+                        merged.append((s[2], canonical[2]))
+            return merged
         finally:
-            self.db.close()
+            self.writeAmpliconDump()
 
     def addLocations(self, *locations):
         '''updates location for a batch of primers'''
-        try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            # update
-            try:
-                cursor = self.db.cursor()
-                cursor.executemany('''UPDATE OR IGNORE primer
-                    SET vessel = ?, well = ? WHERE name = ?''', \
-                    ((loc.vessel(), loc.well(), primerid) for primerid, loc in locations))
-                self.db.commit()
-            except:
-                raise
-        finally:
-            self.db.close()
+        with self.writer() as cursor:
+            cursor.executemany('''UPDATE OR IGNORE primer
+                SET vessel = ?, well = ? WHERE name = ?''', \
+                ((loc.vessel(), loc.well(), primerid) for primerid, loc in locations))
         return
 
     def storePrimer(self,primerid,loc,force=False):
         '''updates the location in which primers are stored'''
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
-            # reset storage location
-            if force:
-                try:
-                    cursor = self.db.cursor()
+            with self.writer() as cursor:
+                # reset storage location
+                if force:
                     cursor.execute('''UPDATE OR IGNORE primer SET vessel = NULL, well = NULL
                         WHERE vessel = ? AND well = ?''', (loc.vessel(), loc.well()))
-                    self.db.commit()
-                except:
-                    raise
-            # update
-            try:
-                cursor = self.db.cursor()
+                # update
                 cursor.execute('''UPDATE OR ABORT primer SET vessel = ?, well = ?
                     WHERE name = ?''', (loc.vessel(), loc.well(), primerid))
-                self.db.commit()
-            except sqlite3.IntegrityError:
-                return False
-            except:
-                raise
-            # check if updated
-            try:
+                # check if updated
                 cursor.execute('''SELECT DISTINCT vessel, well
                     FROM primer WHERE name = ?;''', (primerid,) )
                 rows = cursor.fetchall()
-                assert len(rows)==1 and Location(str(rows[0][0]),str(rows[0][1])) == loc
-            except AssertionError:
-                return False
-            except:
-                raise
-        finally:
-            self.db.close()
-        return True
+        except sqlite3.IntegrityError:
+            return False
+        except:
+            raise
+        return len(rows)==1 and Location(str(rows[0][0]),str(rows[0][1])) == loc
 
     def updateName(self,primerName,newName):
         '''changes the name of a primer stored in the database'''
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
             # update primer name in primer and pairs table
-            try:
-                cursor = self.db.cursor()
+            with self.writer() as cursor:
                 cursor.execute('''UPDATE OR ABORT pairs SET left = ?
                     WHERE left = ?;''', (newName, primerName))
                 cursor.execute('''UPDATE OR ABORT pairs SET right = ?
                     WHERE right = ?;''', (newName, primerName))
                 cursor.execute('''UPDATE OR ABORT primer SET name = ?
                     WHERE name = ?;''', (newName, primerName))
-                self.db.commit()
-            except sqlite3.IntegrityError:
-                return False
-            except:
-                raise
-            # check if updated
-            try:
+                # check if updated
                 cursor.execute('''SELECT DISTINCT name
                     FROM primer WHERE name = ?;''', (newName,) )
                 rows = cursor.fetchall()
-                assert rows[0][0] == newName
-                return True
-            except AssertionError:
-                return False
-            except:
-                raise
+            return len(rows)==1 and rows[0][0] == newName
+        except sqlite3.IntegrityError:
+            return False
+        except:
+            raise
         finally:
-            self.db.close()
             self.writeAmpliconDump()
 
     def updatePairName(self,pairName,newName):
         '''changes the name of a primer stored in the database'''
         try:
-            self.db = sqlite3.connect(self.sqlite)
-        except:
-            raise
-        else:
             # update primer name in primer and pairs table
-            try:
-                cursor = self.db.cursor()
+            with self.writer() as cursor:
                 cursor.execute('''UPDATE OR ABORT pairs SET pairid = ?
                     WHERE pairid = ?;''', (newName, pairName))
-                self.db.commit()
-            except sqlite3.IntegrityError:
-                return False
-            except:
-                raise
-            # check if updated
-            try:
+                # check if updated
                 cursor.execute('''SELECT DISTINCT pairid
                     FROM pairs WHERE pairid = ?;''', (newName,) )
                 rows = cursor.fetchall()
-                assert rows[0][0] == newName
-                return True
-            except AssertionError:
-                return False
-            except:
-                raise
+            return len(rows)==1 and rows[0][0] == newName
+        except sqlite3.IntegrityError:
+            return False
+        except:
+            raise
         finally:
-            self.db.close()
             self.writeAmpliconDump()
 
-    def dump(self,what,**kwargs):
+    def dumpRows(self,what,**kwargs):
         if what=='amplicons':
             # dump amplicons (all possible)
-            try:
-                self.db = sqlite3.connect(self.sqlite)
-            except:
-                raise
-            else:
-                cursor = self.db.cursor()
+            with self.reader() as cursor:
                 if 'size' in kwargs.keys() and len(kwargs['size'])==2:
                     cursor.execute('''SELECT DISTINCT p.chrom, p.start, p.end, p.pairid
                         FROM pairs AS p
@@ -510,17 +605,10 @@ class PrimerDB(object):
                         FROM pairs AS p
                         ORDER BY p.chrom, p.start;''')
                 rows = cursor.fetchall()
-            finally:
-                self.db.close()
             return rows, ('chrom','chromStart','chromEnd','name')  # rows and colnames
             # return [ '{}\t{}\t{}\t{}'.format(*row) for row in rows ]
         elif what=='ordersheet':
-            try:
-                self.db = sqlite3.connect(self.sqlite)
-            except:
-                raise
-            else:
-                cursor = self.db.cursor()
+            with self.reader() as cursor:
                 # PAIRS
                 cursor.execute('''SELECT DISTINCT
                     p.pairid AS pairname, l.name AS primername, l.seq AS sequence, l.tag as seqtag, 'fwd' AS direction
@@ -535,44 +623,10 @@ class PrimerDB(object):
                     WHERE r.well IS NULL AND r.vessel IS NULL
                     ORDER BY pairname, direction;''')
                 rows = cursor.fetchall()
-            finally:
-                self.db.close()
-            # define columns
-            columns = ['pairname','primername','sequence','seqtag','direction']
-            # add tags and extra columns
-            if 'extracolumns' in kwargs.keys() and kwargs['extracolumns']:
-                columns += [ c[0] for c in kwargs['extracolumns'] ]
-                for i in range(len(rows)):
-                    rows[i] = list(rows[i]) + [ c[1] for c in kwargs['extracolumns'] ]
-            # add sequence tag
-            if 'sequencetags' in kwargs.keys() and kwargs['sequencetags']:
-                for row in rows:
-                    # get correct tag
-                    try:
-                        p = parsePrimerName(row[1])
-                        if p[1] > 0:
-                            prepend = kwargs['sequencetags'][row[3]]['tags'][0]
-                        elif p[1] < 0:
-                            prepend = kwargs['sequencetags'][row[3]]['tags'][1]
-                        else:
-                            raise Exception('PrimerNameParseError')
-                        print >> sys.stderr, prepend
-                    except AssertionError:
-                        raise
-                    except:
-                        row[2] = row[3] + '-' + row[2]  # prepend tag sequence
-                    else:
-                        row[2] = prepend + row[2]  # prepend tag sequence
-            # return rows (list of list) and column names (headers)
-            return rows, columns
+            return rows, ['pairname','primername','sequence','seqtag','direction']
         elif what=='locations':
             # dump locations (all possible)
-            try:
-                self.db = sqlite3.connect(self.sqlite)
-            except:
-                raise
-            else:
-                cursor = self.db.cursor()
+            with self.reader() as cursor:
                 # PAIRS
                 cursor.execute('''SELECT DISTINCT pp.pairid, p.name, p.vessel, p.well
                         FROM pairs AS pp, primer as p
@@ -582,17 +636,10 @@ class PrimerDB(object):
                         FROM pairs AS pp, primer as p
                         WHERE pp.right = p.name;''')
                 rows = cursor.fetchall()
-            finally:
-                self.db.close()
             return rows, ['pair','primer','vessel','well']
         elif what=='table':
             # dump table with pairs primers and locations (which can be reimported)
-            try:
-                self.db = sqlite3.connect(self.sqlite)
-            except:
-                raise
-            else:
-                cursor = self.db.cursor()
+            with self.reader() as cursor:
                 cursor.execute('''SELECT * FROM (
                     SELECT p.name, pp.pairid, p.tag, p.seq, p.vessel, p.well
                     FROM pairs AS pp, primer AS p
@@ -603,6 +650,4 @@ class PrimerDB(object):
                     WHERE pp.right = p.name)
                     ORDER BY pairid;''')
                 rows = cursor.fetchall()
-            finally:
-                self.db.close()
             return rows, ['primername', 'primerset', 'tag', 'sequence', 'vessel', 'well']
@@ -11,182 +11,274 @@ __status__ = "Production"
 import sys
 import re
 import os
+import gzip
+import heapq
+import itertools
+from contextlib import contextmanager
 from math import ceil
+from array import array
 from collections import Counter, defaultdict
 from hashlib import sha1
 from . import ConfigError
 from .interval import *
 from urllib import quote, unquote
 
-'''GenePred parser with automatic segment numbering and tiling'''
-class GenePred(IntervalList):
-    def __init__(self,fh,getgenes=None,interval=None,overlap=None,flank=0,combine=True,noncoding=False):
-        IntervalList.__init__(self, [], source='GenePred')
-        counter = Counter()
-        intervalindex = defaultdict(list)
-        # read exons per gene
-        genes = defaultdict(list)
-        for line in fh:
-            if line.startswith("#"):
+'''reads GenePred transcripts and merges overlapping transcripts of same gene (gene name -> genes with flattened exons)'''
+def readGenePred(fh,getgenes=None,noncoding=False):
+    # read exons per transcript
+    transcripts = defaultdict(list)
+    for line in fh:
+        if line.startswith("#"):
+            continue
+        else:
+            # create gene and add exons
+            f = line.split()
+            assert f[3] in ['+','-']
+            if getgenes and (f[12] not in getgenes or int(f[6])==int(f[7])) and not noncoding:  # ignore non-coding transcripts
                 continue
-            else:
-                # create gene and add exons
-                f = line.split()
-                assert f[3] in ['+','-']
-                if getgenes and (f[12] not in getgenes or int(f[6])==int(f[7])) and not noncoding:  # ignore non-coding transcripts
+            # coding / noncoding
+            geneStart = int(f[4]) if noncoding else int(f[6])
+            geneEnd = int(f[5]) if noncoding else int(f[7])
+            reverse = f[3].startswith('-')
+            gene = Interval(f[2],geneStart,geneEnd,f[12],reverse)
+            # parse exons
+            exons = []
+            for e in zip(f[9].split(','),f[10].split(',')):
+                try:
+                    map(int,e)
+                except:
                     continue
-                # coding / noncoding
-                geneStart = int(f[4]) if noncoding else int(f[6])
-                geneEnd = int(f[5]) if noncoding else int(f[7])
-                reverse = f[3].startswith('-')
-                gene = Interval(f[2],geneStart,geneEnd,f[12],reverse)
-                # parse exons
-                for e in zip(f[9].split(','),f[10].split(',')):
-                    try:
-                        map(int,e)
-                    except:
-                        continue
-                    if int(e[1]) < geneStart or geneEnd < int(e[0]):
-                        continue  # noncoding
-                    try:
-                        exonStart = int(e[0]) if noncoding else max(geneStart,int(e[0]))
-                        exonEnd = int(e[1]) if noncoding else min(geneEnd,int(e[1]))
-                        gene.addSubintervals([Interval(f[2],exonStart,exonEnd,f[12],reverse)])
-                    except ValueError:
-                        pass
-                    except:
-                        raise
-                # find appropriate gene (same name, and overlapping)
-                ovpgenes = [ g for g in genes[gene.name] if gene.overlap(g) ]
-                if ovpgenes:
-                    try:
-                        assert len(ovpgenes) == 1
-                    except:
-                        # MERGE 2 GENES (there were non-overlapping transcripts in same gene locus!)
-                        for i in range(1,len(ovpgenes)):
-                            ovpgenes[0].merge(ovpgenes[i],subintervals=True)
-                            genes[gene.name].remove(ovpgenes[i])  # remove merged
-                    ovpgenes[0].addSubintervals(gene.subintervals)  # add exons from other transcript/gene
-                    ovpgenes[0].flattenSubintervals()  # flatten intervals IntervalList
-                else:
-                    # add new
-                    genes[gene.name].append(gene)
-        # name metaexons and combine if small enough
-        for genename, genelist in genes.items():
-            for g in genelist:
-                if combine:
-                    # iteratively combine closest exons
-                    combinedExons = [ [x] for x in sorted(g.subintervals) ]
-                    while True:
-                        # get distances
-                        distances = [ max([ x.chromEnd for x in combinedExons[i]]) - \
-                            min([ x.chromStart for x in combinedExons[i-1]]) \
-                            for i in range(1,len(combinedExons)) ]
-                        # combine smallest distance
-                        if any([ d < interval for d in distances ]):
-                            smallestIndex = distances.index(min(distances))
-                            recombinedExons = []
-                            for i,e in enumerate(combinedExons):
-                                if i > smallestIndex:  # merge with previous and add remainder
-                                    recombinedExons[-1] += e
-                                    if i+1 < len(combinedExons):
-                                        recombinedExons += combinedExons[i+1:]
-                                    break
-                                else:
-                                    recombinedExons.append(e)
-                            combinedExons = recombinedExons
-                        else:
-                            break
-                    # add exon numbers
-                    i = 0
-                    for e in combinedExons:
-                        # get exons
-                        ii = range(i,i+len(e))
-                        exonNumbers = [ len(g.subintervals) - x for x in ii ] if g.strand < 0 else [ x+1 for x in ii ]
-                        if len(e)>1:  # combine exons
-                            for j in range(1,len(e)):
-                                e[0].merge(e[j])
-                        e[0].name += '_{}'.format('+'.join(map(str,sorted(exonNumbers))))
-                        intervalindex[e[0].name].append(e[0])
-                        i += len(e)
-                else:
-                    # append exon number
-                    for i, e in enumerate(sorted(g.subintervals)):
-                        exonNumber = len(g.subintervals) - i if g.strand < 0 else i + 1
-                        e.name += '_{}'.format(str(exonNumber))
-                        intervalindex[e.name].append(e)
-        # split interval if necessary
-        for ivs in intervalindex.values():
-            for iv in ivs:
-                if interval and overlap and interval < len(iv):
-                    assert '+' not in iv.name  # paranoia
-                    self += iv.tile(interval,overlap,len(f)>3)  # name with suffix if named interval
-                else:
-                    self += [ iv ]
-        # add flanks
-        for e in self:
-            e.extend(flank)
-        return
-
-'''bed parser with automatic segment numbering and tiling'''
-class BED(IntervalList):
-    def __init__(self,fh,interval=None,overlap=None,flank=0):
-        IntervalList.__init__(self, [], source='BED')
-        counter = Counter()
-        intervalindex = defaultdict(list)
-        for line in fh:
-            if line.startswith("#"):
-                continue
-            else:
-                # create interval
-                f = line.split()
+                if int(e[1]) < geneStart or geneEnd < int(e[0]):
+                    continue  # noncoding
                 try:
-                    if len(f) > 5:  # name/strand
-                        iv = Interval(f[0],int(f[1]),int(f[2]),f[3],f[5].startswith('-'))
-                    elif len(f) > 3:  # name
-                        iv = Interval(f[0],int(f[1]),int(f[2]),f[3])
-                    else:  # automatic naming
-                        iv = Interval(f[0],int(f[1]),int(f[2]))
+                    exonStart = int(e[0]) if noncoding else max(geneStart,int(e[0]))
+                    exonEnd = int(e[1]) if noncoding else min(geneEnd,int(e[1]))
+                    exons.append(Interval(f[2],exonStart,exonEnd,f[12],reverse))
+                except ValueError:
+                    pass
                 except:
-                    print >> sys.stderr, f
                     raise
-                intervalindex[iv.name].append(iv)
+            gene.addSubintervals(exons)
+            transcripts[gene.name].append(gene)
+    # merge overlapping transcripts of same gene (sweep by position, can only overlap last gene)
+    genes = defaultdict(list)
+    for genename, transcriptlist in transcripts.items():
+        for gene in sorted(transcriptlist):
+            if genes[genename] and genes[genename][-1].overlap(gene):
+                genes[genename][-1].addSubintervals(gene.subintervals)  # add exons from other transcript
+                genes[genename][-1].flattenSubintervals()  # flatten intervals IntervalList
+            else:
+                genes[genename].append(gene)
+    return genes
+
+'''iteratively combines closest neighbouring exons while combined span is smaller than interval (heap of spans, leftmost first on ties)'''
+def combineExons(exons,interval):
+    combinedExons = [ [x] for x in exons ]
+    n = len(combinedExons)
+    starts = [ x.chromStart for x in exons ]  # span of combined exons (by index of first exon)
+    ends = [ x.chromEnd for x in exons ]
+    following = range(1,n+1)
+    preceding = range(-1,n-1)
+    heap = [ (ends[i] - starts[i-1], i-1, i) for i in range(1,n) ]
+    heapq.heapify(heap)
+    while heap:
+        distance, i, j = heapq.heappop(heap)
+        if not (combinedExons[i] and combinedExons[j]) or following[i] != j or ends[j] - starts[i] != distance:
+            continue  # outdated by previous merge
+        if not distance < interval:
+            break
+        # merge with previous and update distances to neighbours
+        combinedExons[i] += combinedExons[j]
+        combinedExons[j] = None
+        starts[i], ends[i] = min(starts[i], starts[j]), max(ends[i], ends[j])
+        following[i] = following[j]
+        if following[i] < n:
+            preceding[following[i]] = i
+            heapq.heappush(heap, (ends[following[i]] - starts[i], i, following[i]))
+        if preceding[i] >= 0:
+            heapq.heappush(heap, (ends[i] - starts[preceding[i]], preceding[i], i))
+    return [ e for e in combinedExons if e ]
+
+'''opens plain or gzip/bgzip compressed file (restricted to region CHR:START-END if tabix indexed)'''
+@contextmanager
+def openTargets(filename,region=None):
+    if region:
+        import pysam
+        tabix = pysam.TabixFile(filename)
+        try:
+            yield itertools.chain(( h+'\n' for h in tabix.header ), ( l+'\n' for l in tabix.fetch(region=region) ))
+        finally:
+            tabix.close()
+    else:
+        fh = gzip.open(filename) if filename.endswith('.gz') or filename.endswith('.bgz') else open(filename)
+        try:
+            yield fh
+        finally:
+            fh.close()
+
+'''returns target file format from extension (vcf, bed or genepred)'''
+def targetFormat(filename):
+    name = re.sub(r'\.b?gz$','',filename)
+    if name.endswith('vcf'):  # VCF files (strand 0)
+        return 'vcf'
+    elif name.endswith('bed'):  # BED files (BED3 with automatic names)
+        return 'bed'
+    elif name.endswith('txt') or name.lower().endswith('genepred'):  # GenePred files (uses gene name if unique)
+        return 'genepred'
+    raise Exception('UnknownFileExtension')
+
+'''splits iterable into lists of at most size elements'''
+def chunks(iterable,size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator,size))
+        if not chunk:
+            break
+        yield chunk
+
+'''names metaexons by exon numbers (combines closest exons while smaller than interval)'''
+def geneMetaexons(genes,interval=None,combine=True):
+    for genename in genes.keys():
+        for g in genes.pop(genename):
+            if combine:
+                # iteratively combine closest exons
+                combinedExons = combineExons(sorted(g.subintervals),interval)
+                # add exon numbers
+                i = 0
+                for e in combinedExons:
+                    # get exons
+                    ii = range(i,i+len(e))
+                    exonNumbers = [ len(g.subintervals) - x for x in ii ] if g.strand < 0 else [ x+1 for x in ii ]
+                    if len(e)>1:  # combine exons
+                        for j in range(1,len(e)):
+                            e[0].merge(e[j])
+                    e[0].name += '_{}'.format('+'.join(map(str,sorted(exonNumbers))))
+                    yield e[0]
+                    i += len(e)
+            else:
+                # append exon number
+                for i, e in enumerate(sorted(g.subintervals)):
+                    exonNumber = len(g.subintervals) - i if g.strand < 0 else i + 1
+                    e.name += '_{}'.format(str(exonNumber))
+                    yield e
+
+'''GenePred reader with automatic segment numbering and tiling (yields by gene, reads from compiled AnnotationStore if given)'''
+def iterGenePred(fh,getgenes=None,interval=None,overlap=None,flank=0,combine=True,noncoding=False,chunksize=10000):
+    from .intervalarray import intervalArray  # numpy
+    genes = fh.genes(getgenes,noncoding) if hasattr(fh,'genes') else readGenePred(fh,getgenes,noncoding)
+    for metaexons in chunks(geneMetaexons(genes,interval,combine),chunksize):
+        exons = intervalArray(metaexons)
+        # split interval if necessary and add flanks
+        if interval and overlap:
+            assert not any([ '+' in name for name in exons.name[exons.lengths() > interval] ])  # paranoia
+            exons = exons.tile(interval,overlap,True)  # name with suffix (named interval)
+        for e in exons.extend(flank).intervals():
+            yield e
+
+'''GenePred parser with automatic segment numbering and tiling (reads from compiled AnnotationStore if given)'''
+class GenePred(IntervalList):
+    def __init__(self,fh,getgenes=None,interval=None,overlap=None,flank=0,combine=True,noncoding=False):
+        IntervalList.__init__(self, iterGenePred(fh,getgenes,interval,overlap,flank,combine,noncoding), source='GenePred')
+
+'''parses BED line (returns chrom, chromStart, chromEnd, name, strand and if named, None for comments)'''
+def parseBED(line):
+    if line.startswith("#"):
+        return None
+    f = line.split()
+    try:
+        chromStart, chromEnd = int(f[1]), int(f[2])
+        assert chromStart <= chromEnd  # make sure its on the forward genomic strand
+        if len(f) > 5:  # name/strand
+            return f[0], chromStart, chromEnd, f[3], -1 if f[5].startswith('-') else 1, True
+        elif len(f) > 3:  # name
+            return f[0], chromStart, chromEnd, f[3], 0, True
+        else:  # automatic naming
+            return f[0], chromStart, chromEnd, '{}:{}-{}'.format(f[0], chromStart, chromEnd), 0, False
+    except:
+        print >> sys.stderr, f
+        raise
+
+'''counts interval names in BED (to number duplicate names when streaming, first of two passes so input must be re-readable)'''
+def bedNames(fh):
+    names = Counter()
+    for line in fh:
+        fields = parseBED(line)
+        if fields:
+            names[fields[3]] += 1
+    return names
+
+'''BED reader with segment numbering (of duplicate names counted by bedNames on separate pass) and tiling (in chunks of lines)'''
+def iterBED(fh,interval=None,overlap=None,flank=0,names=None,chunksize=10000):
+    from .intervalarray import IntervalArray  # numpy
+    numbered = Counter()
+    for lines in chunks(fh,chunksize):
+        rows = [ fields for fields in map(parseBED,lines) if fields ]
+        if not rows:
+            continue
+        chrom, chromStart, chromEnd, name, strand, named = zip(*rows)
         # suffix interval names if necessary
-        for ivs in intervalindex.values():
-            if len(ivs)>1:
-                for i,iv in enumerate(ivs):
-                    iv.name += '-{:02d}'.format(i+1)
-        # split interval if necessary
-        for ivs in intervalindex.values():
-            for iv in ivs:
-                if interval and overlap and interval < len(iv):
-                    self += iv.tile(interval,overlap,len(f)>3)  # name with suffix if named interval
-                else:
-                    self += [ iv ]
-        # add flanks
-        for e in self:
-            e.extend(flank)
-        return
+        name = list(name)
+        if names:
+            for i, n in enumerate(name):
+                if names[n] > 1:
+                    numbered[n] += 1
+                    name[i] += '-{:02d}'.format(numbered[n])
+        # split interval if necessary and add flanks
+        intervals = IntervalArray(chrom,chromStart,chromEnd,name,strand)
+        if interval and overlap:
+            intervals = intervals.tile(interval,overlap,named)  # name with suffix if named interval
+        for e in intervals.extend(flank).intervals():
+            yield e
+
+'''bed parser with automatic segment numbering and tiling'''
+class BED(IntervalList):
+    def __init__(self,fh,interval=None,overlap=None,flank=0):
+        lines = list(fh)
+        IntervalList.__init__(self, iterBED(lines,interval,overlap,flank,bedNames(lines)), source='BED')
+
+'''VCF reader (header lines are appended to header if given)'''
+def iterVCF(fh,interval=None,overlap=None,flank=0,header=None):
+    for line in fh:
+        if line.startswith("#") or len(line.rstrip())==0:
+            if header is not None:
+                header.append(line)
+        else:
+            f = line.split()
+            iv = Interval(f[0],int(f[1]),int(f[1])+max(map(len,[f[3]]+f[4].split(','))),name=f[2] if f[2]!='.' else None)
+            yield iv.extend(flank)
 
 '''vcf parser with segment hashing and tiling'''
 class VCF(IntervalList):  # no interval tiling as a variant has to be sequenced in onse single run
     def __init__(self,fh,interval=None,overlap=None,flank=0):
-        IntervalList.__init__(self, [], source='VCF')
         self.header = []
+        IntervalList.__init__(self, iterVCF(fh,interval,overlap,flank,self.header), source='VCF')
         self.samples = None
-        for line in fh:
-            if line.startswith("#") or len(line.rstrip())==0:
-                self.header.append(line)
-                if line.startswith("#CHROM"):
-                    self.samples = line[1:].split()[9:]  # sample header
-            else:
-                f = line.split()
-                iv = Interval(f[0],int(f[1]),int(f[1])+max(map(len,[f[3]]+f[4].split(','))),name=f[2] if f[2]!='.' else None)
-                self.append(iv)
-        # add flanks and name
-        for e in self:
-            e.extend(flank)
-        return
+        for line in self.header:
+            if line.startswith("#CHROM"):
+                self.samples = line[1:].split()[9:]  # sample header
+
+'''returns variant location and name from SNPpy row (column -> value)'''
+def snppyVariant(row):
+    chrom = row['chromosome'][3:] if row['chromosome'].startswith('chr') else row['chromosome']
+    # parse variant name
+    variantDescription = [ row['geneID'] ]
+    if '-' in row['position']:  # interval (gene,chrom,exon,hgvs/pos,zyg)
+        chromStart, chromEnd = map(int,row['position'].split('-'))
+        variantDescription += [ row['chromosome'] ]
+    else:  # variant (gene,tx,exon,hgvs/pos,zyg)
+        if 'HGVS_c' in row.keys():
+            chromStart, chromEnd = int(row['position']), int(row['position'])+hgvsLength(row['HGVS_c'])
+        elif 'ALT' in row.keys() and 'REF' in row.keys():
+            chromStart, chromEnd = int(row['position']), int(row['position'])+max(map(len,[row['REF'],row['ALT']]))
+        else:
+            raise Exception('UnkownVariantLength')
+        if 'transcriptID' in row.keys():
+            variantDescription += [ row['transcriptID'] ]
+    if 'rank' in row.keys() and '/' in row['rank']:
+        variantDescription += [ 'exon'+row['rank'].split('/')[0] ] # exonnumber
+    variantDescription += [ row['HGVS_c'] if 'HGVS_c' in row.keys() and row['HGVS_c'] else row['position'] ]  # HGVS
+    variantDescription += [ ':'.join([ row[k] for k in sorted(row.keys()) if k.startswith('GT') ]) ]  # zygosity
+    return chrom, chromStart, chromEnd, quote(','.join(variantDescription))
 
 '''SNPpy result reader'''
 class SNPpy(IntervalList):
@@ -211,26 +303,8 @@ class SNPpy(IntervalList):
                             self.data[k].append(v)
                         except:
                             raise Exception('UnknownColumn')
-                    chrom = row['chromosome'][3:] if row['chromosome'].startswith('chr') else row['chromosome']
-                    # parse variant name
-                    variantDescription = [ row['geneID'] ]
-                    if '-' in row['position']:  # interval (gene,chrom,exon,hgvs/pos,zyg)
-                        chromStart, chromEnd = map(int,row['position'].split('-'))
-                        variantDescription += [ row['chromosome'] ]
-                    else:  # variant (gene,tx,exon,hgvs/pos,zyg)
-                        if 'HGVS_c' in row.keys():
-                            chromStart, chromEnd = int(row['position']), int(row['position'])+hgvsLength(row['HGVS_c'])
-                        elif 'ALT' in row.keys() and 'REF' in row.keys():
-                            chromStart, chromEnd = int(row['position']), int(row['position'])+max(map(len,[row['REF'],row['ALT']]))
-                        else:
-                            raise Exception('UnkownVariantLength')
-                        if 'transcriptID' in row.keys():
-                            variantDescription += [ row['transcriptID'] ]
-                    if 'rank' in row.keys() and '/' in row['rank']:
-                        variantDescription += [ 'exon'+row['rank'].split('/')[0] ] # exonnumber
-                    variantDescription += [ row['HGVS_c'] if 'HGVS_c' in row.keys() and row['HGVS_c'] else row['position'] ]  # HGVS
-                    variantDescription += [ ':'.join([ row[k] for k in sorted(row.keys()) if k.startswith('GT') ]) ]  # zygosity
-                    iv = Interval(chrom,chromStart,chromEnd,name=quote(','.join(variantDescription)),sample=row['sampleID'])
+                    chrom, chromStart, chromEnd, name = snppyVariant(row)
+                    iv = Interval(chrom,chromStart,chromEnd,name=name,sample=row['sampleID'])
                 except:
                     print >> sys.stderr, line
                     print >> sys.stderr, row
@@ -242,6 +316,59 @@ class SNPpy(IntervalList):
             e.extend(flank)
         return
 
+'''columnar SNPpy reader (variant columns only, coordinates as arrays, interned sample/gene/chromosome, rows grouped by sample)'''
+class SNPpyTable(object):
+    columns = ['chromosome','position','geneID','HGVS_c','REF','ALT','transcriptID','rank','sampleID']  # and genotypes (GT*)
+
+    def __init__(self,fh,flank=0,delim='\t'):
+        self.flank = flank
+        self.chrom, self.sample, self.gene, self.name = [], [], [], []
+        self.chromStart, self.chromEnd = array('l'), array('l')
+        self.order = array('l')  # row indices by sample
+        self.slices = {}  # sample -> (start, stop) in order
+        columns = []  # (column, index)
+        commentcount = 0
+        for i, line in enumerate(fh):
+            if line.startswith('#'):
+                commentcount += 1
+            elif i-commentcount == 0:
+                header = line.rstrip().split(delim)
+                columns = [ (h, j) for j, h in enumerate(header) if h in self.columns or h.startswith('GT') ]
+            else:
+                try:
+                    f = line.rstrip().split(delim)
+                    row = { h: f[j] for h, j in columns if j < len(f) }
+                    chrom, chromStart, chromEnd, name = snppyVariant(row)
+                except:
+                    print >> sys.stderr, line
+                    raise
+                self.chrom.append(intern(chrom))
+                self.chromStart.append(chromStart)
+                self.chromEnd.append(chromEnd)
+                self.name.append(name)
+                self.sample.append(intern(row['sampleID']))
+                self.gene.append(intern(row['geneID']))
+        # group rows by sample (keeps file order within sample)
+        self.order.extend(sorted(xrange(len(self.sample)), key=self.sample.__getitem__))
+        for j, i in enumerate(self.order):
+            start, stop = self.slices.get(self.sample[i], (j, j))
+            self.slices[self.sample[i]] = (start, j+1)
+
+    def __len__(self):
+        return len(self.name)
+
+    def samples(self):
+        return sorted(self.slices.keys())
+
+    def genes(self):
+        return sorted(set(self.gene))
+
+    def intervals(self,sample):
+        '''returns flanked variant intervals of sample'''
+        start, stop = self.slices[sample]
+        return IntervalList([ Interval(self.chrom[i],self.chromStart[i],self.chromEnd[i],name=self.name[i],sample=sample).extend(self.flank) \
+            for i in self.order[start:stop] ],source='SNPpy')
+
 '''generic data class with formatted output'''
 class Data(object):
     def __init__(self,data,header):
@@ -274,25 +401,38 @@ class Data(object):
                 fh.close()
 
 
-''' read target intervals from VCF, BED or directly'''
-def readTargets(targets,tiling):
+''' read target intervals from VCF, BED (optionally gzip/bgzip compressed and restricted to tabix region) or directly'''
+def iterTargets(targets,tiling,region=None):
+    if os.path.exists(targets) and not os.path.isfile(targets):
+        # BED files are opened twice (numbering of duplicate names)
+        print >> sys.stderr, "ERROR: Targets must be a regular file, not a pipe or device (%s)" % targets
+        raise Exception('NotRegularFile')
     if os.path.isfile(targets):
-        with open(targets) as fh:
-            if targets.endswith('vcf'):  # VCF files (strand 0)
-                intervals = VCF(fh,**tiling)
-            elif targets.endswith('bed'):  # BED files (BED3 with automatic names)
-                intervals = BED(fh,**tiling)
-            elif targets.endswith('txt') or targets.lower().endswith('genepred'):  # GenePred files (uses gene name if unique)
-                intervals = GenePred(fh,**tiling)
+        fileformat = targetFormat(targets)
+        names = None
+        if fileformat == 'bed':  # first pass to number duplicate names
+            with openTargets(targets,region) as fh:
+                names = bedNames(fh)
+        with openTargets(targets,region) as fh:
+            if fileformat == 'vcf':
+                intervals = iterVCF(fh,**tiling)
+            elif fileformat == 'bed':
+                intervals = iterBED(fh,names=names,**tiling)
             else:
-                raise Exception('UnknownFileExtension')
+                intervals = iterGenePred(fh,**tiling)
+            for iv in intervals:
+                yield iv
     elif re.match('\w+:\d+-\d+',targets):  # single interval, no tiling
         m = re.match('(\w+):(\d+)-(\d+):?([+-])?',targets)
         rev = None if m.group(4) is None else True if m.group(4) == '-' else False
-        intervals = [ Interval(m.group(1),m.group(2),m.group(3),reverse=rev) ]
+        yield Interval(m.group(1),m.group(2),m.group(3),reverse=rev)
     else:
         raise Exception('FileNotFound')
-    return intervals
+
+''' read all target intervals from VCF, BED or directly'''
+def readTargets(targets,tiling,region=None):
+    source = { 'vcf': 'VCF', 'bed': 'BED', 'genepred': 'GenePred' }[targetFormat(targets)] if os.path.isfile(targets) else None
+    return IntervalList(iterTargets(targets,tiling,region), source=source)
 
 
 '''readBatch: read file from SNPpy result output'''
@@ -303,17 +443,10 @@ def readBatch(fi,tiling):
         print >> sys.stderr, "ERROR: Not a readable file (%s)" % fi
         raise
     with open(fi) as fh:
-        intervals = SNPpy(fh,flank=tiling['flank'])
-    sampleVariants = {}
-    for iv in intervals:
-        try:
-            sampleVariants[iv.sample].append(iv)
-        except KeyError:
-            sampleVariants[iv.sample] = IntervalList([iv],source='SNPpy')
-        except:
-            raise
+        table = SNPpyTable(fh,flank=tiling['flank'])
+    sampleVariants = { sample: table.intervals(sample) for sample in table.samples() }
     # extract gene names
-    return sampleVariants, sorted(list(set(intervals.data['geneID'])))
+    return sampleVariants, table.genes()
 
 
 '''return length of variant from hgvs.c notation'''
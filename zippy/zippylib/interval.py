@@ -10,8 +10,14 @@ __status__ = "Production"
 
 import sys
 from math import ceil
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 
+'''genomic interval (identified by location and name)'''
 class Interval(object):
+    __slots__ = ('chrom', 'chromStart', 'chromEnd', 'name', 'strand', 'sample', '_subintervals', '_key')
+    keyfields = frozenset(['chrom', 'chromStart', 'chromEnd', 'name'])
+
     def __init__(self,chrom,chromStart,chromEnd,name=None,reverse=None,sample=None):
         self.chrom = chrom
         self.chromStart = int(chromStart)
@@ -20,9 +26,37 @@ class Interval(object):
         self.name = name if name else chrom+':'+str(chromStart)+'-'+str(chromEnd)
         self.strand = 0 if reverse is None else -1 if reverse else 1
         self.sample = sample
-        self.subintervals = IntervalList([])
+        self._subintervals = None  # created when used
         return
 
+    def __setattr__(self,attr,value):
+        object.__setattr__(self, attr, value)
+        if attr in Interval.keyfields:
+            object.__setattr__(self, '_key', None)  # location or name changed
+
+    def __getstate__(self):
+        return (self.chrom, self.chromStart, self.chromEnd, self.name, self.strand, self.sample, self._subintervals)
+
+    def __setstate__(self,state):
+        for k, v in zip(Interval.__slots__, state + (None,)):
+            object.__setattr__(self, k, v)
+
+    @property
+    def subintervals(self):
+        if self._subintervals is None:
+            self._subintervals = IntervalList([])
+        return self._subintervals
+
+    @subintervals.setter
+    def subintervals(self,subintervals):
+        self._subintervals = subintervals
+
+    def key(self):
+        '''identity key ((chrom, chromStart, chromEnd), name), cached until changed'''
+        if self._key is None:
+            object.__setattr__(self, '_key', ((self.chrom, self.chromStart, self.chromEnd), self.name))
+        return self._key
+
     def midpoint(self):
         return int(self.chromStart + (self.chromEnd - self.chromStart)/2.0)
 
@@ -31,16 +65,19 @@ class Interval(object):
         return ( self.chrom, self.chromStart, self.chromEnd )
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self._key or self.key())
 
     def __len__(self):
         return self.chromEnd - self.chromStart
 
     def __eq__(self,other):
-        return hash(self) == hash(other)
+        return isinstance(other, Interval) and (self._key or self.key()) == (other._key or other.key())
+
+    def __ne__(self,other):
+        return not self == other
 
     def __lt__(self,other):
-        return (self.chrom, self.chromStart, self.chromEnd) < (other.chrom, other.chromStart, other.chromEnd)
+        return (self._key or self.key())[0] < (other._key or other.key())[0]
 
     def __repr__(self):
         return "<Interval ("+self.name+") "+self.chrom+":"+str(self.chromStart)+'-'+str(self.chromEnd)+ \
@@ -115,3 +152,46 @@ class IntervalList(list):
 
     def __repr__(self):
         return "<IntervalList (%s) %d elements> " % (self.source, len(self))
+
+    def intersect(self, other):
+        '''returns intervals overlapping any interval in other (bookended included)'''
+        index = IntervalIndex(other)
+        return IntervalList([ iv for iv in self if index.overlaps(iv) ], source=self.source)
+
+    def cluster(self, distance, maxlength):
+        '''returns intervals with members (subintervals) less than distance apart, spanning at most maxlength'''
+        clusters = []
+        for iv in sorted(self):
+            last = clusters[-1] if clusters else None
+            if last and last.chrom == iv.chrom and iv.chromStart - last.chromEnd <= distance and \
+                max(last.chromEnd, iv.chromEnd) - last.chromStart <= maxlength:
+                last.chromEnd = max(last.chromEnd, iv.chromEnd)
+                last.name = last.name + '_' + iv.name
+                last.subintervals.append(iv)
+            else:
+                clusters.append(Interval(iv.chrom, iv.chromStart, iv.chromEnd, iv.name))
+                clusters[-1].subintervals.append(iv)
+        return IntervalList(clusters, source=self.source)
+
+'''overlap index (intervals sorted by start per chromosome, searched within longest interval)'''
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        self.starts = defaultdict(list)  # chrom -> sorted start positions
+        self.intervals = defaultdict(list)  # chrom -> intervals in start order
+        self.maxlength = defaultdict(int)  # chrom -> longest interval
+        for iv in sorted(intervals, key=lambda x: (x.chrom, x.chromStart)):
+            self.starts[iv.chrom].append(iv.chromStart)
+            self.intervals[iv.chrom].append(iv)
+            self.maxlength[iv.chrom] = max(self.maxlength[iv.chrom], len(iv))
+
+    def overlapping(self, iv):
+        '''returns intervals overlapping iv (bookended included)'''
+        if iv.chrom not in self.starts:
+            return []
+        starts = self.starts[iv.chrom]
+        first = bisect_left(starts, iv.chromStart - self.maxlength[iv.chrom])
+        last = bisect_right(starts, iv.chromEnd)
+        return [ x for x in self.intervals[iv.chrom][first:last] if x.chromEnd >= iv.chromStart ]
+
+    def overlaps(self, iv):
+        return len(self.overlapping(iv)) > 0
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+__doc__=="""Interval arrays (columns as NumPy arrays for bulk tiling, flanking and merging)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import numpy as np
+from .interval import Interval, IntervalList
+
+'''intervals as columns (chromosome codes, starts, ends, strands, names and samples)'''
+class IntervalArray(object):
+    def __init__(self,chrom,chromStart,chromEnd,name=None,strand=None,sample=None):
+        self.chromosomes = sorted(set(chrom))  # code -> chromosome (codes sort like names)
+        codes = { c: i for i, c in enumerate(self.chromosomes) }
+        self._set(np.array([ codes[c] for c in chrom ], dtype=np.int32), chromStart, chromEnd, name, strand, sample)
+
+    def _set(self,chrom,chromStart,chromEnd,name,strand,sample):
+        self.chrom = chrom
+        self.chromStart = np.array(chromStart, dtype=np.int64)
+        self.chromEnd = np.array(chromEnd, dtype=np.int64)
+        assert (self.chromStart <= self.chromEnd).all()  # make sure its on the forward genomic strand
+        self.strand = np.zeros(len(chrom), dtype=np.int8) if strand is None else np.array(strand, dtype=np.int8)
+        self.name = objects(name, len(chrom))
+        for j in np.flatnonzero(np.equal(self.name, None) | np.equal(self.name, '')).tolist():  # automatic naming
+            self.name[j] = '{}:{}-{}'.format(self.chromosomes[chrom[j]], self.chromStart[j], self.chromEnd[j])
+        self.sample = objects(sample, len(chrom))
+
+    def _new(self,chrom,chromStart,chromEnd,name,strand,sample):
+        '''returns IntervalArray with same chromosome codes'''
+        new = IntervalArray.__new__(IntervalArray)
+        new.chromosomes = self.chromosomes
+        new._set(chrom, chromStart, chromEnd, name, strand, sample)
+        return new
+
+    def __len__(self):
+        return len(self.chrom)
+
+    def __repr__(self):
+        return "<IntervalArray %d elements>" % len(self)
+
+    def __getitem__(self,index):
+        '''returns intervals selected by index array (or boolean mask)'''
+        return self._new(self.chrom[index], self.chromStart[index], self.chromEnd[index], \
+            self.name[index], self.strand[index], self.sample[index])
+
+    def chromnames(self):
+        return [ self.chromosomes[c] for c in self.chrom ]
+
+    def lengths(self):
+        return self.chromEnd - self.chromStart
+
+    def intervals(self,source=None):
+        '''returns IntervalList (strand and sample preserved)'''
+        return IntervalList([ Interval(c, s, e, n, None if d == 0 else d < 0, sample) for c, s, e, n, d, sample in \
+            zip(self.chromnames(), self.chromStart.tolist(), self.chromEnd.tolist(), self.name.tolist(), self.strand.tolist(), self.sample.tolist()) ], source=source)
+
+    def extend(self,flank):
+        '''adds flanks (clipped at chromosome start)'''
+        self.chromStart = np.where(flank <= self.chromStart, self.chromStart - flank, 0)
+        self.chromEnd = self.chromEnd + flank
+        return self
+
+    def order(self):
+        '''returns index sorting by chromosome, start and end'''
+        return np.lexsort((self.chromEnd, self.chromStart, self.chrom))
+
+    def sort(self):
+        return self[self.order()]
+
+    def tile(self,i,o,suffix=True):  # interval, overlap
+        '''splits intervals longer than i into tiles overlapping by o (as Interval.tile, suffix can be given per interval)'''
+        length = self.lengths()
+        split = np.flatnonzero(length > i)
+        # tile number and size (as Interval.tile)
+        splitintervals = np.ceil((length[split] - o) / float(i - o)).astype(np.int64)
+        optimalsize = np.ceil((length[split] + splitintervals*o - o) / splitintervals.astype(np.float64)).astype(np.int64)
+        step = optimalsize - o
+        counts = np.ones(len(self), dtype=np.int64)
+        counts[split] = np.maximum(0, -((optimalsize - length[split]) // step)) + 1  # last tile reaches end
+        # tile coordinates
+        source = np.repeat(np.arange(len(self)), counts)
+        n = np.arange(len(source)) - np.repeat(np.cumsum(counts) - counts, counts)
+        tiled = counts[source] > 1
+        size = np.zeros(len(self), dtype=np.int64)
+        size[split] = optimalsize
+        stepsize = np.zeros(len(self), dtype=np.int64)
+        stepsize[split] = step
+        chromStart = self.chromStart[source] + n * stepsize[source]
+        chromEnd = np.where(tiled, np.minimum(chromStart + size[source], self.chromEnd[source]), self.chromEnd[source])
+        tilenumber = np.where(self.strand[source] < 0, counts[source] - n, n + 1)
+        suffixed = (np.ones(len(self), dtype=bool) & suffix)[source]
+        names = self.name[source]
+        names[tiled & ~suffixed] = None  # automatic naming
+        named = np.flatnonzero(tiled & suffixed)
+        names[named] = [ n + '_' + str(t) for n, t in zip(names[named].tolist(), tilenumber[named].tolist()) ]
+        strand = np.where(tiled, np.where(self.strand[source] < 0, -1, 1), self.strand[source])
+        return self._new(self.chrom[source], chromStart, chromEnd, names, strand, self.sample[source])
+
+    def flatten(self):
+        '''merges overlapping and bookended intervals on same chromosome (sorted, names joined as in Interval.merge)'''
+        ordered = self.sort()
+        if not len(ordered):
+            return ordered
+        offset = ordered.chrom.astype(np.int64) << 40  # chromosomes do not overlap
+        reach = np.maximum.accumulate(ordered.chromEnd + offset)
+        first = np.ones(len(ordered), dtype=bool)
+        first[1:] = ordered.chromStart[1:] + offset[1:] > reach[:-1]
+        cluster = np.cumsum(first) - 1
+        chromStart = ordered.chromStart[first]
+        chromEnd = np.maximum.reduceat(ordered.chromEnd, np.flatnonzero(first))
+        names = []
+        for j, name in zip(cluster.tolist(), ordered.name.tolist()):
+            if j == len(names):
+                names.append(name)
+            elif name != names[j]:
+                names[j] += '_' + name
+        return self._new(ordered.chrom[first], chromStart, chromEnd, names, ordered.strand[first], ordered.sample[first])
+
+'''returns object array of values (or of None)'''
+def objects(values,length):
+    array = np.empty(length, dtype=object)
+    if values is not None:
+        array[:] = values if isinstance(values, np.ndarray) else list(values)
+    return array
+
+'''returns IntervalArray of intervals'''
+def intervalArray(intervals):
+    intervals = list(intervals)
+    return IntervalArray([ iv.chrom for iv in intervals ], [ iv.chromStart for iv in intervals ], [ iv.chromEnd for iv in intervals ], \
+        [ iv.name for iv in intervals ], [ iv.strand for iv in intervals ], [ iv.sample for iv in intervals ])
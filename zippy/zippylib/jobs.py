@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+__doc__=="""Background job queue (SQLite backed, no broker required)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import sys
+import os
+import time
+import json
+import uuid
+import signal
+import sqlite3
+import datetime
+import traceback
+import cPickle as pickle
+import multiprocessing
+from contextlib import contextmanager
+from . import ascii_encode_dict, addProgressSink, removeProgressSink
+from .metrics import metrics, saveSnapshot
+
+'''job queue (jobs are claimed atomically by worker processes)'''
+class JobQueue(object):
+    def __init__(self, database, timeout=30.0):
+        self.sqlite = database
+        self.timeout = timeout
+        with self.connection() as cursor:
+            cursor.execute('''CREATE TABLE IF NOT EXISTS job(
+                id TEXT PRIMARY KEY, kind TEXT, spec TEXT, cwd TEXT,
+                status TEXT, progress REAL, message TEXT, result BLOB,
+                worker INT, submitted TEXT, started TEXT, finished TEXT, key TEXT);''')
+            # add content key to job tables of previous version
+            cursor.execute('''PRAGMA table_info(job);''')
+            if 'key' not in [ row[1] for row in cursor.fetchall() ]:
+                cursor.execute('''ALTER TABLE job ADD COLUMN key TEXT;''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS job_status
+                ON job(status, submitted);''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS job_key
+                ON job(key, status);''')
+        return
+
+    def __str__(self):
+        return '<JobQueue at %s>' % self.sqlite
+
+    @contextmanager
+    def connection(self):
+        '''write transaction (connection per call, safe across worker forks)'''
+        db = sqlite3.connect(self.sqlite, timeout=self.timeout, isolation_level=None)
+        try:
+            cursor = db.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+        finally:
+            db.close()
+
+    def events(self, jobid):
+        '''progress event file of job (JSON lines)'''
+        return os.path.join(self.sqlite+'.events', jobid+'.json')
+
+    def metrics(self):
+        '''metrics snapshot directory of workers'''
+        return self.sqlite+'.metrics'
+
+    def counts(self):
+        '''returns number of jobs by status'''
+        db = sqlite3.connect(self.sqlite, timeout=self.timeout)
+        try:
+            return dict(db.execute('''SELECT status, count(*) FROM job GROUP BY status;''').fetchall())
+        finally:
+            db.close()
+
+    def submit(self, kind, spec, cwd=None, key=None):
+        '''queues job and returns job id (id of queued or running job with same content key)'''
+        with self.connection() as cursor:
+            if key:
+                cursor.execute('''SELECT id FROM job WHERE key = ? AND status IN ('queued','running')
+                    ORDER BY submitted LIMIT 1;''', (key,))
+                row = cursor.fetchone()
+                if row:
+                    return row[0]
+            jobid = uuid.uuid4().hex
+            cursor.execute('''INSERT INTO job(id,kind,spec,cwd,status,progress,submitted,key)
+                VALUES(?,?,?,?,?,?,?,?)''', (jobid, kind, json.dumps(spec), \
+                cwd if cwd else os.getcwd(), 'queued', 0.0, str(datetime.datetime.now()), key))
+        return jobid
+
+    def claim(self):
+        '''claims oldest queued job (None if queue is empty)'''
+        with self.connection() as cursor:
+            cursor.execute('''SELECT id FROM job WHERE status = 'queued'
+                ORDER BY submitted LIMIT 1;''')
+            row = cursor.fetchone()
+            if not row:
+                return None
+            cursor.execute('''UPDATE job SET status = 'running', worker = ?, started = ?
+                WHERE id = ?;''', (os.getpid(), str(datetime.datetime.now()), row[0]))
+        return self.get(row[0])
+
+    def progress(self, jobid, progress, message=None):
+        with self.connection() as cursor:
+            cursor.execute('''UPDATE job SET progress = ?, message = coalesce(?, message)
+                WHERE id = ?;''', (progress, message, jobid))
+
+    def finish(self, jobid, result):
+        with self.connection() as cursor:
+            cursor.execute('''UPDATE job SET status = 'done', progress = 1.0, result = ?, finished = ?
+                WHERE id = ?;''', (sqlite3.Binary(pickle.dumps(result, 2)), str(datetime.datetime.now()), jobid))
+
+    def fail(self, jobid, message):
+        with self.connection() as cursor:
+            cursor.execute('''UPDATE job SET status = 'failed', message = ?, finished = ?
+                WHERE id = ?;''', (message, str(datetime.datetime.now()), jobid))
+
+    def recover(self):
+        '''requeues running jobs of dead workers'''
+        requeued = []
+        with self.connection() as cursor:
+            cursor.execute('''SELECT id, worker FROM job WHERE status = 'running';''')
+            for jobid, worker in cursor.fetchall():
+                try:
+                    os.kill(worker, 0)
+                except OSError:
+                    cursor.execute('''UPDATE job SET status = 'queued', worker = NULL, started = NULL
+                        WHERE id = ?;''', (jobid,))
+                    requeued.append(jobid)
+        return requeued
+
+    def get(self, jobid):
+        '''returns job as dictionary (None if unknown)'''
+        db = sqlite3.connect(self.sqlite, timeout=self.timeout)
+        try:
+            db.row_factory = sqlite3.Row
+            row = db.execute('''SELECT * FROM job WHERE id = ?;''', (jobid,)).fetchone()
+        finally:
+            db.close()
+        if not row:
+            return None
+        job = dict(zip(row.keys(), row))
+        job['spec'] = json.loads(job['spec'], object_hook=ascii_encode_dict)
+        job['result'] = pickle.loads(str(job['result'])) if job['result'] is not None else None
+        return job
+
+'''writes progress events of running job to event file (and throttled to queue)'''
+class JobProgress(object):
+    def __init__(self, queue, jobid, interval=5.0):
+        self.queue = queue
+        self.jobid = jobid
+        self.interval = interval  # minimum time between queue updates (seconds)
+        self.last = 0
+        if not os.path.isdir(os.path.dirname(queue.events(jobid))):
+            try:
+                os.makedirs(os.path.dirname(queue.events(jobid)))
+            except OSError:
+                pass  # created by other worker
+        self.fh = open(queue.events(jobid), 'a')
+
+    def __call__(self, event):
+        print >> self.fh, json.dumps(event)
+        self.fh.flush()
+        if event['done'] >= event['total'] or time.time()-self.last >= self.interval:
+            self.last = time.time()
+            self.queue.progress(self.jobid, event['done']/float(event['total']) if event['total'] else 1.0, \
+                '{stage} {done}/{total}'.format(**event))
+
+    def close(self, status):
+        print >> self.fh, json.dumps({ 'status': status, 'time': time.time() })
+        self.fh.close()
+
+'''runs jobs from queue with handlers (kind -> function(spec))'''
+def work(queue, handlers, poll=1.0):
+    home = os.getcwd()
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll)
+            continue
+        print >> sys.stderr, 'Running {} job {}'.format(job['kind'], job['id'])
+        progress = JobProgress(queue, job['id'])
+        addProgressSink(progress)
+        try:
+            os.chdir(job['cwd'])  # relative paths as in submitting process
+            with metrics.timer('zippy_job_seconds', kind=job['kind']):
+                result = handlers[job['kind']](job['spec'])
+        except Exception as e:
+            print >> sys.stderr, traceback.format_exc()
+            queue.fail(job['id'], '{}: {}'.format(type(e).__name__, e))
+            progress.close('failed')
+        else:
+            queue.finish(job['id'], result)
+            progress.close('done')
+        finally:
+            removeProgressSink(progress)
+            os.chdir(home)
+            saveMetrics(queue)
+
+'''writes metrics snapshot of worker process (exported by webservice)'''
+def saveMetrics(queue):
+    try:
+        saveSnapshot(queue.metrics())
+    except OSError:
+        print >> sys.stderr, 'WARNING: could not write metrics to {}'.format(queue.metrics())
+
+'''starts worker pool and restarts dead workers'''
+def workerPool(queue, handlers, workers=2, poll=1.0):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # stop workers on service shutdown
+    queue.recover()
+    pool = []
+    try:
+        while True:
+            for p in [ p for p in pool if not p.is_alive() ]:
+                print >> sys.stderr, 'WARNING: worker {} exited ({})'.format(p.pid, p.exitcode)
+                pool.remove(p)
+                queue.recover()
+            while len(pool) < workers:
+                p = multiprocessing.Process(target=work, args=(queue, handlers, poll))
+                p.daemon = True
+                p.start()
+                pool.append(p)
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in pool:
+            os.kill(p.pid, signal.SIGTERM)
+            p.join()
+        queue.recover()  # requeue interrupted jobs
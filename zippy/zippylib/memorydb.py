@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+__doc__=="""In-memory primer database (tests and benchmarks)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import sys
+import datetime
+from bisect import bisect_left, bisect_right, insort
+from itertools import groupby
+from collections import defaultdict
+from .store import PrimerStore, changeConflictingName, datematch
+
+'''In-memory primer database with indexed dictionaries and sorted interval arrays'''
+class MemoryDB(PrimerStore):
+    def __init__(self, dump=None):
+        PrimerStore.__init__(self, dump)
+        self.primers = {}  # name -> [name, seq, tag, tm, gc, vessel, well, dateadded]
+        self.seqtags = defaultdict(set)  # (seq,tag) -> primer names
+        self.locations = {}  # (vessel,well) -> primer name
+        self.targets = set()  # (seq,chrom,position,reverse) mapping loci
+        self.pairs = {}  # pairid -> [pairid, uniqueid, left, right, chrom, start, end, dateadded]
+        self.uniqueids = defaultdict(set)  # uniqueid -> pairids
+        self.amplicons = defaultdict(list)  # chrom -> sorted (start, end, pairid)
+        self.maxlength = defaultdict(int)  # chrom -> longest amplicon (bounds interval scans)
+        self.blacklisted = {}  # uniqueid -> blacklistdate
+        self.changes = 0  # database version
+
+    def __str__(self):
+        return '<ZippyDB in memory>'
+
+    def _pairRow(self, pairid, midpoint=None):
+        p = self.pairs[pairid]
+        l = self.primers.get(p[2], [None]*8)
+        r = self.primers.get(p[3], [None]*8)
+        distance = abs(p[5]+((p[6]-p[5])//2) - midpoint) if midpoint is not None else 0
+        return (p[0], l[2], r[2], l[1], r[1], p[2], p[3], p[4], p[5], p[6], l[5], l[6], r[5], r[6], distance)
+
+    def _removePair(self, pairid):
+        p = self.pairs.pop(pairid)
+        self.uniqueids[p[1]].discard(pairid)
+        amplicons = self.amplicons[p[4]]
+        del amplicons[bisect_left(amplicons, (p[5], p[6], pairid))]
+
+    def _setLocation(self, name, vessel, well):
+        primer = self.primers[name]
+        if primer[5] is not None and primer[6] is not None:
+            del self.locations[(primer[5], primer[6])]
+        primer[5], primer[6] = vessel, well
+        if vessel is not None and well is not None:
+            self.locations[(vessel, well)] = name
+
+    def version(self, primary=False):
+        return self.changes
+
+    def pairTable(self):
+        return [ tuple(p[:2]) + (p[2], self.primers[p[2]][1] if p[2] in self.primers else None,
+            p[3], self.primers[p[3]][1] if p[3] in self.primers else None) + tuple(p[4:]) \
+            for p in self.pairs.values() ]
+
+    def queryRows(self, query):
+        if datematch.match(str(query)):  # query date
+            rows = [ self._pairRow(k) for k, p in self.pairs.items() if query in p[7] ]
+            return sorted(rows)
+        elif type(query) in [str,unicode]:  # use primerpair name (case insensitive like SQL LIKE)
+            rows = [ self._pairRow(k) for k in self.pairs.keys() if query.lower() in k.lower() ]
+            return sorted(rows)
+        else:  # is interval (amplicons starting between longest amplicon and query start)
+            midpoint = int(query.chromStart+int(query.chromEnd-query.chromStart)/2.0)
+            amplicons = self.amplicons[query.chrom]
+            first = bisect_left(amplicons, (query.chromEnd-self.maxlength[query.chrom],))
+            last = bisect_right(amplicons, (query.chromStart, sys.maxint))
+            rows = []
+            for start, end, pairid in amplicons[first:last]:
+                row = self._pairRow(pairid, midpoint)
+                if row[3] is None or row[4] is None:
+                    continue
+                if start + len(row[3]) <= query.chromStart and end - len(row[4]) >= query.chromEnd:
+                    rows.append(row)
+            return sorted(rows, key=lambda x: x[-1])  # ordered by midpoint distance
+
+    def dumpRows(self, what, **kwargs):
+        if what=='amplicons':
+            rows = set([ tuple(p[4:7]) + (p[0],) for p in self.pairs.values() ])
+            if 'size' in kwargs.keys() and len(kwargs['size'])==2:
+                rows = [ r for r in rows if r[2]-r[1] >= kwargs['size'][0] and r[2]-r[1] <= kwargs['size'][1] ]
+            return sorted(rows), ('chrom','chromStart','chromEnd','name')
+        elif what=='ordersheet':
+            rows = set()
+            for p in self.pairs.values():
+                for i, direction in [(2,'fwd'),(3,'rev')]:
+                    primer = self.primers.get(p[i], [None]*8)
+                    if primer[5] is None and primer[6] is None:
+                        rows.add((p[0], primer[0], primer[1], primer[2], direction))
+            return sorted(rows, key=lambda x: (x[0],x[4])), ['pairname','primername','sequence','seqtag','direction']
+        elif what=='locations':
+            rows = set([ (p[0], p[i], self.primers[p[i]][5], self.primers[p[i]][6]) \
+                for p in self.pairs.values() for i in [2,3] if p[i] in self.primers ])
+            return sorted(rows), ['pair','primer','vessel','well']
+        elif what=='table':
+            rows = set([ (p[i], p[0]) + tuple(self.primers[p[i]][k] for k in [2,1,5,6]) \
+                for p in self.pairs.values() for i in [2,3] if p[i] in self.primers ])
+            return sorted(rows, key=lambda x: x[1]), ['primername', 'primerset', 'tag', 'sequence', 'vessel', 'well']
+
+    def _insertPrimers(self, primers):
+        self.changes += 1
+        current_time = str(datetime.datetime.now())
+        for p in primers:
+            # store primers and modify names if necessary
+            originalName = p.name
+            while p.name in self.primers:
+                stored = self.primers[p.name]
+                if (stored[1], stored[2]) == (p.seq, p.tag):
+                    break  # identical primer
+                p.name = changeConflictingName(p.name)
+            else:
+                self.primers[p.name] = [p.name, p.seq, p.tag, p.tm, p.gc, None, None, current_time]
+                self.seqtags[(p.seq, p.tag)].add(p.name)
+            if originalName != p.name:
+                print >> sys.stderr, "WARNING: renamed primer {} -> {} in database".format(originalName, p.name)
+            # store mapping loci
+            for l in p.loci:
+                self.targets.add((p.seq, l.chrom, l.offset, l.reverse))
+
+    def addPrimer(self, *primers):
+        try:
+            self._insertPrimers(primers)
+        finally:
+            self.writeAmpliconDump()
+        return
+
+    def addPair(self, *pairs):
+        '''adds primer pairs (and individual primers)'''
+        try:
+            flat = []
+            for p in pairs:
+                flat.append(p[0])
+                flat.append(p[1])
+            self._insertPrimers(flat)
+            current_time = str(datetime.datetime.now())
+            for p in pairs:
+                p.fixName()  # changes name if there is a longer common name (catches primer renaming)
+                if p.name in self.pairs:
+                    continue
+                chrom = p[0].targetposition.chrom
+                start = p[0].targetposition.offset
+                end = p[1].targetposition.offset+p[1].targetposition.length
+                self.pairs[p.name] = [p.name, p.uniqueid(), p[0].name, p[1].name, chrom, start, end, current_time]
+                self.uniqueids[p.uniqueid()].add(p.name)
+                insort(self.amplicons[chrom], (start, end, p.name))
+                self.maxlength[chrom] = max(self.maxlength[chrom], end-start)
+        finally:
+            self.writeAmpliconDump()
+        return
+
+    '''show/update blacklist'''
+    def blacklist(self, add=None):
+        if add:
+            try:
+                self.changes += 1
+                blacklisttime = str(datetime.datetime.now())
+                pairlist = []
+                for uid in set([ self.pairs[add][1] ] if add in self.pairs else []):
+                    self.blacklisted.setdefault(uid, blacklisttime)
+                    pairlist += sorted(self.uniqueids[uid])
+                    for pairid in sorted(self.uniqueids[uid]):
+                        self._removePair(pairid)
+                return pairlist
+            finally:
+                self.writeAmpliconDump()
+        else:
+            return self.blacklisted.keys()
+
+    def removeOrphans(self):
+        self.changes += 1
+        try:
+            paired = set([ p[i] for p in self.pairs.values() for i in [2,3] ])
+            orphans = [ name for name in self.primers.keys() if name not in paired ]
+            for name in orphans:
+                self._setLocation(name, None, None)
+                primer = self.primers.pop(name)
+                self.seqtags[(primer[1], primer[2])].discard(name)
+            return orphans
+        finally:
+            self.writeAmpliconDump()
+
+    def getLocation(self, loc):
+        '''returns whats stored at location'''
+        return sorted(set([ name for (vessel, well), name in self.locations.items() \
+            if vessel == loc.vessel() and loc.well().lower() in well.lower() ]))
+
+    def addLocations(self, *locations):
+        '''updates location for a batch of primers'''
+        self.changes += 1
+        for primerid, loc in locations:
+            key = (loc.vessel(), loc.well())
+            if primerid in self.primers and (key not in self.locations or self.locations[key] == primerid):
+                self._setLocation(primerid, *key)
+        return
+
+    def storePrimer(self, primerid, loc, force=False):
+        '''updates the location in which primers are stored'''
+        self.changes += 1
+        key = (loc.vessel(), loc.well())
+        if key in self.locations and self.locations[key] != primerid:
+            if not force:
+                return False
+            self._setLocation(self.locations[key], None, None)  # reset storage location
+        if primerid not in self.primers:
+            return False
+        self._setLocation(primerid, *key)
+        return True
+
+    def updateName(self, primerName, newName):
+        '''changes the name of a primer stored in the database'''
+        self.changes += 1
+        try:
+            if newName == primerName:
+                return primerName in self.primers
+            if newName in self.primers or primerName not in self.primers:
+                return False
+            primer = self.primers.pop(primerName)
+            primer[0] = newName
+            self.primers[newName] = primer
+            self.seqtags[(primer[1], primer[2])].discard(primerName)
+            self.seqtags[(primer[1], primer[2])].add(newName)
+            if primer[5] is not None and primer[6] is not None:
+                self.locations[(primer[5], primer[6])] = newName
+            for p in self.pairs.values():
+                p[2] = newName if p[2] == primerName else p[2]
+                p[3] = newName if p[3] == primerName else p[3]
+            return True
+        finally:
+            self.writeAmpliconDump()
+
+    def updatePairName(self, pairName, newName):
+        '''changes the name of a primer pair stored in the database'''
+        self.changes += 1
+        try:
+            if newName == pairName:
+                return pairName in self.pairs
+            if newName in self.pairs or pairName not in self.pairs:
+                return False
+            pair = self.pairs[pairName]
+            self._removePair(pairName)
+            pair[0] = newName
+            self.pairs[newName] = pair
+            self.uniqueids[pair[1]].add(newName)
+            insort(self.amplicons[pair[4]], (pair[5], pair[6], newName))
+            return True
+        finally:
+            self.writeAmpliconDump()
+
+    def getRedundantPrimers(self):
+        '''returns redundant primer (same tag and sequence)'''
+        redundant = [ [ k[0], k[1], ','.join(sorted(v)) ] for k, v in sorted(self.seqtags.items()) if len(v) > 1 ]
+        return redundant, ['seq','tag','synonyms']
+
+    def mergeRedundantPrimers(self):
+        '''merges primers with same sequence and tag into canonical record'''
+        merged = []  # (merged primer, canonical primer)
+        self.changes += 1
+        try:
+            for k, names in sorted(self.seqtags.items()):
+                if len(names) < 2:
+                    continue
+                # canonical is stored primer or oldest record
+                synonyms = sorted([ self.primers[n] for n in names ], \
+                    key=lambda x: (x[5] is None or x[6] is None, x[7], x[0]))
+                canonical = synonyms[0]
+                for s in synonyms[1:]:
+                    # keep primers stored in a different location (separate tube)
+                    if s[5] is not None and s[6] is not None and (s[5],s[6]) != (canonical[5],canonical[6]):
+                        continue
+                    for p in self.pairs.values():
+                        p[2] = canonical[0] if p[2] == s[0] else p[2]
+                        p[3] = canonical[0] if p[3] == s[0] else p[3]
+                    self._setLocation(s[0], None, None)
+                    del self.primers[s[0]]
+                    names.discard(s[0])
+                    merged.append((s[0], canonical[0]))
+            return merged
+        finally:
+            self.writeAmpliconDump()
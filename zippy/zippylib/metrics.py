@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+__doc__=="""Process metrics (counters, gauges and timings in Prometheus text format)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import os
+import time
+import json
+import errno
+import fcntl
+import threading
+from contextlib import contextmanager
+
+'''metrics registry (one per process, merged from worker snapshots for export)'''
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.summaries = {}  # (name, labels) -> [count, sum]
+        self.savedto, self.savedat = None, 0  # last snapshot file of process
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''observes runtime of block in seconds (also if block raises)'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time()-start, **labels)
+
+    def hit(self, cache, hit):
+        self.inc('zippy_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def snapshot(self):
+        '''returns metrics as JSON serialisable dictionary'''
+        with self.lock:
+            return { kind: [ [ name, list(labels), value ] for (name, labels), value in getattr(self, kind).items() ] \
+                for kind in ['counters', 'gauges', 'summaries'] }
+
+    def merge(self, snapshot):
+        '''adds metrics snapshot (counters and summaries are summed, gauges replaced)'''
+        with self.lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                self.gauges[(name, tuple(map(tuple, labels)))] = value
+            for name, labels, value in snapshot['summaries']:
+                summary = self.summaries.setdefault((name, tuple(map(tuple, labels))), [0, 0.0])
+                summary[0] += value[0]
+                summary[1] += value[1]
+
+    def since(self, snapshot):
+        '''returns metrics added after snapshot (counter and summary differences, current gauges)'''
+        changes = Metrics()
+        changes.merge(self.snapshot())
+        with changes.lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                changes.counters[key] -= value
+                if not changes.counters[key]:
+                    del changes.counters[key]
+            for name, labels, value in snapshot['summaries']:
+                key = (name, tuple(map(tuple, labels)))
+                changes.summaries[key] = [ changes.summaries[key][0] - value[0], changes.summaries[key][1] - value[1] ]
+                if not changes.summaries[key][0]:
+                    del changes.summaries[key]
+        return changes
+
+    def save(self, filename):
+        '''writes snapshot atomically (read by metrics export of other processes)'''
+        with open(filename+'.tmp', 'w') as fh:
+            json.dump(self.snapshot(), fh)
+        os.rename(filename+'.tmp', filename)
+
+    def render(self):
+        '''returns metrics in Prometheus text exposition format'''
+        labelstring = lambda labels: '{'+','.join([ '{}="{}"'.format(k, str(v).replace('\\','\\\\').replace('"','\\"')) \
+            for k, v in labels ])+'}' if labels else ''
+        lines = []
+        with self.lock:
+            for kind, metrics in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted(set([ k[0] for k in metrics.keys() ])):
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append('{}{} {}'.format(name, labelstring(labels), repr(float(value))))
+            for name in sorted(set([ k[0] for k in self.summaries.keys() ])):
+                lines.append('# TYPE {} summary'.format(name))
+                for (n, labels), (count, total) in sorted(self.summaries.items()):
+                    if n == name:
+                        lines.append('{}_count{} {:d}'.format(name, labelstring(labels), count))
+                        lines.append('{}_sum{} {}'.format(name, labelstring(labels), repr(total)))
+        return '\n'.join(lines)+'\n'
+
+    def write(self, filename):
+        with open(filename, 'w') as fh:
+            fh.write(self.render())
+
+'''process metrics'''
+metrics = Metrics()
+
+'''checks if process is running'''
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+'''writes snapshot of process metrics to directory (file per process id, at most every interval seconds)'''
+def saveSnapshot(directory, interval=0):
+    if time.time() - metrics.savedat < interval:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, '{}.json'.format(os.getpid()))
+    if metrics.savedto != filename and os.path.exists(filename):
+        retireSnapshots(directory, [filename])  # left by exited process with same id
+    metrics.save(filename)
+    metrics.savedto, metrics.savedat = filename, time.time()
+
+'''adds counters and summaries of exited processes to retired totals (exported counters stay monotonic) and removes their snapshots'''
+def retireSnapshots(directory, filenames=None):
+    with open(os.path.join(directory, 'retired.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # released on close
+        if filenames is None:
+            filenames = [ os.path.join(directory, fi) for fi in sorted(os.listdir(directory)) \
+                if fi.endswith('.json') and fi[:-5].isdigit() and not alive(int(fi[:-5])) ]
+        if not filenames:
+            return []
+        retired = Metrics()
+        retiredfile = os.path.join(directory, 'retired.json')
+        for fi in [ retiredfile ] + filenames:
+            try:
+                with open(fi) as fh:
+                    snapshot = json.load(fh)
+            except (IOError, ValueError):
+                continue
+            snapshot['gauges'] = []  # gauges end with process
+            retired.merge(snapshot)
+        retired.save(retiredfile)
+        for fi in filenames:
+            try:
+                os.unlink(fi)
+            except OSError:
+                pass
+    return filenames
+
+'''exports metrics of all processes (eg. prefork webservice and job workers) from snapshots in directory (else of this process)'''
+def exportMetrics(directory=None, gauges=[]):
+    combined = Metrics()
+    if directory:
+        saveSnapshot(directory)
+        retireSnapshots(directory)
+        for fi in sorted(os.listdir(directory)):
+            if fi.endswith('.json'):
+                try:
+                    with open(os.path.join(directory, fi)) as fh:
+                        combined.merge(json.load(fh))
+                except (IOError, ValueError):
+                    pass  # replaced while reading
+    else:
+        combined.merge(metrics.snapshot())
+    for name, labels, value in gauges:  # measured at export (eg. queue depth)
+        combined.set(name, value, **labels)
+    return combined.render()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+__doc__=="""In silico PCR (primer binding sites as sorted per chromosome arrays)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+'''binding sites sorted by product end (3' end of reverse primer) per chromosome'''
+class BindingSites(object):
+    def __init__(self, loci):
+        self.loci = loci
+        sites = defaultdict(list)
+        for j, n in enumerate(loci):
+            sites[n.chrom].append((n.offset + n.length, j))
+        self.ends, self.index = {}, {}
+        for chrom, s in sites.items():
+            s.sort()
+            self.ends[chrom] = [ x[0] for x in s ]
+            self.index[chrom] = [ x[1] for x in s ]
+
+    def __len__(self):
+        return len(self.loci)
+
+    def downstream(self, chrom, start, sizeRange=None):
+        '''returns indices of sites giving product size within range from start (all on chromosome if no range)'''
+        try:
+            ends, index = self.ends[chrom], self.index[chrom]
+        except KeyError:
+            return []
+        if not sizeRange:
+            return index
+        return index[bisect_left(ends, start + sizeRange[0]):bisect_right(ends, start + sizeRange[1])]
+
+'''returns products (left locus, right locus) within size range (inclusive) in loci order as nested loop over left and right loci'''
+def amplify(left, right, sizeRange=[0,10000]):
+    sites = BindingSites(right)
+    return [ (m, right[j]) for m in left for j in sorted(sites.downstream(m.chrom, m.offset, sizeRange)) ]
+
+'''pooled primers of several primer pairs (finds products of any forward and reverse binding site)'''
+class Multiplex(object):
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+        self.forward, self.reverse = [], []  # (pair, primer, locus)
+        for pair in self.pairs:
+            for primer in pair:
+                loci = primer.loci if primer.loci or not primer.targetposition else [ primer.targetposition ]  # database primers are not mapped
+                for locus in loci:
+                    (self.reverse if locus.reverse else self.forward).append((pair, primer, locus))
+        self.sites = BindingSites([ x[2] for x in self.reverse ])
+
+    def products(self, sizeRange=[0,10000]):
+        '''returns all products (forward site, reverse site) within size range'''
+        return [ (f, self.reverse[j]) for f in self.forward for j in self.sites.downstream(f[2].chrom, f[2].offset, sizeRange) ]
+
+    def offtarget(self, sizeRange=[0,10000]):
+        '''returns products of primers from different pairs (pair, primer, locus for each side)'''
+        return [ (f, r) for f, r in self.products(sizeRange) if f[0] is not r[0] ]
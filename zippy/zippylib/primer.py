@@ -9,17 +9,37 @@ __maintainer__ = "David Brawand"
 __email__ = "dbrawand@nhs.net"
 __status__ = "Production"
 
-import sys, os, re, datetime
+import sys, os, re, datetime, heapq
+from itertools import count
 from hashlib import md5, sha1
-import primer3
-import pysam
 import subprocess
 from collections import defaultdict, OrderedDict, Counter
 from .interval import Interval
+from .pcr import amplify
+from .thermo import thermo
 from string import maketrans
 from urllib import unquote
 revcmp = maketrans('ACGTNacgtn','TGCANtgcan')
 
+# pysam, primer3 and metrics are imported where used (not needed by database only commands)
+
+'''open genome and variant files (one handle per process and file)'''
+openResources = {}
+
+def openResource(opener, filename):
+    from .metrics import metrics
+    key = (os.getpid(), opener, filename)
+    metrics.hit('resource', key in openResources)
+    if key not in openResources:
+        openResources[key] = opener(filename)
+    return openResources[key]
+
+def preloadResources(genome, variants):
+    '''opens genome and variant files (eg. before serving requests)'''
+    import pysam
+    openResource(pysam.FastaFile, genome)
+    openResource(pysam.TabixFile, variants)
+
 '''returns common prefix (substring)'''
 def commonPrefix(left,right,stripchars='-_ ',commonlength=3):
     if left and right:
@@ -49,23 +69,24 @@ class Genome(object):
         self.file = fi
 
     def primerMatch(self,locus,seq,ampsize):
+        import pysam
         # get sequence with flank
         chromStart = locus.offset-ampsize[1] if locus.reverse else locus.offset+locus.length+ampsize[0]
         chromEnd   = locus.offset-ampsize[0] if locus.reverse else locus.offset+locus.length+ampsize[1]
-        with pysam.FastaFile(self.file) as fasta:
-            seqslice = fasta.fetch(locus.chrom,chromStart,chromEnd)
+        seqslice = openResource(pysam.FastaFile, self.file).fetch(locus.chrom,chromStart,chromEnd)
         # find sequence
         qrySeq = seq if locus.reverse else seq.translate(revcmp)[::-1]
         # create new loci
         loci = []
         for i in [ match.start() for match in re.finditer(re.escape(qrySeq), seqslice) ]:
-            tm = primer3.calcTm(qrySeq)
+            tm = thermo.tm(qrySeq)
             loci.append(Locus(locus.chrom, chromStart+i, len(qrySeq), not locus.reverse, tm))
         return loci
 
 '''just a wrapper for pysam'''
 class MultiFasta(object):
     def __init__(self,fi):
+        import pysam
         self.file = fi
         # check sequence uniqueness
         with pysam.FastaFile(self.file) as fasta:
@@ -75,13 +96,16 @@ class MultiFasta(object):
                 raise Exception('DuplicateSequenceNames')
 
     def createPrimers(self,db,bowtie='bowtie2', delete=True, tags={}, tmThreshold=50.0, endMatch=6, maxAln=20):
+        import pysam
+        from .metrics import metrics
         # run bowtie (max 1000 alignments, allow for one gap/mismatch?)
         mapfile = self.file+'.sam'
         if not os.path.exists(mapfile):
-            proc = subprocess.check_call( \
-                [bowtie, '-f', '--end-to-end', '-p 2', \
-                '-k '+str(maxAln), '-L 10', '-N 1', '-D 20', '-R 3', \
-                '-x', db, '-U', self.file, '>', mapfile ])
+            with metrics.timer('zippy_bowtie2_seconds'):
+                proc = subprocess.check_call( \
+                    [bowtie, '-f', '--end-to-end', '-p 2', \
+                    '-k '+str(maxAln), '-L 10', '-N 1', '-D 20', '-R 3', \
+                    '-x', db, '-U', self.file, '>', mapfile ])
         # Read fasta file (Create Primer)
         primers = {}
         with pysam.FastaFile(self.file) as fasta:
@@ -96,7 +120,7 @@ class MultiFasta(object):
                 else:
                     # create stranded targetlocus
                     reverse = True if reTargetposition.group(4)=='-' else False
-                    tm = primer3.calcTm(fasta.fetch(s))  # assume targetlocus is full match
+                    tm = thermo.tm(fasta.fetch(s))  # assume targetlocus is full match
                     targetLocus = Locus(reTargetposition.group(1), int(reTargetposition.group(2)), int(reTargetposition.group(3))-int(reTargetposition.group(2)), reverse, tm)
                 # create primer (with target locus)
                 primertag = tags[primername] if primername in tags.keys() else None
@@ -106,6 +130,7 @@ class MultiFasta(object):
         mappings = pysam.Samfile(mapfile,'r')
         alnCount = Counter()  # count alignments to kill locations of non-specific primers (count == -k)
         for aln in mappings:
+            metrics.inc('zippy_bowtie2_records_total')
             primername = aln.qname.split('|')[0]
             if aln.is_unmapped:
                 continue
@@ -115,7 +140,7 @@ class MultiFasta(object):
             qry = aln.query_sequence.upper()
             ref = aln.get_reference_sequence().upper()
             refrc = ref.translate(revcmp)[::-1]
-            aln_tm = primer3.calcHeterodimerTm(qry,refrc)
+            aln_tm = thermo.heterodimerTm(qry,refrc)
             # TmThreshold and mimatches in 3'end check
             if aln_tm > tmThreshold:
                 if len(qry)>endMatch and len(ref)>endMatch:
@@ -124,7 +149,7 @@ class MultiFasta(object):
         # remove primer locations for those that have hit maximum
         for k, v in primers.items():
             if len(v.loci) >= maxAln:
-                v.loci = []
+                v.loci = ()
         # cleanup
         if delete:
             os.unlink(self.file+'.sam') # delete mapping FILE
@@ -185,6 +210,8 @@ class PrimerPair(list):
         self.reversed = reverse
         self.name = name
         self.variants = []  # list of intervals with metadata from input table
+        self._rankkey = None  # (ranking state, sortvalues)
+        self._uniqueid = None  # (primer labels, uniqueid)
         if not name and all(self):
             commonPrefix(self[0].name, self[1].name)
 
@@ -214,7 +241,7 @@ class PrimerPair(list):
         return super(PrimerPair, self).insert(i, x)
 
     def __hash__(self):
-        return hash(self.__str__())
+        return hash(self.name)
 
     def __eq__(self,other):
         return self.name == other.name
@@ -241,7 +268,7 @@ class PrimerPair(list):
         return super(PrimerPair, self).__setslice__(*args, **kwargs)
 
     def __lt__(self,other):
-        return self.sortvalues() < other.sortvalues()
+        return self.rankkey() < other.rankkey()
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
@@ -310,28 +337,31 @@ class PrimerPair(list):
 
     def sortvalues(self):
         assert len(self)==2
-        return (len(self.amplicons([0,10000]))-1, self.criticalsnp(), self.mispriming(), self.snpcount(), self.designrank())
+        return (len(self.products([0,10000]))-1, self.criticalsnp(), self.mispriming(), self.snpcount(), self.designrank())
+
+    def rankstate(self):
+        '''identifies ranking inputs (revisions of primers, changed with loci, SNPs and design ranks)'''
+        return tuple([ p._revision for p in self ])
+
+    def rankkey(self):
+        '''returns sortvalues (cached until primers are replaced or their loci, SNPs or ranks change)'''
+        cached = getattr(self, '_rankkey', None)
+        if cached is None or cached[0] != self.rankstate():
+            key = self.sortvalues()  # can reverse pair
+            self._rankkey = (self.rankstate(), key)
+            return key
+        return cached[1]
+
+    def products(self, sizeRange=[0,10000], autoreverse=True):  # in silico PCR of primer loci (left, right locus)
+        products = amplify(self[0].loci, self[1].loci, sizeRange)
+        if autoreverse and not products:  # reverse if and find amplicons if one direction doesnt yield any
+            products = amplify(self[1].loci, self[0].loci, sizeRange)
+            if products:
+                self.reverse()
+        return products
 
     def amplicons(self, sizeRange=[0,10000], autoreverse=True):  # counts possible amplicons to a certain size
-        amplicons = []
-        for m in self[0].loci:
-            for n in self[1].loci:
-                if m.chrom == n.chrom:
-                    amplen = n.offset + n.length - m.offset
-                    if (not sizeRange) or (amplen >= sizeRange[0] and amplen <= sizeRange[1]):
-                        amp = (m, n, Interval(m.chrom,m.offset,n.offset + n.length,self.name))
-                        amplicons.append(amp)
-        if autoreverse and not amplicons:  # reverse if and find amplicons if one direction doesnt yield any
-            for m in self[1].loci:
-                for n in self[0].loci:
-                    if m.chrom == n.chrom:
-                        amplen = n.offset + n.length - m.offset
-                        if (not sizeRange) or (amplen >= sizeRange[0] and amplen <= sizeRange[1]):
-                            amp = (m, n, Interval(m.chrom,m.offset,n.offset + n.length,self.name))
-                            amplicons.append(amp)
-            if amplicons:
-                self.reverse()
-        return amplicons
+        return [ (m, n, Interval(m.chrom,m.offset,n.offset + n.length,self.name)) for m, n in self.products(sizeRange, autoreverse) ]
 
     def snpcount(self):
         return len(self[0].snp)+len(self[1].snp)
@@ -361,7 +391,12 @@ class PrimerPair(list):
         return True
 
     def uniqueid(self):
-        return sha1(','.join([str(self[0].tag)+'-'+self[0].seq,str(self[1].tag)+'-'+self[1].seq])).hexdigest()
+        '''returns SHA1 of tagged primer sequences (cached until sequences or tags change)'''
+        labels = (self[0].label(), self[1].label())
+        cached = getattr(self, '_uniqueid', None)
+        if cached is None or cached[0] != labels:
+            self._uniqueid = (labels, sha1(','.join(labels)).hexdigest())
+        return self._uniqueid[1]
 
     '''returns primer suffixes'''
     def primerSuffixes(self):
@@ -393,23 +428,78 @@ class PrimerPair(list):
             self[i].name = re.sub('^'+oldname,newname,self[i].name)
         return
 
-'''fasta/primer'''
+'''yields primer pairs by rank (heap of cached ranking keys, stable)'''
+def rankedPairs(pairs):
+    heap = [ (p.rankkey(), i, p) for i, p in enumerate(pairs) ]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+'''primer revisions (unique in process)'''
+primerRevisions = count(1)
+
+'''fasta/primer (slotted, Tm, GC and label cached until sequence or tag change, new revision on ranking input change, loci and SNPs immutable)'''
 class Primer(object):
+    __slots__ = ('rank', 'name', 'seq', 'tag', 'loci', 'snp', 'meta', 'targetposition', 'location', '_tm', '_gc', '_label', '_revision')
+    derivedfrom = frozenset(['seq', 'tag'])
+    rankedfrom = frozenset(['loci', 'snp', 'rank'])
+    immutable = frozenset(['loci', 'snp'])  # shared by copies
+
     def __init__(self,name,seq,targetposition=None,tag=None,loci=[],location=None):
         self.rank = -1
         self.name = name
         self.seq = str(seq.upper())
         self.tag = tag
-        self.tm = primer3.calcTm(self.seq)
-        self.gc = (self.seq.count('G') + self.seq.count('C')) / float(len(self.seq))
-        self.loci = []  # genome matches
-        self.snp = []  # same order as loci attribute
+        self.loci = ()  # genome matches (tuple, replaced as shared by copies)
+        self.snp = ()  # same order as loci attribute
         self.meta = {}  # metadata
         self.targetposition = targetposition
         self.location = location  # storage location
         if loci:
             pass
 
+    def __setattr__(self,attr,value):
+        if attr in Primer.immutable:
+            value = tuple(value)
+        object.__setattr__(self, attr, value)
+        if attr in Primer.derivedfrom:
+            for k in ('_tm', '_gc', '_label'):
+                object.__setattr__(self, k, None)  # sequence or tag changed
+        elif attr in Primer.rankedfrom:
+            object.__setattr__(self, '_revision', next(primerRevisions))  # invalidates ranking keys of pairs
+
+    def __getstate__(self):
+        return tuple([ getattr(self, k) for k in Primer.__slots__ ])
+
+    def __setstate__(self,state):
+        for k, v in zip(Primer.__slots__, state):
+            object.__setattr__(self, k, tuple(v) if k in Primer.immutable else v)
+        object.__setattr__(self, '_revision', next(primerRevisions))  # revisions of other processes not unique
+
+    def __copy__(self):
+        '''shares loci, SNPs, metadata and cached values with original (copy on write)'''
+        new = Primer.__new__(Primer)
+        new.__setstate__(self.__getstate__())
+        return new
+
+    @property
+    def tm(self):
+        if self._tm is None:
+            self._tm = thermo.tm(self.seq)
+        return self._tm
+
+    @property
+    def gc(self):
+        if self._gc is None:
+            self._gc = (self.seq.count('G') + self.seq.count('C')) / float(len(self.seq))
+        return self._gc
+
+    def label(self):
+        '''returns tagged sequence (TAG-SEQUENCE)'''
+        if self._label is None:
+            self._label = str(self.tag)+'-'+self.seq
+        return self._label
+
     def __hash__(self):
         return hash(self.name) ^ hash(self.seq) ^ hash(self.tag)
 
@@ -438,7 +528,7 @@ class Primer(object):
         return "\n".join([ ">"+seqname, self.seq ])
 
     def addTarget(self, chrom, pos, reverse, tm=None):
-        self.loci.append(Locus(chrom,pos,len(self),reverse,tm))
+        self.loci = self.loci + (Locus(chrom,pos,len(self),reverse,tm),)
         return
 
     def snpCheckPrimer(self,vcf):
@@ -479,13 +569,16 @@ class Locus(object):
         return hash((self.chrom, self.offset, self.length, self.reverse))
 
     def snpCheck(self,database):
-        db = pysam.TabixFile(database)
-        try:
-            snps = db.fetch(self.chrom,self.offset,self.offset+self.length)
-        except ValueError:
-            snps = []
-        except:
-            raise
+        import pysam
+        from .metrics import metrics
+        db = openResource(pysam.TabixFile, database)
+        with metrics.timer('zippy_tabix_query_seconds'):
+            try:
+                snps = list(db.fetch(self.chrom,self.offset,self.offset+self.length))
+            except ValueError:
+                snps = []
+            except:
+                raise
         # query database and translate to primer positions
         snp_positions = []
         for v in snps:
@@ -498,10 +591,11 @@ class Locus(object):
 '''primer3 wrapper class'''
 class Primer3(object):
     def __init__(self,genome,target,flank=200):
+        import pysam
         self.genome = genome
         self.target = target
         self.flank = flank
-        fasta = pysam.FastaFile(self.genome)
+        fasta = openResource(pysam.FastaFile, self.genome)
         self.designregion = ( str(self.target[0]), self.target[1]-self.flank, self.target[2]+self.flank )
         self.sequence = fasta.fetch(*self.designregion)
         self.pairs = []
@@ -511,6 +605,7 @@ class Primer3(object):
         return len(self.pairs)
 
     def design(self,name,pars):
+        import primer3
         # Sequence args
         seq = {
             'SEQUENCE_ID': str(name),
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+__doc__=="""Application configuration and resource registry"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import os
+import json
+import threading
+from . import ascii_encode_dict
+from .metrics import metrics
+
+'''configuration (reloaded when file changes) and shared resources (one per process)'''
+class Registry(object):
+    def __init__(self, configfile):
+        self.configfile = configfile
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.current = None  # configuration
+        self.resources = {}  # (pid, name) -> resource
+
+    def config(self):
+        '''returns configuration (resources are reopened if configuration changed)'''
+        mtime = os.stat(self.configfile).st_mtime
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.configfile) as conf:
+                        self.current = json.load(conf, object_hook=ascii_encode_dict)
+                    for (pid, name), resource in self.resources.items():
+                        if pid == os.getpid() and hasattr(resource, 'close'):
+                            resource.close()  # open connections (requests using them finish first)
+                    self.resources = {}
+                    self.mtime = mtime
+        return self.current
+
+    def resource(self, name, factory):
+        '''returns resource built by factory(config)'''
+        config = self.config()
+        key = (os.getpid(), name)  # not shared with forked processes
+        try:
+            resource = self.resources[key]
+        except KeyError:
+            metrics.hit('registry', False)
+            with self.lock:
+                if key not in self.resources:
+                    self.resources[key] = factory(config)
+                return self.resources[key]
+        metrics.hit('registry', True)
+        return resource
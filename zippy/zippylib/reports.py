@@ -21,6 +21,7 @@ from hashlib import sha1
 from collections import Counter
 from . import PlateError, char_range, imageDir, githash
 from .primer import parsePrimerName, PrimerPair, Primer
+from .metrics import metrics
 from urllib import unquote
 
 from reportlab.pdfgen import canvas
@@ -578,7 +579,8 @@ class Worksheet(list):
                 tickbox=['Unmatched Sample Check', 'Control Check'], tickboxNames=['YES','NO'],
                 textLines={'Comments': 3})
         # build pdf
-        r.build()
+        with metrics.timer('zippy_pdf_render_seconds', report='primertest' if primertest else 'worksheet'):
+            r.build()
 
     '''tube Labels'''
     def tubeLabels(self,fi='/dev/null',tags={}):
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+__doc__=="""Primer storage interface"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import sys
+import re
+from .primer import Primer, Locus, PrimerPair, Location, parsePrimerName
+from .thermo import thermo
+
+# date queries (eg. 2016-05-12)
+datematch = re.compile("([0-9\s-]+)$")
+
+# changes conflicting name
+def changeConflictingName(n):
+    f = n.split('_')
+    # find suffix to increment
+    if len(f)==4:  # try to increase suffix
+        try:
+            f[2] = str(int(f[2])+1)
+        except:
+            raise Exception('PrimerNameChangeError')
+        return '_'.join(f)
+    elif len(f)==3:  # add number suffix after exon
+        return '_'.join(f[:2]+[str(1)]+f[2])
+    raise Exception('PrimerNameChangeError')
+
+'''primer storage engine (implemented by PrimerDB and MemoryDB)'''
+class PrimerStore(object):
+    def __init__(self, dump=None):
+        self.dumpfile = dump  # Primer BED file written after updates
+
+    def __repr__(self):
+        return "\n".join([ '{:<20} {:40} {:>20} {:<25} {:>20} {:<25} {:>8} {:>9d} {:>9d} {}'.format(*row) for row in self.pairTable() ])
+
+    # ==========================================================================
+    # engine methods
+    # ==========================================================================
+    def version(self, primary=False):
+        '''returns database version (incremented by every write, of primary database if requested)'''
+        raise NotImplementedError
+
+    def pairTable(self):
+        '''returns (pairid, uniqueid, left, leftseq, right, rightseq, chrom, start, end, dateadded)'''
+        raise NotImplementedError
+
+    def queryRows(self, query):
+        '''returns pair rows for interval, pair name or date (ordered by midpoint distance or name)'''
+        raise NotImplementedError
+
+    def queryRowsMany(self, queries):
+        '''returns pair rows for each query (engines may answer all in one transaction)'''
+        return [ self.queryRows(q) for q in queries ]
+
+    def searchRows(self, name, offset=0, limit=None):
+        '''returns number of pairs matching name and rows of requested page'''
+        rows = [ row for row in self.queryRows(name) if name.lower() in row[0].lower() ]  # names only
+        return len(rows), rows[offset:] if limit is None else rows[offset:offset+limit]
+
+    def dumpRows(self, what, **kwargs):
+        '''returns rows and column names for amplicons, ordersheet, locations and table'''
+        raise NotImplementedError
+
+    def addPrimer(self, *primers):
+        raise NotImplementedError
+
+    def addPair(self, *pairs):
+        raise NotImplementedError
+
+    def blacklist(self, add=None):
+        raise NotImplementedError
+
+    def removeOrphans(self):
+        raise NotImplementedError
+
+    def getLocation(self, loc):
+        raise NotImplementedError
+
+    def addLocations(self, *locations):
+        raise NotImplementedError
+
+    def storePrimer(self, primerid, loc, force=False):
+        raise NotImplementedError
+
+    def updateName(self, primerName, newName):
+        raise NotImplementedError
+
+    def updatePairName(self, pairName, newName):
+        raise NotImplementedError
+
+    def getRedundantPrimers(self):
+        raise NotImplementedError
+
+    def mergeRedundantPrimers(self):
+        raise NotImplementedError
+
+    # ==========================================================================
+    # shared methods
+    # ==========================================================================
+    def close(self):
+        '''releases persistent connections (none unless engine keeps them)'''
+        pass
+
+    def writeAmpliconDump(self):
+        ## dump amplicons to bed file
+        if self.dumpfile:
+            rows, colnames = self.dumpRows('amplicons')
+            # write bed file
+            try:
+                with open(self.dumpfile,'w') as fh:
+                    for row in rows:
+                        print >> fh, '\t'.join(map(str,row))
+            except IOError:
+                print >> sys.stderr, "cannot write to %s" % self.dumpfile
+                pass  # fail silently (eg if data cannot be written)
+            except:
+                raise
+
+    '''query for interval or name'''
+    def query(self, query):
+        '''returns suitable primer pairs for the specified interval'''
+        return self._primerPairs(self.queryRows(query))  # ordered by midpoint distance
+
+    def queryMany(self, queries):
+        '''returns primer pairs for each interval or name'''
+        return [ self._primerPairs(rows) for rows in self.queryRowsMany(queries) ]
+
+    def search(self, name, offset=0, limit=None):
+        '''returns number of pairs matching name and primer pairs of requested page'''
+        total, rows = self.searchRows(name, offset, limit)
+        return total, self._primerPairs(rows)
+
+    def _primerPairs(self, rows):
+        # return primer pairs that would match
+        primerPairs = []
+        for row in rows:
+            # build targets
+            leftTargetposition = Locus(row[7], row[8], len(row[3]), False, thermo.tm(str(row[3])))
+            rightTargetposition = Locus(row[7], row[9]-len(row[4]), len(row[4]), True, thermo.tm(str(row[4])))
+            # build storage locations (if available)
+            leftLocation = Location(*row[10:12]) if all(row[10:12]) else None
+            rightLocation = Location(*row[12:14]) if all(row[12:14]) else None
+            # Build primers
+            leftPrimer = Primer(row[5], row[3], targetposition=leftTargetposition, tag=row[1], location=leftLocation)
+            rightPrimer = Primer(row[6], row[4], targetposition=rightTargetposition, tag=row[2], location=rightLocation)
+            # get reverse status (from name)
+            orientations = [ x[1] for x in map(parsePrimerName,row[5:7]) ]
+            if not any(orientations) or len(set(orientations))==1:
+                print >> sys.stderr, '\rWARNING: {} orientation is ambiguous ({},{}){}\r'.format(row[0],\
+                    '???' if orientations[0]==0 else 'rev' if orientations[0]<0 else 'fwd', \
+                    '???' if orientations[0]==0 else 'rev' if orientations[1]<0 else 'fwd'," "*20)
+                reverse = False
+            elif orientations[0]>0 or orientations[1]<0:
+                reverse = False
+            elif orientations[1]>0 or orientations[0]<0:
+                reverse = True
+            else:
+                raise Exception('PrimerPairStrandError')
+            # Build pair
+            primerPairs.append(PrimerPair([leftPrimer, rightPrimer],name=row[0],reverse=reverse))
+        return primerPairs
+
+    def dump(self,what,**kwargs):
+        rows, columns = self.dumpRows(what,**kwargs)
+        if what=='ordersheet':
+            # add tags and extra columns
+            if 'extracolumns' in kwargs.keys() and kwargs['extracolumns']:
+                columns += [ c[0] for c in kwargs['extracolumns'] ]
+                for i in range(len(rows)):
+                    rows[i] = list(rows[i]) + [ c[1] for c in kwargs['extracolumns'] ]
+            # add sequence tag
+            if 'sequencetags' in kwargs.keys() and kwargs['sequencetags']:
+                for row in rows:
+                    # get correct tag
+                    try:
+                        p = parsePrimerName(row[1])
+                        if p[1] > 0:
+                            prepend = kwargs['sequencetags'][row[3]]['tags'][0]
+                        elif p[1] < 0:
+                            prepend = kwargs['sequencetags'][row[3]]['tags'][1]
+                        else:
+                            raise Exception('PrimerNameParseError')
+                        print >> sys.stderr, prepend
+                    except AssertionError:
+                        raise
+                    except:
+                        row[2] = row[3] + '-' + row[2]  # prepend tag sequence
+                    else:
+                        row[2] = prepend + row[2]  # prepend tag sequence
+        # return rows (list of list) and column names (headers)
+        return rows, columns
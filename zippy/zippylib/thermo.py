@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+__doc__=="""Thermodynamics (cached Primer3 melting temperature, hairpin and dimer calculations)"""
+__author__ = "David Brawand"
+__license__ = "MIT"
+__version__ = "2.3.3"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+__status__ = "Production"
+
+import os
+import cPickle as pickle
+from collections import namedtuple
+
+'''secondary structure result (picklable copy of primer3 ThermoResult)'''
+ThermoResult = namedtuple('ThermoResult', ['structure_found', 'tm', 'dg', 'dh', 'ds'])
+
+'''bounded cache of Primer3 calculations keyed by calculation, sequences and conditions (one per process)'''
+class Thermodynamics(object):
+    conditionnames = ('mv_conc', 'dv_conc', 'dntp_conc', 'dna_conc')  # salt and oligo concentrations
+
+    def __init__(self, size=100000, **conditions):
+        self.recent, self.older = {}, {}  # (calculation, sequences, conditions) -> result (two generations, approximates LRU)
+        self.hits, self.misses = 0, 0
+        self.reported = (0, 0)  # hits and misses published to metrics
+        self.loaded = None  # persisted cache
+        self.size = size
+        self.configure(None, **conditions)
+
+    def __len__(self):
+        return len(self.recent) + len([ k for k in self.older if k not in self.recent ])
+
+    def configure(self, size=None, **conditions):
+        '''sets cache size and conditions (Primer3 defaults if not given)'''
+        for k in conditions.keys():
+            if k not in Thermodynamics.conditionnames:
+                raise ValueError('unknown condition {}'.format(k))
+        if size is not None and size != self.size:
+            self.size = size
+            self.recent, self.older = {}, {}
+        self.conditions = conditions
+        self.key = tuple(sorted(conditions.items()))
+
+    def _store(self, key, result):
+        if len(self.recent) >= self.size/2:
+            self.recent, self.older = {}, self.recent  # least recently used generation dropped
+        self.recent[key] = result
+
+    def _lookup(self, calculation, *seqs):
+        key = (calculation, seqs, self.key)
+        try:
+            result = self.recent[key]
+        except KeyError:
+            try:
+                result = self.older[key]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                self._store(key, result)  # used again
+                return result
+        else:
+            self.hits += 1
+            return result
+        self.misses += 1
+        import primer3
+        result = getattr(primer3, calculation)(*seqs, **self.conditions)
+        if hasattr(result, 'structure_found'):
+            result = ThermoResult(result.structure_found, result.tm, result.dg, result.dh, result.ds)
+        self._store(key, result)
+        return result
+
+    def tm(self, seq):
+        return self._lookup('calcTm', seq)
+
+    def hairpin(self, seq):
+        return self._lookup('calcHairpin', seq)
+
+    def homodimer(self, seq):
+        return self._lookup('calcHomodimer', seq)
+
+    def heterodimerTm(self, seq1, seq2):
+        return self._lookup('calcHeterodimerTm', seq1, seq2)
+
+    def ratio(self):
+        '''returns hit ratio of this process'''
+        return self.hits / float(self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def report(self):
+        '''adds hits and misses since last report to cache metrics'''
+        from .metrics import metrics
+        for result, count, reported in [('hit', self.hits, self.reported[0]), ('miss', self.misses, self.reported[1])]:
+            if count > reported:
+                metrics.inc('zippy_cache_requests_total', count-reported, cache='thermo', result=result)
+        self.reported = (self.hits, self.misses)
+        metrics.set('zippy_thermo_cache_entries', len(self))
+
+    def items(self):
+        '''returns cached results (least recently used first)'''
+        return [ (k, v) for k, v in self.older.items() if k not in self.recent ] + self.recent.items()
+
+    def load(self, filename):
+        '''adds persisted results (once per file and process)'''
+        if self.loaded == filename or not os.path.exists(filename):
+            return
+        try:
+            with open(filename, 'rb') as fh:
+                items = pickle.load(fh)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return  # rebuilt on next save
+        for key, result in items[-self.size:]:
+            if key not in self.recent:
+                self._store(key, result)
+        self.loaded = filename
+
+    def save(self, filename):
+        '''writes results atomically'''
+        with open(filename+'.tmp', 'wb') as fh:
+            pickle.dump(self.items(), fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename+'.tmp', filename)
+        self.loaded = filename
+
+'''process thermodynamics cache'''
+thermo = Thermodynamics()